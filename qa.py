@@ -67,20 +67,61 @@ def test_module1_with_a_user(ctx):
 __author__ = 'Brandon Bickford <bickfordb@gmail.com>'
 __version__ = '0.1.0'
 
+import array
+import ast
+import BaseHTTPServer
+import collections
 import contextlib
+import copy
+import cProfile
+import cStringIO
+import cPickle as pickle
 import datetime
-import logging
+import errno
+import functools
+import gc
+import hashlib
 import imp
+import itertools
+import json
+import linecache
+import logging
+import math
 import multiprocessing
 import operator
 import optparse
 import os
+import pstats
 import re
+try:
+    import resource
+except ImportError:
+    resource = None
+import select
+import signal
+import socket
+import SocketServer
+import struct
 import sys
-import thread
+import threading
 import time
+import timeit
 import traceback
+import types
 import Queue
+from xml.sax import saxutils
+
+try:
+    import gevent
+    import gevent.lock
+    import gevent.queue
+except ImportError:
+    gevent = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 # _qa_globals: This is a separate module which stores global state.  This
 # keeps global state (test case and plugin registration specifically) from
@@ -104,18 +145,82 @@ _registration_log = logging.getLogger('qa.register')
 RUN_SINGLETHREAD = 'single'
 RUN_MULTITHREAD = 'thread'
 RUN_MULTIPROCESS = 'process'
+RUN_ASYNC = 'async'
+RUN_DISTRIBUTED = 'distributed'
+RUN_HYBRID = 'hybrid'
 
-RUN_MODES = [RUN_SINGLETHREAD, RUN_MULTITHREAD, RUN_MULTIPROCESS]
+RUN_MODES = [RUN_SINGLETHREAD, RUN_MULTITHREAD, RUN_MULTIPROCESS, RUN_ASYNC, RUN_DISTRIBUTED, RUN_HYBRID]
 
 DEFAULT_NUM_WORKERS = 10
+DEFAULT_THREADS_PER_PROCESS = 4
+
+SHARD_STABLE = 'stable'
+SHARD_BALANCED = 'balanced'
+
+SHARD_STRATEGIES = [SHARD_STABLE, SHARD_BALANCED]
+
+# Seconds the process pool waits past a test's timeout for the worker to
+# interrupt the test itself before killing the worker, and the thread pool
+# waits for abandoned tests to free the resources other tests are waiting for
+DEFAULT_TIMEOUT_GRACE = 5.0
+_WATCHDOG_INTERVAL = 0.1
+
+DEFAULT_LISTEN_ADDRESS = '127.0.0.1:7910'
+DEFAULT_CONNECT_TIMEOUT = 60.0
+# Tests the coordinator queues for each connected worker agent, so the test case stream is read as workers join
+_COORDINATOR_PREFETCH = 2
+
+DEFAULT_DURATIONS_FILE = '.qa-durations'
+DEFAULT_IMPACT_FILE = '.qa-impact'
+DEFAULT_FAILED_FILE = '.qa-failed'
+DEFAULT_INDEX_FILE = '.qa-index'
+DEFAULT_CACHE_DIR = '.qa-cache'
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_BENCHMARKS_FILE = '.qa-benchmarks'
+DEFAULT_PROFILE_TOP = 30
+DEFAULT_MEMORY_TOP = 10
+# The fewest reruns of a leak check, so a leak is the object count growing at least twice in a row
+MIN_LEAK_CHECK = 3
+DEFAULT_BENCHMARK_THRESHOLD = 0.25
+DEFAULT_BENCHMARK_MIN_TIME = 0.5
+DEFAULT_PARAM_BATCH_SIZE = 50
+DEFAULT_WATCH_INTERVAL = 0.5
+DEFAULT_METRICS_INTERVAL = 5.0
+DEFAULT_METRICS_TOP = 10
+# Benchmark rounds are made at least this long so the timer's resolution doesn't matter
+_BENCHMARK_MIN_ROUND_TIME = 0.005
+# Longer parameter ids are replaced by the row index
+_MAX_PARAM_ID_LENGTH = 40
+# Seconds to keep collecting changes after the first one, since editors write files in several steps
+_WATCH_SETTLE_TIME = 0.2
+# The most tests held back waiting for resources while later tests are started
+_MAX_WAITING_TESTS = 1000
+# Seconds over which the recent rate of finished tests is measured
+_METRICS_RATE_WINDOW = 60
+# Resource limiting the copies of each test in flight (see run_test_cases' concurrency)
+_COPIES_RESOURCE = 'qa:copies'
+
+SCOPE_TEST = 'test'
+SCOPE_GROUP = 'group'
+SCOPE_WORKER = 'worker'
+SCOPE_SESSION = 'session'
 
-def testcase(group=None, name=None, requires=(), is_global=True):
+SCOPES = [SCOPE_TEST, SCOPE_GROUP, SCOPE_WORKER, SCOPE_SESSION]
+
+def testcase(group=None, name=None, requires=(), is_global=True, timeout=None, params=None, ids=None, thread_safe=True,
+        resources=None):
     """Decorator for creating a test case
 
     Arguments
     group -- string, the group of the test.  This defaults to the module name
     name -- string, the name of the test.  This defaults to the function name
     requires -- sequence of context managers that take a dictionary paramter. Each context manager is called one at a time
+    timeout -- float, seconds the test may run before it is reported as crashed.  This defaults to the run's timeout.
+    params -- iterable of parameter rows, or a function returning one, to run the test once for each row (see parametrize)
+    ids -- sequence of the id of each row, or a function of a row returning its id
+    thread_safe -- bool.  In hybrid mode, a test which isn't thread safe runs alone in its worker process.
+    resources -- dictionary of resource name to the units of it the test uses, like {'db': 1}.  The parallel
+        runners only start the test when that many units are free (see --resource).
 
     Returns
     """
@@ -128,12 +233,287 @@ def testcase(group=None, name=None, requires=(), is_global=True):
                 group_ = ''
         else:
             group_ = group
-        a_test_case = TestCase(group=group_, name=name_, callable=function, requires=requires, description=function.__doc__)
+        if params is None:
+            params_, ids_ = getattr(function, 'params', None), getattr(function, 'ids', None)
+        else:
+            params_, ids_ = params, ids
+        a_test_case = TestCase(group=group_, name=name_, callable=function, requires=requires, description=function.__doc__,
+                timeout=timeout, params=params_, ids=ids_, thread_safe=thread_safe, resources=resources)
         if is_global:
             register_test_case(a_test_case)
         return a_test_case
     return case_decorator
 
+def benchmark(group=None, name=None, requires=(), is_global=True, timeout=None, warmup=1,
+        min_time=DEFAULT_BENCHMARK_MIN_TIME, min_rounds=5, max_rounds=1000, threshold=None):
+    """Decorator for creating a benchmark
+
+    A benchmark is a test case whose function is called many times while its
+    requirements are set up once.  After warmup calls, the calls are timed in
+    rounds until min_time seconds have passed (and at least min_rounds rounds
+    have run).  The timings are recorded in test_result.extra['benchmark'] by
+    BenchmarkPlugin, which also fails the benchmark when it is slower than
+    its baseline.
+
+    The parallel runners run benchmarks one at a time after every other test
+    has finished so they aren't slowed down by their neighbors.
+
+    Arguments
+    warmup -- int, the number of untimed calls
+    min_time -- float, seconds to keep timing calls for
+    min_rounds -- int, the fewest timed rounds
+    max_rounds -- int, the most timed rounds
+    threshold -- float, the fraction by which the median time may exceed the baseline's.  This
+        defaults to the run's threshold.
+
+    The rest of the arguments are the same as testcase's.
+
+    Usage:
+
+    @qa.benchmark(requires=[database])
+    def insert_user(ctx):
+        ctx.db.insert_user('someone')
+    """
+    def benchmark_decorator(function):
+        settings = Benchmark(warmup=warmup, min_time=min_time, min_rounds=min_rounds, max_rounds=max_rounds,
+                threshold=threshold)
+        @functools.wraps(function)
+        def run_benchmark(ctx, *params):
+            if params:
+                settings.run(lambda ctx: function(ctx, *params), ctx)
+            else:
+                settings.run(function, ctx)
+        a_test_case = testcase(group=group, name=name, requires=requires, is_global=is_global,
+                timeout=timeout)(run_benchmark)
+        a_test_case.benchmark = settings
+        return a_test_case
+    return benchmark_decorator
+
+def parametrize(params, ids=None):
+    """Decorator for running a test case once for each row of parameters
+
+    The test function is called with the context followed by the row's
+    values (a row which isn't a tuple is passed as a single value).  Each row
+    runs as its own test named "name[id]".  The default id joins the row's
+    values with "-" when they are short numbers or strings, and is the row's
+    index otherwise.
+
+    Rows are made lazily while the tests run, so params may be a generator
+    function producing millions of rows.  A function is called again each
+    time the test case is expanded (once in each worker agent of a
+    distributed run, for instance) and must produce the same rows each time.
+
+    Arguments
+    params -- iterable of rows, or a function returning one
+    ids -- sequence of the id of each row, or a function of a row returning its id
+
+    Usage:
+
+    @qa.parametrize([(1, 2, 3), (2, 2, 4)])
+    @qa.testcase()
+    def add(ctx, x, y, expected):
+        qa.expect_eq(x + y, expected)
+    """
+    def parametrize_decorator(test_case):
+        test_case.params = params
+        test_case.ids = ids
+        return test_case
+    return parametrize_decorator
+
+def _default_param_id(row, index):
+    values = row if isinstance(row, tuple) else (row, )
+    if values and all(v is None or isinstance(v, (basestring, bool, int, long, float)) for v in values):
+        param_id = u'-'.join(v if isinstance(v, unicode) else unicode(str(v), 'utf-8', 'replace') for v in values)
+        if param_id and len(param_id) <= _MAX_PARAM_ID_LENGTH:
+            return param_id
+    return unicode(index)
+
+def _call_with_params(function, params, ctx):
+    return function(ctx, *params)
+
+def expand_test_case(test_case):
+    """Yield the test cases a test case runs as: one for each row of a parametrized test case, itself otherwise
+
+    The rows are read lazily.
+    """
+    if test_case.params is None:
+        yield test_case
+        return
+    rows = test_case.params() if callable(test_case.params) else test_case.params
+    for index, row in enumerate(rows):
+        param_test_case = ParamTestCase(test_case, index, row)
+        if test_case.param_filter is None or test_case.param_filter(param_test_case):
+            yield param_test_case
+
+def expand_test_cases(test_cases):
+    """Lazily expand a stream of test cases (see expand_test_case)"""
+    for test_case in test_cases:
+        for expanded in expand_test_case(test_case):
+            yield expanded
+
+def _filter_test_cases(test_cases, name_filter):
+    """Select the test cases matching a name filter
+
+    Parametrized test cases whose own name doesn't match are kept with the
+    filter applied to their rows as they are expanded.
+    """
+    for test_case in test_cases:
+        if name_filter(test_case):
+            yield test_case
+        elif test_case.params is not None:
+            yield _add_param_filter(test_case, name_filter)
+
+def _add_param_filter(test_case, param_filter):
+    """Copy a parametrized test case, only running the rows which also pass param_filter"""
+    previous = test_case.param_filter
+    test_case = copy.copy(test_case)
+    if previous is None:
+        test_case.param_filter = param_filter
+    else:
+        test_case.param_filter = lambda param_test_case: previous(param_test_case) and param_filter(param_test_case)
+    return test_case
+
+def _row_names(test_cases, names):
+    """Find the names of the rows of parametrized test cases among names
+
+    Records of parametrized tests are kept for each row, named "group:name[id]".
+
+    Returns
+    dictionary of the "group:name" of each parametrized test case in test_cases with rows in names to the
+    list of their names
+    """
+    templates = set(t.group_and_name() for t in test_cases if t.params is not None)
+    rows = {}
+    if not templates:
+        return rows
+    for name in names:
+        start = name.find('[')
+        while start != -1:
+            if name[:start] in templates:
+                rows.setdefault(name[:start], []).append(name)
+                break
+            start = name.find('[', start + 1)
+    return rows
+
+def _with_row_durations(test_cases, durations):
+    """Add the total recorded duration of the rows of each parametrized test case to durations"""
+    rows = _row_names(test_cases, durations)
+    if not rows:
+        return durations
+    durations = dict(durations)
+    for name, row_names in rows.iteritems():
+        durations.setdefault(name, sum(durations[row_name] for row_name in row_names))
+    return durations
+
+class Benchmark(object):
+    """The settings of a benchmark test case (see the benchmark decorator)"""
+    def __init__(self, warmup=1, min_time=DEFAULT_BENCHMARK_MIN_TIME, min_rounds=5, max_rounds=1000, threshold=None):
+        self.warmup = warmup
+        self.min_time = min_time
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self.threshold = threshold
+
+    def run(self, function, ctx):
+        """Time function and compare it to ctx's baseline
+
+        The statistics are stored in the context for BenchmarkPlugin to
+        record.
+
+        Raises
+        Failure -- the median time per call exceeds the baseline's by more than the threshold
+        """
+        for i in range(self.warmup):
+            function(ctx)
+        # Double the number of calls in each round until a round is long enough to time
+        loops = 1
+        while _time_calls(function, ctx, loops) < _BENCHMARK_MIN_ROUND_TIME and loops < 2 ** 24:
+            loops *= 2
+        times = []
+        started = timeit.default_timer()
+        while len(times) < self.max_rounds and (len(times) < self.min_rounds
+                or timeit.default_timer() - started < self.min_time):
+            times.append(_time_calls(function, ctx, loops) / loops)
+        stats = _benchmark_stats(times, loops)
+        ctx['_qa_benchmark'] = stats
+        baseline = ctx.get('_qa_benchmark_baseline')
+        threshold = self.threshold if self.threshold is not None else ctx.get('_qa_benchmark_threshold')
+        if baseline is not None and threshold is not None and stats['median'] > baseline['median'] * (1 + threshold):
+            raise Failure('benchmark regressed: median %s per call, baseline %s (%+.0f%%, threshold %+.0f%%)' % (
+                _format_seconds(stats['median']), _format_seconds(baseline['median']),
+                100.0 * (stats['median'] / baseline['median'] - 1), 100.0 * threshold))
+
+def _time_calls(function, ctx, loops):
+    started = timeit.default_timer()
+    for i in xrange(loops):
+        function(ctx)
+    return timeit.default_timer() - started
+
+def _benchmark_stats(times, loops):
+    """Summarize the seconds per call of each benchmark round"""
+    times = sorted(times)
+    n = len(times)
+    mean = sum(times) / n
+    if n % 2:
+        median = times[n // 2]
+    else:
+        median = (times[n // 2 - 1] + times[n // 2]) / 2
+    return {'rounds': n,
+            'loops': loops,
+            'min': times[0],
+            'median': median,
+            'p95': _percentile(times, 0.95),
+            'stddev': math.sqrt(sum((t - mean) ** 2 for t in times) / (n - 1)) if n > 1 else 0.0,
+            'ops_per_sec': 1.0 / mean if mean > 0 else 0.0}
+
+def _percentile(values, fraction):
+    """Get the nearest rank percentile of sorted values"""
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+def _format_seconds(seconds):
+    for unit, scale in [('s', 1.0), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return '%.3g%s' % (seconds / scale, unit)
+    return '%.3gns' % (seconds / 1e-9, )
+
+def _format_bytes(num_bytes):
+    if num_bytes is None:
+        return 'unknown'
+    for unit, scale in [('GiB', 2 ** 30), ('MiB', 2 ** 20), ('KiB', 2 ** 10)]:
+        if abs(num_bytes) >= scale:
+            return '%.3g%s' % (float(num_bytes) / scale, unit)
+    return '%dB' % (num_bytes, )
+
+def fixture(scope=SCOPE_TEST):
+    """Decorator for setting the scope of a test case requirement
+
+    A requirement with a scope other than SCOPE_TEST is set up once and shared
+    by every test that requires it within that scope:
+
+    SCOPE_GROUP -- once for each test case group
+    SCOPE_WORKER -- once for each worker thread or process
+    SCOPE_SESSION -- once for the whole run (once for each worker process in process mode, unless it is preloaded)
+
+    Whatever the requirement sets on its context is copied into the context of
+    each test that uses it.  A shared requirement is torn down once the last
+    test that needs it has finished.
+
+    Usage:
+
+    @qa.fixture(scope=qa.SCOPE_SESSION)
+    @contextlib.contextmanager
+    def database(ctx):
+        ctx.db = create_database()
+        yield
+        drop_database(ctx.db)
+    """
+    if scope not in SCOPES:
+        raise ValueError("unexpected scope", scope)
+    def fixture_decorator(function):
+        function.scope = scope
+        return function
+    return fixture_decorator
+
 def register_test_case(test_case):
     """Globally register a test case"""
     _registration_log.debug('registering test case: %r', test_case)
@@ -144,7 +524,8 @@ class TestCase(object):
 
     These are usually made with the @testcase decorator
     """
-    def __init__(self, callable=None, group='', name='', requires=(), description='', skip=False, skip_reason=''):
+    def __init__(self, callable=None, group='', name='', requires=(), description='', skip=False, skip_reason='',
+            timeout=None, benchmark=None, params=None, ids=None, thread_safe=True, resources=None):
         self.group = group
         self.name = name
         self.callable = callable
@@ -152,6 +533,14 @@ class TestCase(object):
         self.description = description
         self.skip = skip
         self.skip_reason = skip_reason
+        self.timeout = timeout
+        self.benchmark = benchmark
+        self.params = params
+        self.ids = ids
+        self.thread_safe = thread_safe
+        self.resources = {} if resources is None else dict(resources)
+        # Filter of the rows of a parametrized test case (see _filter_test_cases)
+        self.param_filter = None
 
     def group_and_name(self):
         return '%s:%s' % (self.group, self.name)
@@ -166,10 +555,41 @@ class TestCase(object):
         return cmp((type(self), self.group, self.callable, self.requires, self.description),
                 (type(other), self.group, other.callable, other.requires, other.description))
 
+class ParamTestCase(TestCase):
+    """One row of a parametrized test case
+
+    These are made by expand_test_case.
+
+    Arguments
+    template -- TestCase, the parametrized test case
+    param_index -- int, the index of the row
+    param_row -- the row of parameters
+    """
+    def __init__(self, template, param_index, param_row):
+        if template.ids is None:
+            param_id = _default_param_id(param_row, param_index)
+        elif callable(template.ids):
+            param_id = template.ids(param_row)
+        else:
+            param_id = template.ids[param_index]
+        params = param_row if isinstance(param_row, tuple) else (param_row, )
+        TestCase.__init__(self, callable=functools.partial(_call_with_params, template.callable, params),
+                group=template.group, name=u'%s[%s]' % (template.name, param_id), requires=template.requires,
+                description=template.description, skip=template.skip, skip_reason=template.skip_reason,
+                timeout=template.timeout, benchmark=template.benchmark, thread_safe=template.thread_safe,
+                resources=template.resources)
+        self.template = template
+        self.param_index = param_index
+        self.param_row = param_row
+
 class Failure(Exception):
     """A test failure which is not a crash"""
     pass
 
+class Timeout(Exception):
+    """Raised inside a test which ran for longer than its timeout"""
+    pass
+
 def make_expect_function(function, msg, doc):
     """Function wrapper (decorator) for building new 'expect_' functions"""
     def wrapper(*args):
@@ -193,6 +613,51 @@ expect_isinstance = make_expect_function(isinstance, '%r isinstance %r', 'expect
 def unlines(seq):
     return os.linesep.join(seq)
 
+# The most frames kept of a test's traceback
+TRACEBACK_LIMIT = 30
+
+class ExceptionSummary(object):
+    """An exception and the call stack it was raised through, without the traceback's frames
+
+    Only file names, line numbers and function names are kept, so the
+    frames' locals can be freed as soon as the test finishes.  Source lines
+    are looked up when the summary is formatted.
+    """
+    __slots__ = ('exception_lines', 'stack')
+
+    def __init__(self, exception_lines, stack):
+        self.exception_lines = exception_lines
+        self.stack = stack
+
+    @classmethod
+    def from_exc_info(cls, exc_info, limit=TRACEBACK_LIMIT):
+        exc_type, exc_value, tb = exc_info
+        stack = []
+        while tb is not None and len(stack) < limit:
+            code = tb.tb_frame.f_code
+            stack.append((code.co_filename, tb.tb_lineno, code.co_name))
+            tb = tb.tb_next
+        return cls(traceback.format_exception_only(exc_type, exc_value), stack)
+
+    def format(self):
+        """Format the summary like traceback.format_exception"""
+        entries = []
+        for filename, lineno, name in self.stack:
+            linecache.checkcache(filename)
+            entries.append((filename, lineno, name, linecache.getline(filename, lineno).strip() or None))
+        return ''.join(['Traceback (most recent call last):\n'] + traceback.format_list(entries) + self.exception_lines)
+
+    def __getstate__(self):
+        return (self.exception_lines, self.stack)
+
+    def __setstate__(self, state):
+        self.exception_lines, self.stack = state
+
+def _summarize_exception(error):
+    if error is None or isinstance(error, ExceptionSummary):
+        return error
+    return ExceptionSummary.from_exc_info(error)
+
 class TestResult(object):
     """A test result
 
@@ -202,16 +667,28 @@ class TestResult(object):
     description -- str, test case description
     skipped -- bool, whether or not this test case was skipped
     skipped_reason -- str, reason the test case was skipped
-    error -- exc_info tuple, an unhandled Exception that occured while the test was running
-    error_msg -- str, crash message if an exc_info tuple isn't available (e.g. not pickleable)
-    failure -- exc_info tuple, a Failure which occurred while the test was running
+    error -- exc_info tuple or ExceptionSummary, an unhandled Exception that occured while the test was running
+    error_msg -- str, crash message if an exception isn't available
+    failure -- exc_info tuple or ExceptionSummary, a Failure which occurred while the test was running
     failure_msg -- str, a failure message
-    started_at -- datetime or None
-    ended_at -- datetime or None
+    started_at -- datetime or float seconds since the epoch, or None
+    ended_at -- datetime or float seconds since the epoch, or None
+    extra -- dictionary of picklable data added by plugins.  This travels with the result from worker processes.
+    cached -- bool, whether this result was loaded from a ResultCache instead of running the test
+    worker -- str, name of the worker which ran the test
 
+    exc_info tuples are reduced to an ExceptionSummary when they're set so a
+    result doesn't keep the test's frames alive.  The times are kept as
+    seconds since the epoch: started_at and ended_at are datetimes and
+    duration a timedelta, while started_at_seconds, ended_at_seconds and
+    duration_seconds are the same as floats.
     """
+    __slots__ = ('group', 'name', 'description', 'skipped', 'skipped_reason', '_error', 'error_msg', '_failure',
+            'failure_msg', 'started_at_seconds', 'ended_at_seconds', '_extra', 'cached', 'worker')
+
     def __init__(self, group='', name='', description='', skipped=False, skipped_reason='', error=None,
-            error_msg='', failure=None, failure_msg='', started_at=None, ended_at=None):
+            error_msg='', failure=None, failure_msg='', started_at=None, ended_at=None, extra=None, cached=False,
+            worker=''):
         self.group = group
         self.name = name
         self.description = description
@@ -223,48 +700,72 @@ class TestResult(object):
         self.failure_msg = failure_msg
         self.started_at = started_at
         self.ended_at = ended_at
+        self._extra = extra
+        self.cached = cached
+        self.worker = worker
 
-    def __getstate__(self):
+    @property
+    def error(self):
+        return self._error
 
-        if not self.error_msg:
-            if self.error is not None:
-                error_msg = ''.join(traceback.format_exception(*self.error, limit=30))
-            else:
-                error_msg = ''
-        else:
-            error_msg = self.error_msg
+    @error.setter
+    def error(self, error):
+        self._error = _summarize_exception(error)
 
-        if not self.failure_msg:
-            if self.failure is not None:
-                failure_msg = ''.join(traceback.format_exception(*self.failure, limit=30))
-            else:
-                failure_msg = ''
-        else:
-            failure_msg = self.failure_msg
-
-        return {'group': self.group, 
-                'name': self.name,
-                'description': self.description,
-                'skipped': self.skipped,
-                'skipped_reason': self.skipped_reason,
-                'error': None,
-                'error_msg': error_msg,
-                'failure': None,
-                'failure_msg': failure_msg,
-                'started_at': self.started_at,
-                'ended_at': self.ended_at}
+    @property
+    def failure(self):
+        return self._failure
+
+    @failure.setter
+    def failure(self, failure):
+        self._failure = _summarize_exception(failure)
+
+    @property
+    def started_at(self):
+        return _to_datetime(self.started_at_seconds)
+
+    @started_at.setter
+    def started_at(self, started_at):
+        self.started_at_seconds = _to_timestamp(started_at)
+
+    @property
+    def ended_at(self):
+        return _to_datetime(self.ended_at_seconds)
+
+    @ended_at.setter
+    def ended_at(self, ended_at):
+        self.ended_at_seconds = _to_timestamp(ended_at)
+
+    @property
+    def extra(self):
+        # Most results have no extra data so the dictionary is made on demand
+        if self._extra is None:
+            self._extra = {}
+        return self._extra
+
+    @extra.setter
+    def extra(self, extra):
+        self._extra = extra
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        if isinstance(state, dict):
+            # A result pickled by an older version, with datetimes and formatted tracebacks
+            self.__init__(**state)
+        else:
+            for slot, value in zip(self.__slots__, state):
+                setattr(self, slot, value)
 
     @property
     def formatted_message(self):
         if self.error:
-            return ''.join(traceback.format_exception(*self.error))
+            return self.error.format()
         elif self.error_msg:
             return self.error_msg
         elif self.failure:
-            return ''.join(traceback.format_exception(*self.failure))
+            return self.failure.format()
         else:
             return self.failure_msg
 
@@ -284,11 +785,18 @@ class TestResult(object):
     def is_failure(self):
         return bool(self.failure or self.failure_msg)
 
-    @property 
+    @property
     def duration(self):
         """Get the duration time delta of the test"""
-        if self.started_at is not None and self.ended_at is not None:
-            return self.ended_at - self.started_at
+        duration = self.duration_seconds
+        if duration is not None:
+            return datetime.timedelta(seconds=duration)
+
+    @property
+    def duration_seconds(self):
+        """Get the duration of the test in seconds"""
+        if self.started_at_seconds is not None and self.ended_at_seconds is not None:
+            return self.ended_at_seconds - self.started_at_seconds
 
     @property
     def status(self):
@@ -338,9 +846,53 @@ option_parser = optparse.OptionParser()
 option_parser.add_option('-v', '--verbose', action='store_true')
 option_parser.add_option('-d', '--debug', action='store_true')
 option_parser.add_option('-f', '--filter', dest='filter', action='append', help='Run only tests that match this regular epxression pattern.  Test names are of the form "dotted-module-path:function-name"', default=[])
-option_parser.add_option('-c', '--concurrency-mode', default='single', choices=[RUN_SINGLETHREAD, RUN_MULTIPROCESS, RUN_MULTITHREAD])
-option_parser.add_option('-w', '--num-workers', default=10, type='int', help='The number of workers (if mode is "process" or "thread")')
+option_parser.add_option('-c', '--concurrency-mode', default='single', choices=RUN_MODES)
+option_parser.add_option('-w', '--num-workers', default=None, help='The number of workers (if mode is "process", "thread" or "async"), or PROCESSESxTHREADS (if mode is "hybrid")')
 option_parser.add_option('-m', '--module', dest='modules', default=[], action='append')
+option_parser.add_option('--list', action='store_true', help='Print the names of the tests (matching --filter) instead of running them.  The --module modules are not imported unless --index-file is empty.')
+option_parser.add_option('--index-file', default=DEFAULT_INDEX_FILE, help='File which caches the tests each --module module defines.  With --filter, only the modules which define matching tests are imported.  Set this to an empty string to disable it.')
+option_parser.add_option('--durations', action='store_true', help='Record how long each test took in --durations-file and start the tests which took longest first in the parallel modes')
+option_parser.add_option('--durations-file', default=DEFAULT_DURATIONS_FILE, help='File which records how long each test took (see --durations and --shard-strategy)')
+option_parser.add_option('--impact', action='store_true', help='Run only tests whose source files changed since they last passed, and record which files each test runs')
+option_parser.add_option('--changed', action='append', default=[], help='With --impact, run only the tests which run this file instead of checking every recorded file for changes')
+option_parser.add_option('--impact-file', default=DEFAULT_IMPACT_FILE, help='File which records the source files each test runs')
+option_parser.add_option('--cache', action='store_true', help='Skip tests which passed before if their code, requirements and the modules they import are unchanged.  Rows of parametrized tests are cached when their repr reads back as the same row.  Benchmarks always run.')
+option_parser.add_option('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of cached test results')
+option_parser.add_option('--cache-size', default=DEFAULT_CACHE_SIZE, type='int', help='The most test results to keep in the cache')
+option_parser.add_option('-r', '--report', dest='reports', default=[], action='append', metavar='FORMAT:PATH', help='Write each test result to PATH as it finishes.  FORMAT is "jsonl" or "junit".  PATH "-" is stdout.')
+option_parser.add_option('--listen', default=DEFAULT_LISTEN_ADDRESS, metavar='HOST:PORT', help='The address to serve tests to worker agents on (if mode is "distributed").  This defaults to the loopback interface, pass --listen 0.0.0.0:PORT to accept workers on other hosts.')
+option_parser.add_option('--connect', default=None, metavar='HOST:PORT', help='Run as a worker agent which runs tests served by the coordinator at this address')
+option_parser.add_option('--shard', default=None, metavar='INDEX/TOTAL', help='Run only the INDEX-th (counting from 1) of TOTAL disjoint slices of the tests')
+option_parser.add_option('--shard-strategy', default=SHARD_STABLE, choices=SHARD_STRATEGIES, help='"stable" assigns tests to shards by a hash of their name.  "balanced" uses recorded durations (see --durations-file) so shards take about as long as each other.  Every shard must see the same durations file.')
+option_parser.add_option('--plan', action='store_true', help='Print the tests and predicted duration of each of the --shard TOTAL shards instead of running tests')
+option_parser.add_option('--benchmarks', default='run', choices=['run', 'skip', 'only'], help='Whether to "run" benchmarks (after the other tests in the parallel modes), "skip" them or run "only" them')
+option_parser.add_option('--benchmarks-file', default=DEFAULT_BENCHMARKS_FILE, help='File of benchmark baselines.  A benchmark which has no baseline yet is added to it.')
+option_parser.add_option('--benchmark-threshold', default=DEFAULT_BENCHMARK_THRESHOLD, type='float', help='Fail benchmarks whose median time exceeds the baseline by more than this fraction')
+option_parser.add_option('--update-benchmarks', action='store_true', help='Replace the baseline of every passing benchmark')
+option_parser.add_option('--profile', default=None, metavar='DIR', help='Profile each test, saving DIR/GROUP:NAME.PID.N.prof and the merged profile of the run in DIR/all.prof, and print the functions with the most cumulative time')
+option_parser.add_option('--profile-fixtures', action='store_true', help='With --profile, also profile setting up and tearing down requirements')
+option_parser.add_option('--trace', default=None, metavar='FILE', help='Save a timeline of the run to FILE as Chrome trace events, with a track for each worker and spans for each test and its requirements\' setup and teardown and plugin hooks.  Open it in chrome://tracing or Perfetto.')
+option_parser.add_option('--profile-top', default=DEFAULT_PROFILE_TOP, type='int', help='The number of functions to print with --profile')
+option_parser.add_option('--memory', action='store_true', help='Record the memory each test retains after its requirements are torn down.  Object counts are for the whole process, so use "single" or "process" mode for accurate numbers.')
+option_parser.add_option('--memory-threshold', default=None, type='int', metavar='BYTES', help='With --memory, fail tests which retain more than this many bytes of resident memory')
+option_parser.add_option('--leak-check', default=0, type='int', metavar='N', help='With --memory, run each passing test N (at least 3) more times and fail it if the number of live objects grows every time')
+option_parser.add_option('--failed-first', action='store_true', help='Record the tests which fail or crash in --failed-file and run the tests which failed or crashed last time before the others')
+option_parser.add_option('--failed-file', default=DEFAULT_FAILED_FILE, help='File which records the tests which failed or crashed the last time they ran (see --failed-first)')
+option_parser.add_option('-x', '--fail-fast', action='store_const', const=1, dest='max_failures', help='Stop after the first test fails or crashes.  Tests which are still running are cancelled.')
+option_parser.add_option('--max-failures', default=None, type='int', metavar='N', help='Stop after N tests fail or crash')
+option_parser.add_option('-t', '--timeout', default=None, type='float', help='Seconds each test may run before it is reported as crashed (unless the test sets its own timeout)')
+option_parser.add_option('--max-tests-per-worker', type='int', default=None, help='Replace each process worker after it has run this many tests (if mode is "process")')
+option_parser.add_option('--resource', default=[], action='append', dest='resources', metavar='NAME=N', help='Let the tests running at once use at most N units of a resource which tests declare with @qa.testcase(resources={NAME: units})')
+option_parser.add_option('--repeat', default=None, type='int', metavar='N', help='Run each test N times and print the percentiles of its durations, its failure rate and its runs per second')
+option_parser.add_option('--concurrency', default=None, type='int', dest='copies', metavar='C', help='With --repeat, run up to C copies of each test at once.  The number of workers defaults to C.')
+option_parser.add_option('--stress-json', default=None, metavar='FILE', help='With --repeat, also save the summary of the runs to FILE as JSON')
+option_parser.add_option('--metrics-file', default=None, metavar='FILE', help='Rewrite FILE with the live metrics of the run (throughput, tests in flight and queued, worker busy and idle time and the longest running tests) in the Prometheus text format every --metrics-interval seconds')
+option_parser.add_option('--metrics-address', default=None, metavar='HOST:PORT', help='Serve the live metrics of the run over HTTP on HOST:PORT, at /metrics in the Prometheus text format and at /stats as JSON')
+option_parser.add_option('--metrics-interval', default=DEFAULT_METRICS_INTERVAL, type='float', help='Seconds between rewrites of --metrics-file')
+option_parser.add_option('--watch', action='store_true', help='Keep running: when a source file of an imported module under the current directory changes, reload it and the modules which use it and rerun their tests')
+option_parser.add_option('--watch-interval', default=DEFAULT_WATCH_INTERVAL, type='float', help='Seconds between checks for changes with --watch when pyinotify is not installed')
+option_parser.add_option('--preload', action='store_true', help='In process or hybrid mode, set up the session requirements of the tests once before the workers are forked so every worker shares them')
+option_parser.add_option('--preload-module', default=[], action='append', dest='preload_modules', metavar='MODULE', help='Import a module before the workers are forked, for heavy modules the tests import lazily')
 
 def _make_name_filter(patterns):
     if patterns:
@@ -354,6 +906,203 @@ def _make_name_filter(patterns):
         filter_function = lambda test_case: True
     return filter_function
 
+_TEST_DECORATORS = frozenset(['testcase', 'benchmark'])
+# Calls which can make test cases whose names can't be found without running the module
+_DYNAMIC_TEST_FACTORIES = frozenset(['testcase', 'benchmark', 'register_test_case', 'TestCase'])
+
+_DYNAMIC = object()
+
+def _called_name(call):
+    if isinstance(call.func, ast.Attribute):
+        return call.func.attr
+    elif isinstance(call.func, ast.Name):
+        return call.func.id
+
+def _literal_argument(arguments, key, default):
+    """Get a literal argument of a decorator call
+
+    Returns
+    the value, default if the argument is missing or None, or _DYNAMIC if it isn't a literal
+    """
+    node = arguments.get(key)
+    if node is None:
+        return default
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return _DYNAMIC
+    return default if value is None else value
+
+def _scan_test_module(source, module_name):
+    """Find the names of the test cases a module defines by reading its source
+
+    Test cases made by @testcase or @benchmark on a top level function with
+    literal arguments are found.  A module which could make other test cases
+    when it is imported (in a loop, with non literal names, with TestCase or
+    register_test_case) or which has parametrized test cases is dynamic, and
+    the test cases after those are still found.
+
+    Returns
+    (list of "group:name", dynamic bool)
+    """
+    tree = ast.parse(source)
+    names = []
+    found = set()
+    dynamic = False
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            if not isinstance(decorator, ast.Call) or _called_name(decorator) not in _TEST_DECORATORS:
+                continue
+            found.add(decorator)
+            arguments = dict(zip(['group', 'name', 'requires', 'is_global'], decorator.args))
+            arguments.update((keyword.arg, keyword.value) for keyword in decorator.keywords)
+            group = _literal_argument(arguments, 'group', module_name)
+            name = _literal_argument(arguments, 'name', node.name)
+            if _literal_argument(arguments, 'is_global', True) is False:
+                continue
+            # The names of the rows of a parametrized test case depend on its parameters
+            if (group is _DYNAMIC or name is _DYNAMIC or 'params' in arguments or
+                    any(isinstance(d, ast.Call) and _called_name(d) == 'parametrize' for d in node.decorator_list)):
+                dynamic = True
+                continue
+            names.append('%s:%s' % (group, name))
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and node not in found and _called_name(node) in _DYNAMIC_TEST_FACTORIES):
+            arguments = dict((keyword.arg, keyword.value) for keyword in node.keywords)
+            if _literal_argument(arguments, 'is_global', True) is not False:
+                dynamic = True
+                break
+    return names, dynamic
+
+def _find_module_source(module_name):
+    """Find the source file of a module without importing it
+
+    Returns
+    path, or None if the module isn't a Python source file or can't be found
+    """
+    search_path = None
+    source = None
+    for part in module_name.split('.'):
+        if source is not None and search_path is None:
+            # A module can't contain other modules
+            return None
+        try:
+            f, pathname, (suffix, mode, kind) = imp.find_module(part, search_path)
+        except ImportError:
+            return None
+        if f is not None:
+            f.close()
+        if kind == imp.PKG_DIRECTORY:
+            search_path = [pathname]
+            source = os.path.join(pathname, '__init__.py')
+        elif kind == imp.PY_SOURCE:
+            search_path = None
+            source = pathname
+        else:
+            return None
+    return os.path.abspath(source) if source is not None else None
+
+class TestIndex(object):
+    """A cache of the test cases each test module defines, found without importing the modules
+
+    Each module's entry is refreshed when its source file's modification
+    time or size changes.
+
+    Arguments
+    path -- path of the index file
+    """
+    def __init__(self, path=DEFAULT_INDEX_FILE):
+        self.path = path
+        self.changed = False
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            _log.debug('no usable test index in %r', path)
+            self.entries = {}
+
+    def lookup(self, module_name):
+        """Get the test cases a module defines
+
+        Returns
+        (list of "group:name", dynamic bool).  Modules without a readable source are dynamic.
+        """
+        source_path = _find_module_source(module_name)
+        if source_path is None:
+            return [], True
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return [], True
+        entry = self.entries.get(module_name)
+        if entry is None or entry['path'] != source_path or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            try:
+                with open(source_path) as f:
+                    names, dynamic = _scan_test_module(f.read(), module_name)
+            except (IOError, SyntaxError):
+                names, dynamic = [], True
+            entry = {'path': source_path, 'mtime': stat.st_mtime, 'size': stat.st_size, 'tests': names, 'dynamic': dynamic}
+            self.entries[module_name] = entry
+            self.changed = True
+        return entry['tests'], entry['dynamic']
+
+    def list_test_names(self, module_names, patterns=()):
+        """List the names of the test cases the modules define which match any of the patterns
+
+        The test cases dynamic modules make when they are imported aren't listed.
+        """
+        patterns = [re.compile(pattern) for pattern in patterns]
+        names = []
+        for module_name in module_names:
+            tests, dynamic = self.lookup(module_name)
+            if dynamic:
+                _log.warning('%s makes tests when it is imported, they may not all be listed', module_name)
+            names.extend(name for name in tests if not patterns or any(p.search(name) for p in patterns))
+        return names
+
+    def print_test_names(self, module_names, patterns=(), test_cases=(), file=None):
+        """Print the sorted names of the test cases the modules define which match any of the patterns
+
+        Arguments
+        test_cases -- test cases which are already registered, whose names are printed too
+        file -- the file to print to.  This defaults to stdout.
+        """
+        if file is None:
+            file = sys.stdout
+        names = set(self.list_test_names(module_names, patterns)) | set(t.group_and_name() for t in test_cases)
+        for name in sorted(names):
+            file.write('%s\n' % name)
+
+    def select_modules(self, module_names, patterns):
+        """Select the modules which may define test cases matching any of the patterns"""
+        patterns = [re.compile(pattern) for pattern in patterns]
+        selected = []
+        for module_name in module_names:
+            tests, dynamic = self.lookup(module_name)
+            if dynamic or any(p.search(name) for name in tests for p in patterns):
+                selected.append(module_name)
+            else:
+                _log.debug('not importing %s, it has no matching tests', module_name)
+        return selected
+
+    def save(self):
+        if self.changed:
+            _save_json(self.path, self.entries)
+            self.changed = False
+
+def print_test_names(test_cases, file=None):
+    """Print the sorted names of test cases
+
+    Arguments
+    file -- the file to print to.  This defaults to stdout.
+    """
+    if file is None:
+        file = sys.stdout
+    for name in sorted(set(t.group_and_name() for t in test_cases)):
+        file.write('%s\n' % name)
+
 def main(init_logging=True, test_cases=None, plugins=None):
     """main method"""
     options, args = option_parser.parse_args()
@@ -368,30 +1117,283 @@ def main(init_logging=True, test_cases=None, plugins=None):
     if test_cases is None:
         test_cases = _qa_globals.all_test_cases
 
-    for module in options.modules:
-       __import__(module) 
+    if options.list and options.connect:
+        option_parser.error("--list can't be used with --connect")
+    modules = options.modules
+    if options.index_file and modules and (options.list or options.filter) and not options.connect:
+        index = TestIndex(options.index_file)
+        try:
+            if options.list:
+                registered = expand_test_cases(_filter_test_cases(test_cases, _make_name_filter(options.filter)))
+                index.print_test_names(modules, options.filter, registered)
+                return
+            modules = index.select_modules(modules, options.filter)
+        finally:
+            index.save()
 
-    name_filter = _make_name_filter(options.filter)
-    test_cases = (t for t in test_cases if name_filter(t))
+    for module in modules:
+       __import__(module) 
+    if options.list:
+        # Without the index the modules are imported and their registered tests are listed
+        print_test_names(expand_test_cases(_filter_test_cases(test_cases, _make_name_filter(options.filter))))
+        return
+    for module in options.preload_modules:
+        __import__(module)
 
     if plugins is None:
         plugins = _qa_globals.plugins
+
+    if options.connect:
+        # Distributed workers started with --trace record spans for the coordinator's trace
+        run_worker(_parse_address(options.connect), test_cases, plugins, timeout=options.timeout,
+                trace=bool(options.trace))
+        return
+
+    if not options.watch:
+        _run_main(options, test_cases, plugins)
+        return
+    watcher = _make_watcher(os.getcwd(), interval=options.watch_interval)
+    selected = test_cases
+    while True:
+        _run_main(options, selected, plugins)
+        _test_run_log.info('watching for changes')
+        try:
+            changed_paths = watcher.wait()
+        except KeyboardInterrupt:
+            return
+        reloaded = reload_changed_modules(changed_paths, os.getcwd())
+        selected = [t for t in test_cases if _test_case_modules(t) & reloaded]
+        _test_run_log.info('rerunning %d tests affected by %s', len(selected), ', '.join(sorted(reloaded)))
+
+def _run_main(options, test_cases, plugins):
+    """Select, run and print the test cases of a main() run"""
+    name_filter = _make_name_filter(options.filter)
+    test_cases = _filter_test_cases(test_cases, name_filter)
+    if options.benchmarks == 'skip':
+        test_cases = (t for t in test_cases if t.benchmark is None)
+    elif options.benchmarks == 'only':
+        test_cases = (t for t in test_cases if t.benchmark is not None)
+    benchmarks = load_benchmarks(options.benchmarks_file) if options.benchmarks != 'skip' else None
+    if benchmarks is not None:
+        plugins = list(plugins) + [BenchmarkPlugin(benchmarks, threshold=options.benchmark_threshold)]
+
+    if options.changed and not options.impact:
+        option_parser.error('--changed requires --impact')
+    if options.concurrency_mode == RUN_ASYNC and gevent is None:
+        option_parser.error('-c async requires gevent')
+    if options.impact and options.concurrency_mode == RUN_ASYNC:
+        # sys.settrace is per thread, so tests interleaved on the event loop would share one trace
+        option_parser.error("--impact can't be used with -c async")
+    if options.impact:
+        impact_map = load_impact_map(options.impact_file)
+        test_cases = select_impacted_test_cases(test_cases, impact_map, changed_paths=options.changed or None)
+        plugins = list(plugins) + [ImpactPlugin()]
+
+    # Balanced shards read the recorded durations without --durations
+    durations = None
+    if options.durations or (options.shard and options.shard_strategy == SHARD_BALANCED):
+        durations = load_durations(options.durations_file)
+    if options.failed_first and not options.failed_file:
+        option_parser.error('--failed-first requires --failed-file')
+    failed = load_failed(options.failed_file) if options.failed_first else None
+
+    if options.shard:
+        try:
+            index, total = _parse_shard(options.shard)
+        except ValueError:
+            option_parser.error('--shard must be INDEX/TOTAL with 1 <= INDEX <= TOTAL')
+        partitions = partition_test_cases(test_cases, total, strategy=options.shard_strategy, durations=durations)
+        if not options.durations:
+            durations = None
+        if options.plan:
+            print_shard_plan(partitions, durations)
+            return
+        test_cases = partitions[index - 1]
+    elif options.plan:
+        option_parser.error('--plan requires --shard')
+
+    if options.leak_check and options.leak_check < MIN_LEAK_CHECK:
+        option_parser.error('--leak-check must be at least %d' % MIN_LEAK_CHECK)
+    if options.memory:
+        plugins = list(plugins) + [MemoryPlugin(threshold=options.memory_threshold, leak_check=options.leak_check)]
+    if options.profile:
+        plugins = list(plugins) + [ProfilePlugin(options.profile, fixtures=options.profile_fixtures)]
+
+    if options.cache and options.repeat is not None:
+        option_parser.error("--cache can't be used with --repeat")
+    cache = ResultCache(options.cache_dir, max_entries=options.cache_size) if options.cache else None
     
-    test_results = run_test_cases(test_cases, mode=options.concurrency_mode, num_workers=options.num_workers, plugins=plugins)
-    print_test_results(test_results, plugins=plugins)
+    try:
+        num_workers = _parse_num_workers(options.num_workers) if options.num_workers else options.copies
+    except ValueError:
+        option_parser.error('-w must be a number or PROCESSESxTHREADS')
+    if options.copies is not None and (options.repeat is None or options.concurrency_mode == RUN_SINGLETHREAD):
+        option_parser.error('--concurrency requires --repeat and a parallel mode')
+    if isinstance(num_workers, tuple) and options.concurrency_mode != RUN_HYBRID:
+        option_parser.error('-w PROCESSESxTHREADS requires -c hybrid')
+    if options.max_tests_per_worker is not None and options.max_tests_per_worker < 1:
+        option_parser.error('--max-tests-per-worker must be at least 1')
+    if options.preload and options.concurrency_mode not in (RUN_MULTIPROCESS, RUN_HYBRID):
+        option_parser.error('--preload requires -c process or -c hybrid')
+    try:
+        resources = dict(_parse_resource(resource) for resource in options.resources)
+    except ValueError:
+        option_parser.error('--resource must be NAME=N')
+    try:
+        reporters = [make_reporter(report) for report in options.reports]
+    except ValueError:
+        option_parser.error('-r must be FORMAT:PATH with FORMAT one of %s' % ', '.join(sorted(REPORTERS)))
+    metrics = exporter = None
+    if options.metrics_file or options.metrics_address:
+        metrics = RunMetrics()
+        exporter = MetricsExporter(metrics, path=options.metrics_file, interval=options.metrics_interval,
+                address=_parse_address(options.metrics_address) if options.metrics_address else None)
+    test_results = run_test_cases(test_cases, mode=options.concurrency_mode, num_workers=num_workers, plugins=plugins,
+            max_tests_per_worker=options.max_tests_per_worker, durations=durations, cache=cache,
+            address=_parse_address(options.listen), timeout=options.timeout,
+            failed=failed, max_failures=options.max_failures,
+            preload=options.preload, resources=resources, repeat=options.repeat, concurrency=options.copies,
+            metrics=metrics, trace=bool(options.trace))
+    if options.durations:
+        test_results = _record_durations(test_results, durations, options.durations_file)
+    if failed is not None:
+        test_results = _record_failed(test_results, failed, options.failed_file)
+    if options.repeat is not None:
+        test_results = stress_report(test_results, json_path=options.stress_json)
+    if options.trace:
+        test_results = write_trace(test_results, options.trace)
+    if options.profile:
+        test_results = merge_profiles(test_results, options.profile, top=options.profile_top)
+    if benchmarks is not None:
+        test_results = _record_benchmarks(test_results, benchmarks, options.benchmarks_file, update=options.update_benchmarks)
+    if options.impact:
+        test_results = _record_impact(test_results, impact_map, options.impact_file)
+    if exporter is None:
+        print_test_results(test_results, plugins=plugins, reporters=reporters)
+        return
+    exporter.start()
+    try:
+        print_test_results(test_results, plugins=plugins, reporters=reporters)
+    finally:
+        exporter.stop()
 
-def run_test_cases(test_cases, mode=RUN_SINGLETHREAD, num_workers=None, plugins=None):
+def run_test_cases(test_cases, mode=RUN_SINGLETHREAD, num_workers=None, plugins=None, max_tests_per_worker=None,
+        durations=None, cache=None, address=None, timeout=None, failed=None, max_failures=None, preload=False,
+        resources=None, repeat=None, concurrency=None, metrics=None, trace=False):
+    """Run test cases and return a stream of test results
+
+    In the parallel modes, benchmarks are run one at a time after the other tests.
+
+    Arguments
+    test_cases -- iterable of TestCase
+    mode -- one of RUN_MODES
+    num_workers -- int, the number of workers (if mode is RUN_MULTIPROCESS, RUN_MULTITHREAD or RUN_ASYNC).  If
+        mode is RUN_HYBRID, a (processes, threads per process) tuple or the number of processes.
+    plugins -- list of Plugin
+    max_tests_per_worker -- int, replace process workers after they run this many tests
+    durations -- dictionary of test name to seconds from a previous run (see load_durations). In the
+        parallel modes the longest tests are started first.
+    cache -- ResultCache.  Tests with a cached passing result are not run.
+    address -- (host, port) tuple to serve tests to worker agents on (if mode is RUN_DISTRIBUTED)
+    timeout -- float, seconds each test without its own timeout may run.  Tests which run longer are reported
+        as crashed.  Process workers which don't stop the test are killed and thread workers are abandoned,
+        and a replacement worker is started.
+    failed -- collection of "group:name" of tests to start before the others (see load_failed)
+    max_failures -- int, stop after this many tests fail or crash.  Tests which are still running are cancelled
+        and tests which haven't started yet aren't run.
+    preload -- bool, set up the session requirements of the tests before forking the process workers (if mode
+        is RUN_MULTIPROCESS or RUN_HYBRID).  The workers and the benchmarks run after them share the
+        requirements' values instead of each setting them up.
+    resources -- dictionary of resource name to the units of it the tests running at once may use (see the
+        resources argument of testcase).  Other tests are started while a test waits for its resources.
+    repeat -- int, run each test case (other than benchmarks in the parallel modes) this many times in a row
+    concurrency -- int, the most copies of each repeated test case to run at once (in the parallel modes)
+    metrics -- RunMetrics to keep up to date while the tests run
+    trace -- bool, record a timeline of each test in test_result.extra['trace'] (see write_trace).  In
+        distributed mode the worker agents record it instead (see run_worker).
+    """
+    if plugins is None:
+        plugins = []
+    if max_failures is not None:
+        test_results = run_test_cases(test_cases, mode=mode, num_workers=num_workers, plugins=plugins,
+                max_tests_per_worker=max_tests_per_worker, durations=durations, cache=cache, address=address,
+                timeout=timeout, failed=failed, preload=preload, resources=resources, repeat=repeat,
+                concurrency=concurrency, metrics=metrics, trace=trace)
+        return _stop_after_failures(test_results, max_failures)
+    if cache is not None:
+        run = functools.partial(run_test_cases, mode=mode, num_workers=num_workers, plugins=plugins,
+                max_tests_per_worker=max_tests_per_worker, durations=durations, address=address, timeout=timeout,
+                failed=failed, preload=preload, resources=resources, repeat=repeat, concurrency=concurrency,
+                metrics=metrics, trace=trace)
+        return _run_test_cases_cached(test_cases, cache, run, plugins)
+    benchmarks = None
+    if mode != RUN_SINGLETHREAD:
+        benchmarks = []
+        test_cases = _hold_back_benchmarks(test_cases, benchmarks)
+    # Ordering keeps the tests which share requirement instances together, otherwise they're grouped as
+    # they're fed to the workers
+    ordered = False
+    if durations and mode != RUN_SINGLETHREAD:
+        test_cases = _order_longest_first(test_cases, durations)
+        ordered = True
+    if failed:
+        test_cases = _order_failed_first(test_cases, failed)
+        ordered = True
+    if repeat is not None:
+        test_cases = _repeat_test_cases(test_cases, repeat)
+    fixture_users = None
+    if not ordered:
+        fixture_users = {}
+        test_cases = _group_by_fixtures(test_cases, fixture_users)
+    if concurrency is not None:
+        resources = dict(resources or {})
+        resources[_COPIES_RESOURCE] = concurrency
+    session_fixture_scope = None
+    if preload and mode in (RUN_MULTIPROCESS, RUN_HYBRID):
+        # Kept until the benchmarks have run too, so they don't set the requirements up again
+        session_fixture_scope = _FixtureScope()
     if mode == RUN_SINGLETHREAD:
         _test_run_log.debug('executing tests in single threaded mode')
-        return _run_test_cases_singlethread(test_cases, plugins=plugins)
+        test_results = _run_test_cases_singlethread(test_cases, plugins=plugins, timeout=timeout, metrics=metrics,
+                fixture_users=fixture_users, trace=trace)
     elif mode == RUN_MULTIPROCESS:
         _test_run_log.debug('executing tests in multiprocess mode')
-        return _run_test_cases_multiprocess(test_cases, num_workers=num_workers, plugins=plugins)
+        test_results = _run_test_cases_multiprocess(test_cases, num_workers=num_workers, plugins=plugins,
+                max_tests_per_worker=max_tests_per_worker, timeout=timeout,
+                session_fixture_scope=session_fixture_scope, resources=resources, metrics=metrics, trace=trace)
+    elif mode == RUN_HYBRID:
+        _test_run_log.debug('executing tests in hybrid mode')
+        if isinstance(num_workers, tuple):
+            num_workers, threads_per_worker = num_workers
+        else:
+            threads_per_worker = DEFAULT_THREADS_PER_PROCESS
+        test_results = _run_test_cases_multiprocess(test_cases, num_workers=num_workers, plugins=plugins,
+                max_tests_per_worker=max_tests_per_worker, timeout=timeout,
+                session_fixture_scope=session_fixture_scope, threads_per_worker=threads_per_worker,
+                resources=resources, metrics=metrics, trace=trace)
     elif mode == RUN_MULTITHREAD:
         _test_run_log.debug('executing tests in multithreaded mode')
-        return _run_test_cases_multithread(test_cases, num_workers=num_workers, plugins=plugins)
+        test_results = _run_test_cases_multithread(test_cases, num_workers=num_workers, plugins=plugins, timeout=timeout,
+                resources=resources, metrics=metrics, fixture_users=fixture_users, trace=trace)
+    elif mode == RUN_ASYNC:
+        _test_run_log.debug('executing tests in async mode')
+        test_results = _run_test_cases_async(test_cases, num_workers=num_workers, plugins=plugins, timeout=timeout,
+                resources=resources, metrics=metrics, fixture_users=fixture_users, trace=trace)
+    elif mode == RUN_DISTRIBUTED:
+        _test_run_log.debug('executing tests in distributed mode')
+        test_results = _run_test_cases_distributed(test_cases, address=address, plugins=plugins, resources=resources,
+                metrics=metrics)
     else:
         raise ValueError("unexpected mode", mode)
+    if benchmarks is not None:
+        # benchmarks is filled in by the time the other tests have all been run
+        benchmark_users = {}
+        test_results = _run_in_turn(test_results, _run_test_cases_singlethread(
+            _group_by_fixtures(benchmarks, benchmark_users), plugins=plugins, timeout=timeout, metrics=metrics,
+            fixture_users=benchmark_users, session_fixture_scope=session_fixture_scope, trace=trace))
+    if session_fixture_scope is not None:
+        test_results = _close_after(test_results, session_fixture_scope)
+    return test_results
 
 def register_plugin(plugin):
     _registration_log.debug('adding plugin %r', plugin)
@@ -400,13 +1402,6 @@ def register_plugin(plugin):
     else:
         _registration_log.error('plugin %r already registered', plugin)
 
-def _run_and_queue_result(a_queue, tag, function, *args, **kwargs):
-    try:
-        result = function(*args, **kwargs)
-        a_queue.put((tag, result))
-    except Exception:
-        _test_run_log.exception('An exception occurred')
-
 def _is_skip_test_case(test_case, plugins):
     skip = test_case.skip
     skip_reason = test_case.skip_reason
@@ -431,152 +1426,2626 @@ def _is_skip_test_case(test_case, plugins):
                 skipped=True,
                 skipped_reason=test_case.skip_reason)
 
-def _run_test_cases_multithread(test_cases, num_workers, plugins):
-    """Run test cases multithreaded"""
-    if num_workers is None:
-        num_workers = DEFAULT_NUM_WORKERS
-    running = 0
-    queue = Queue.Queue()
-    for tag, test_case in enumerate(test_cases):
-        skip_test_result = _is_skip_test_case(test_case, plugins)
-        if skip_test_result is not None:
-            yield skip_test_result
-            continue
-        if running >= num_workers:
-            tag, result = queue.get()
-            yield test_result
-            running -= 1
-        _test_run_log.debug("starting %r", test_case)
-        thread.start_new_thread(_run_and_queue_result, (queue, tag, _run_test_case, test_case, plugins))
-        running += 1 
-        while running > 0:
-            tag, result = queue.get()
-            yield result
-            running -= 1
-
-def _run_test_cases_multiprocess(test_cases, num_workers, plugins):
-    """Run test cases in a separate process for each.
-    """
-    if num_workers is None:
-        num_workers = DEFAULT_NUM_WORKERS
+def _test_case_timeout(test_case, default_timeout):
+    return test_case.timeout if test_case.timeout is not None else default_timeout
 
-    queue = multiprocessing.Queue()
-    running = {}
-    def run(num, test_case):
-        test_result = _run_test_case(test_case, plugins)
-        queue.put((num, test_result))
+def _timeout_result(test_case, timeout, started_at, worker, detail):
+    """Make the crashed result of a test which timed out"""
+    return TestResult(group=test_case.group, name=test_case.name, description=test_case.description,
+            started_at=started_at, ended_at=time.time(), worker=worker,
+            error_msg='Timeout: test did not finish within %gs; %s' % (timeout, detail))
 
-    for i, test_case in enumerate(test_cases):
-        skip_test_result = _is_skip_test_case(test_case, plugins)
-        if skip_test_result:
-            yield skip_test_result
-            continue
-        process = multiprocessing.Process(target=run, args=(i, test_case))
-        process.start()
-        running[i] = process
-        while len(running) >= num_workers:
-            worker_num, test_result = queue.get()
-            yield test_result
-            running[worker_num].join()
-            del running[worker_num]
-
-    while running:
-        worker_num, test_result = queue.get()
-        yield test_result
-        running[worker_num].join()
-        del running[worker_num]
-             
-class Context(dict):
-    def __getattr__(self, attr):
-        try:
-            return self.__getitem__(attr)
-        except KeyError:
-            raise AttributeError
+class _ThreadWorker(object):
+    """A thread pool worker's state, shared with the pool's watchdog"""
+    def __init__(self, name):
+        self.name = name
+        self.thread = None
+        # (tag, test_case, started_at, timeout) while running a test
+        self.running = None
+        self.abandoned = False
 
-    def __setattr__(self, attr, val):
-        self.__setitem__(attr, val)
+def _thread_worker_main(worker, task_queue, result_queue, plugins, fixture_scope, default_timeout, lock, trace):
+    """Main loop of a thread pool worker
 
-    def __delattr__(self, attr):
+    Group and session requirements are shared with the other workers through
+    fixture_scope.  Worker requirements are set up for this thread only.  A
+    worker which the watchdog abandoned drops its result, reports that the
+    test's resources are free and exits.
+    """
+    for plugin in plugins:
+        plugin.did_clone()
+    worker_fixture_scope = _FixtureScope()
+    fixture_scopes = {SCOPE_GROUP: fixture_scope, SCOPE_WORKER: worker_fixture_scope, SCOPE_SESSION: fixture_scope}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        tag, test_case = task
+        with lock:
+            worker.running = (tag, test_case, time.time(), _test_case_timeout(test_case, default_timeout))
         try:
-            return self.__delitem__(attr)
-        except KeyError:
-            raise AttributeError
+            test_result = _run_test_case(test_case, plugins, fixture_scopes, worker=worker.name, trace=trace)
+        except Exception:
+            _test_run_log.exception('An exception occurred')
+            test_result = TestResult(group=test_case.group, name=test_case.name,
+                    description=test_case.description, error=sys.exc_info(), worker=worker.name)
+        with lock:
+            worker.running = None
+            if worker.abandoned:
+                result_queue.put((tag, None))
+                break
+        result_queue.put((tag, test_result))
+    worker_fixture_scope.close()
 
-def _run_test_case(test_case, plugins):
-    """Helper method to run a test case.
+class _ThreadPool(object):
+    """A pool of reusable worker threads fed from a bounded task queue
 
-    This is shared between the multiprocess, multithread and single thread test runners.
+    Threads can't be interrupted, so when a test runs past its timeout the
+    pool reports it as crashed with the thread's current stack, abandons the
+    thread and starts a replacement.  The crash is returned with no tag, since
+    the test still holds its resources, and the abandoned thread returns
+    (tag, None) once the test has actually finished.  Tests waiting for those
+    resources are given up on after grace seconds (see _run_test_cases_pooled).
     """
-    ctx = Context()
-    error = None
-    failure = None
-    duration = None
-    t0 = time.time()
-    test_result = TestResult(group=test_case.group, name=test_case.name, description=test_case.description, started_at=datetime.datetime.now())
-    try:
-        requirements = []
-        for plugin in plugins:
-            for requirement in plugin.extra_test_case_requirements(test_case):
-                requirements.append(requirement(ctx))
-        requirements.extend(requirement(ctx) for requirement in test_case.requires)
-        with contextlib.nested(*requirements):
-            for plugin in plugins:
-                plugin.will_run_test_case(test_case, ctx)
-            test_case.callable(ctx)
-        status = 'passed'
-    except Failure:
-        status = 'failed'
-        test_result.failure = sys.exc_info()
-    except Exception:
-        status = 'crashed'
-        test_result.error = sys.exc_info()
-    test_result.ended_at = datetime.datetime.now()
-    _test_run_log.debug('test %s: %r', test_result.status, test_result.group_and_name)
-    if plugins is not None:
-        for plugin in plugins:
-            plugin.did_run_test_case(test_case, test_result, ctx)
-    return test_result
+    def __init__(self, num_workers, plugins, fixture_scope, timeout=None, trace=False):
+        self.num_workers = num_workers
+        self.plugins = plugins
+        self.fixture_scope = fixture_scope
+        self.timeout = timeout
+        self.trace = trace
+        self.capacity = num_workers * 2
+        self.task_queue = Queue.Queue(maxsize=self.capacity)
+        self.result_queue = Queue.Queue()
+        self.workers = []
+        self.next_worker_id = 0
+        self.lock = threading.Lock()
+        self.watchdog = timeout is not None
+        self.grace = DEFAULT_TIMEOUT_GRACE
 
-def _run_test_cases_singlethread(test_cases, plugins):
-    """Run a list of test cases in a single thread"""
-    for test_case in test_cases:
-        skip_test_result = _is_skip_test_case(test_case, plugins)
-        if skip_test_result is not None:
-            yield skip_test_result
-        else:
-            yield _run_test_case(test_case, plugins)
+    def start(self):
+        for i in range(self.num_workers):
+            self._start_worker()
 
-def print_test_results(test_results, plugins, file=None):
-    """Print a stream of test results
+    def _start_worker(self):
+        worker = _ThreadWorker('thread-%d' % self.next_worker_id)
+        self.next_worker_id += 1
+        worker.thread = threading.Thread(target=_thread_worker_main, name='qa-' + worker.name,
+                args=(worker, self.task_queue, self.result_queue, self.plugins, self.fixture_scope, self.timeout, self.lock,
+                    self.trace))
+        worker.thread.daemon = True
+        for plugin in self.plugins:
+            plugin.will_clone()
+        worker.thread.start()
+        self.workers.append(worker)
 
-    Each test error or failure will be printed to 'file'
+    def submit(self, tag, test_case):
+        if test_case.timeout is not None:
+            self.watchdog = True
+        self.task_queue.put((tag, test_case))
 
-    Arguments
-    test_results -- stream of test results
-    file -- None
+    def get_result(self, timeout=None):
+        """Get the next (tag, test result), or None if there is none within timeout seconds"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            if not self.watchdog and deadline is None:
+                return self.result_queue.get()
+            try:
+                return self.result_queue.get(timeout=_WATCHDOG_INTERVAL)
+            except Queue.Empty:
+                result = self._abandon_overdue_worker()
+                if result is not None:
+                    return result
+                if deadline is not None and time.time() >= deadline:
+                    return None
+
+    def running_tests(self):
+        """Get the (worker name, test case, started at) of each running test"""
+        with self.lock:
+            return [(worker.name, worker.running[1], worker.running[2]) for worker in self.workers
+                    if worker.running is not None]
+
+    def _abandon_overdue_worker(self):
+        now = time.time()
+        with self.lock:
+            for worker in self.workers:
+                if worker.running is None:
+                    continue
+                tag, test_case, started_at, timeout = worker.running
+                if timeout is None or now - started_at < timeout:
+                    continue
+                worker.abandoned = True
+                self.workers.remove(worker)
+                break
+            else:
+                return None
+        frame = sys._current_frames().get(worker.thread.ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        _test_run_log.warning('%s timed out running %s, starting a replacement', worker.name, test_case.group_and_name())
+        self._start_worker()
+        return None, _timeout_result(test_case, timeout, started_at, worker.name,
+                '%s was abandoned.  Its stack was:\n%s' % (worker.name, stack))
+
+    def stop(self, cancel=False):
+        # Drop work that was never started so the stop sentinels fit
+        while True:
+            try:
+                self.task_queue.get_nowait()
+            except Queue.Empty:
+                break
+        with self.lock:
+            if cancel:
+                # Running tests can't be interrupted, so leave their threads behind like the watchdog does
+                for worker in self.workers:
+                    if worker.running is not None:
+                        worker.abandoned = True
+            workers = [worker for worker in self.workers if not worker.abandoned]
+        for worker in workers:
+            self.task_queue.put(None)
+        for worker in workers:
+            worker.thread.join()
+        self.workers = []
+        self.fixture_scope.close()
+
+def _run_test_cases_multithread(test_cases, num_workers, plugins, timeout=None, resources=None, metrics=None,
+        fixture_users=None, trace=False):
+    """Run test cases on a pool of worker threads
+
+    fixture_users is the number of tests using each shared requirement instance.  It's counted from test_cases
+    if it isn't given.
     """
-    if file is None:
-        file = sys.stderr
-    failures = 0
-    errors = 0
-    skipped = 0
-    ok = 0
-    for result in test_results:
-        if result.is_error:
+    if num_workers is None:
+        num_workers = DEFAULT_NUM_WORKERS
+    if fixture_users is None:
+        fixture_users = _count_fixture_users(test_cases)
+    fixture_scope = _FixtureScope(remaining=fixture_users)
+    pool = _ThreadPool(num_workers, plugins, fixture_scope, timeout=timeout, trace=trace)
+    return _run_test_cases_pooled(test_cases, pool, plugins, fixture_scope=fixture_scope, resources=resources,
+            metrics=metrics)
+
+def _greenlet_worker_main(worker, task_queue, result_queue, plugins, fixture_scope, default_timeout, running, trace):
+    """Main loop of a greenlet pool worker
+
+    running is a dictionary of worker name to the (test case, started at) of its running test.
+    """
+    gevent.getcurrent().qa_worker_pid = os.getpid()
+    worker_fixture_scope = _FixtureScope(lock=gevent.lock.RLock())
+    fixture_scopes = {SCOPE_GROUP: fixture_scope, SCOPE_WORKER: worker_fixture_scope, SCOPE_SESSION: fixture_scope}
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            tag, test_case = task
+            running[worker] = (test_case, time.time())
+            try:
+                test_result = _run_test_case(test_case, plugins, fixture_scopes, worker=worker,
+                        timeout=_test_case_timeout(test_case, default_timeout), trace=trace)
+            except Exception:
+                _test_run_log.exception('An exception occurred')
+                test_result = TestResult(group=test_case.group, name=test_case.name,
+                        description=test_case.description, error=sys.exc_info(), worker=worker)
+            del running[worker]
+            result_queue.put((tag, test_result))
+    finally:
+        # The pool kills its greenlets when the run is cancelled
+        worker_fixture_scope.close()
+
+class _GreenletPool(object):
+    """A pool of greenlets which run test cases on a single gevent event loop"""
+    def __init__(self, num_workers, plugins, fixture_scope, timeout=None, trace=False):
+        self.num_workers = num_workers
+        self.plugins = plugins
+        self.fixture_scope = fixture_scope
+        self.timeout = timeout
+        self.trace = trace
+        self.capacity = num_workers * 2
+        self.task_queue = gevent.queue.Queue(maxsize=self.capacity)
+        self.result_queue = gevent.queue.Queue()
+        self.greenlets = []
+        self.running = {}
+
+    def start(self):
+        for i in range(self.num_workers):
+            self.greenlets.append(gevent.spawn(_greenlet_worker_main, 'greenlet-%d' % i,
+                self.task_queue, self.result_queue, self.plugins, self.fixture_scope, self.timeout, self.running,
+                self.trace))
+
+    def running_tests(self):
+        """Get the (worker name, test case, started at) of each running test"""
+        return [(worker, test_case, started_at) for worker, (test_case, started_at) in self.running.items()]
+
+    def submit(self, tag, test_case):
+        self.task_queue.put((tag, test_case))
+
+    def get_result(self):
+        return self.result_queue.get()
+
+    def stop(self, cancel=False):
+        while True:
+            try:
+                self.task_queue.get_nowait()
+            except gevent.queue.Empty:
+                break
+        if cancel:
+            gevent.killall(self.greenlets)
+        else:
+            for greenlet in self.greenlets:
+                self.task_queue.put(None)
+            gevent.joinall(self.greenlets)
+        self.greenlets = []
+        self.fixture_scope.close()
+
+def _run_test_cases_async(test_cases, num_workers, plugins, timeout=None, resources=None, metrics=None,
+        fixture_users=None, trace=False):
+    """Run test cases concurrently as greenlets on one gevent event loop
+
+    Tests only overlap while they wait on gevent cooperative I/O, so test code
+    should use gevent's sockets (or gevent.monkey.patch_all()).  fixture_users
+    is as for _run_test_cases_multithread.
+    """
+    if gevent is None:
+        raise ValueError("async mode requires gevent", RUN_ASYNC)
+    if num_workers is None:
+        num_workers = DEFAULT_NUM_WORKERS
+    if fixture_users is None:
+        fixture_users = _count_fixture_users(test_cases)
+    fixture_scope = _FixtureScope(remaining=fixture_users, lock=gevent.lock.RLock())
+    pool = _GreenletPool(num_workers, plugins, fixture_scope, timeout=timeout, trace=trace)
+    return _run_test_cases_pooled(test_cases, pool, plugins, fixture_scope=fixture_scope, resources=resources,
+            metrics=metrics)
+
+def _run_test_cases_pooled(test_cases, pool, plugins, fixture_scope=None, resources=None, metrics=None):
+    """Feed test cases to a worker pool and yield the results as they finish
+
+    At most pool.capacity test cases are handed to the pool at a time so the
+    test case stream, and the rows of parametrized test cases, are consumed
+    lazily.  If the results stop being consumed before they are all yielded,
+    the tests still running are cancelled.
+
+    A test which needs more of a resource in resources than is free is held
+    back while the tests after it are started, and is started as soon as
+    enough of the resource is released.
+
+    pool.get_result() returns (tag, test result).  The tag is that of the
+    test whose resources are now free, or None if the test was abandoned
+    while it still holds them.  An abandoned test's resources are freed by a
+    later (tag, None).  Pools which abandon tests take a timeout argument to
+    get_result and have a grace attribute: when only abandoned tests are left
+    and they don't free the resources the waiting tests need within grace
+    seconds, the waiting tests are skipped.
+    """
+    pool.start()
+    if metrics is not None:
+        metrics.running_tests = pool.running_tests
+    finished = False
+    limiter = _ResourceLimiter(resources) if resources else None
+    try:
+        in_flight = 0
+        # Abandoned tests which still hold their resources
+        abandoned = 0
+        # Tests held back until their resources are free, in the order they were read
+        waiting = []
+        check_waiting = False
+        stream = enumerate(expand_test_cases(test_cases))
+        exhausted = False
+        while True:
+            while in_flight < pool.capacity:
+                task = None
+                if check_waiting:
+                    for i, (tag, test_case) in enumerate(waiting):
+                        if limiter.acquire(tag, test_case):
+                            task = waiting.pop(i)
+                            break
+                    else:
+                        check_waiting = False
+                if task is None:
+                    if exhausted or len(waiting) >= _MAX_WAITING_TESTS:
+                        break
+                    try:
+                        tag, test_case = next(stream)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    skip_test_result = _is_skip_test_case(test_case, plugins)
+                    if skip_test_result is not None:
+                        if fixture_scope is not None:
+                            _release_fixtures(test_case, fixture_scope)
+                        if metrics is not None:
+                            metrics.test_finished(skip_test_result)
+                        yield skip_test_result
+                        continue
+                    if limiter is not None and not limiter.acquire(tag, test_case):
+                        _test_run_log.debug('waiting for the resources of %r', test_case)
+                        waiting.append((tag, test_case))
+                        if metrics is not None:
+                            metrics.waiting = len(waiting)
+                        continue
+                    task = (tag, test_case)
+                _test_run_log.debug("queueing %r", task[1])
+                pool.submit(*task)
+                in_flight += 1
+                if metrics is not None:
+                    metrics.in_flight = in_flight
+                    metrics.waiting = len(waiting)
+            if in_flight == 0:
+                if not (waiting and abandoned):
+                    break
+                # An abandoned test may never finish, so don't wait for its resources forever
+                result = pool.get_result(timeout=pool.grace)
+                if result is None:
+                    _test_run_log.warning('skipping %d tests waiting for resources held by abandoned tests',
+                            len(waiting))
+                    for tag, test_case in waiting:
+                        if fixture_scope is not None:
+                            _release_fixtures(test_case, fixture_scope)
+                        test_result = TestResult(group=test_case.group, name=test_case.name,
+                                description=test_case.description, skipped=True,
+                                skipped_reason='resources held by an abandoned test')
+                        if metrics is not None:
+                            metrics.test_finished(test_result)
+                        yield test_result
+                    del waiting[:]
+                    check_waiting = False
+                    if metrics is not None:
+                        metrics.waiting = 0
+                    continue
+                tag, test_result = result
+            else:
+                tag, test_result = pool.get_result()
+            if tag is None:
+                abandoned += 1
+            elif limiter is not None:
+                limiter.release(tag)
+                check_waiting = bool(waiting)
+            if test_result is None:
+                abandoned -= 1
+                continue
+            in_flight -= 1
+            if metrics is not None:
+                metrics.in_flight = in_flight
+                metrics.test_finished(test_result)
+            yield test_result
+        finished = True
+    finally:
+        pool.stop(cancel=not finished)
+
+class _ResourceLimiter(object):
+    """Counts the units of each limited resource held by the tests which have been started
+
+    Arguments
+    capacities -- dictionary of resource name to the number of units tests may hold at once.  Resources
+        which aren't in it are unlimited.  A test which needs more units than a resource has waits until it
+        can hold all of them.  _COPIES_RESOURCE limits the copies of each test in flight.
+    """
+    def __init__(self, capacities):
+        self.capacities = dict(capacities)
+        self.copies = self.capacities.pop(_COPIES_RESOURCE, None)
+        self.used = dict.fromkeys(self.capacities, 0)
+        self.running_copies = collections.Counter()
+        self.held = {}
+
+    def acquire(self, tag, test_case):
+        """Take the resources a test needs if they are free
+
+        Returns
+        bool, whether the test may be started
+        """
+        needs = dict((name, min(units, self.capacities[name])) for name, units in test_case.resources.items()
+                if name in self.capacities)
+        if any(self.used[name] + units > self.capacities[name] for name, units in needs.items()):
+            return False
+        test_name = test_case.group_and_name()
+        if self.copies is not None and self.running_copies[test_name] >= self.copies:
+            return False
+        for name, units in needs.items():
+            self.used[name] += units
+        self.running_copies[test_name] += 1
+        self.held[tag] = (needs, test_name)
+        return True
+
+    def release(self, tag):
+        needs, test_name = self.held.pop(tag)
+        for name, units in needs.items():
+            self.used[name] -= units
+        self.running_copies[test_name] -= 1
+        if not self.running_copies[test_name]:
+            del self.running_copies[test_name]
+
+def _process_worker_main(worker_id, test_cases, task_connection, result_connection, plugins, max_tests_per_worker,
+        default_timeout, running, session_fixture_scope=None, trace=False):
+    """Main loop of a process pool worker
+
+    Tasks are (batch id, list of (tag, index, parameter index, parameter row))
+    batches.  Each index refers to test_cases, which the worker inherited
+    from the parent when it was forked, and the parameter row (if any) is
+    applied to that test case.  Shared requirements of every scope live as
+    long as the worker does, except that session requirements come from
+    session_fixture_scope when the parent preloaded them.
+
+    Tasks arrive on task_connection and results are sent on
+    result_connection, the worker's own pipes to the pool, so no lock is
+    shared with the other workers which a dead worker could leave held.  A
+    thread reads the tasks as they arrive so the pool never waits on a busy
+    worker to send one.  Each result is written into the pipe before the
+    worker goes on, so none is left in a buffer when the worker dies.
+
+    running is a list with a pair of shared values for each of the worker's
+    slots, holding the running test and its start time so the pool can tell
+    what a hung or dead worker was doing.  A worker with one slot runs
+    tests on its main thread.  Otherwise each slot
+    is a thread pulling tasks from the worker's queue, with group
+    requirements of its own, and a test which isn't thread_safe waits for
+    the others to finish and runs alone.
+    """
+    for plugin in plugins:
+        plugin.did_fork()
+    task_queue = Queue.Queue()
+
+    def read_tasks():
+        while True:
+            try:
+                task = task_connection.recv()
+            except (EOFError, IOError):
+                task = None
+            if task is None:
+                for slot in running:
+                    task_queue.put(None)
+                return
+            task_queue.put(task)
+
+    reader = threading.Thread(target=read_tasks, name='qa-process-%d-tasks' % (worker_id, ))
+    reader.daemon = True
+    reader.start()
+    fixture_scope = _FixtureScope()
+    lock = threading.Lock()
+    send_lock = threading.Lock()
+    num_run = [0]
+    exclusive = _SharedExclusiveLock() if len(running) > 1 else None
+
+    def run_slot(slot, worker):
+        running_tag, running_since = running[slot]
+        # The group scope only keeps one instance of each requirement, so it would tear down the instance a
+        # sibling slot's test is using
+        group_fixture_scope = fixture_scope if len(running) == 1 else _FixtureScope()
+        fixture_scopes = {SCOPE_GROUP: group_fixture_scope, SCOPE_WORKER: fixture_scope,
+                SCOPE_SESSION: fixture_scope if session_fixture_scope is None else session_fixture_scope}
+        while True:
+            with lock:
+                if max_tests_per_worker is not None and num_run[0] >= max_tests_per_worker:
+                    break
+            task = task_queue.get()
+            if task is None:
+                break
+            batch_id, items = task
+            for item in items:
+                tag = item[0]
+                test_case = _task_test_case(test_cases, item)
+                with _hold_shared_exclusive(exclusive, test_case.thread_safe):
+                    running_since.value = time.time()
+                    running_tag.value = tag
+                    test_result = _run_test_case(test_case, plugins, fixture_scopes, worker=worker,
+                            timeout=_test_case_timeout(test_case, default_timeout), trace=trace)
+                # Cleared first so a result which has been sent is never also reported as a crash
+                running_tag.value = -1
+                with send_lock:
+                    result_connection.send(('result', worker_id, tag, test_result))
+                with lock:
+                    num_run[0] += 1
+        if group_fixture_scope is not fixture_scope:
+            group_fixture_scope.close()
+
+    if len(running) == 1:
+        run_slot(0, 'process-%d' % worker_id)
+    else:
+        threads = []
+        for slot in range(len(running)):
+            thread = threading.Thread(target=_thread_slot_main, name='qa-process-%d-thread-%d' % (worker_id, slot),
+                    args=(plugins, run_slot, slot, 'process-%d/thread-%d' % (worker_id, slot)))
+            thread.daemon = True
+            for plugin in plugins:
+                plugin.will_clone()
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    fixture_scope.close()
+    result_connection.send(('exit', worker_id, None, None))
+
+def _thread_slot_main(plugins, run_slot, slot, worker):
+    for plugin in plugins:
+        plugin.did_clone()
+    run_slot(slot, worker)
+
+class _SharedExclusiveLock(object):
+    """A lock which many holders can share or one can hold exclusively
+
+    A waiting exclusive holder keeps new shared holders out so it isn't starved.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0
+
+    def acquire(self, shared):
+        with self.condition:
+            if shared:
+                while self.exclusive or self.exclusive_waiting:
+                    self.condition.wait()
+                self.shared += 1
+            else:
+                self.exclusive_waiting += 1
+                while self.exclusive or self.shared:
+                    self.condition.wait()
+                self.exclusive_waiting -= 1
+                self.exclusive = True
+
+    def release(self, shared):
+        with self.condition:
+            if shared:
+                self.shared -= 1
+            else:
+                self.exclusive = False
+            self.condition.notify_all()
+
+@contextlib.contextmanager
+def _hold_shared_exclusive(lock, shared):
+    if lock is None:
+        yield
+        return
+    lock.acquire(shared)
+    try:
+        yield
+    finally:
+        lock.release(shared)
+
+def _task_test_case(test_cases, item):
+    tag, index, param_index, row = item
+    if param_index is None:
+        return test_cases[index]
+    return ParamTestCase(test_cases[index], param_index, row)
+
+class _ProcessPool(object):
+    """A pool of long lived worker processes
+
+    Batches of test cases are sent to each worker on a pipe of its own, and
+    the worker sends test results back on another.  A worker is sent at most
+    two batches per thread beyond the ones it has finished, and the rest wait
+    in the pool.  Test cases are sent one at a time
+    except for consecutive rows of a parametrized test case, which are sent in
+    batches of up to batch_size rows.  If max_tests_per_worker is set, each
+    worker exits after running about that many test cases and is replaced by
+    a fresh one.
+
+    Workers are forked from the running process so they inherit its imported
+    modules.  session_fixture_scope is a _FixtureScope of preloaded session
+    requirements for the workers to share.  It is closed when the pool stops.
+
+    With threads_per_worker above 1, each worker runs that many tests at once
+    on a pool of threads.
+
+    Workers interrupt their own tests when they time out.  A worker which is
+    still running a test DEFAULT_TIMEOUT_GRACE seconds after that (or at once
+    if the test is running on a thread, which can't be interrupted), or
+    which dies, is replaced.  The test is reported as crashed, along with
+    every other test the worker was running, which was interrupted.  The
+    rest of the tests of the batches sent to the worker, including one whose
+    result it was cut off sending, are queued again.
+    """
+    def __init__(self, test_cases, num_workers, plugins, max_tests_per_worker=None, timeout=None,
+            batch_size=DEFAULT_PARAM_BATCH_SIZE, session_fixture_scope=None, threads_per_worker=1, trace=False):
+        self.test_cases = test_cases
+        self.indexes = dict((id(test_case), index) for index, test_case in enumerate(test_cases))
+        self.num_workers = num_workers
+        self.plugins = plugins
+        self.max_tests_per_worker = max_tests_per_worker
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.session_fixture_scope = session_fixture_scope
+        self.threads_per_worker = threads_per_worker
+        self.trace = trace
+        self.grace = DEFAULT_TIMEOUT_GRACE if threads_per_worker == 1 else 0.0
+        self.capacity = num_workers * threads_per_worker * 2 * batch_size
+        self.workers = {}
+        # worker id to the end of the worker's result pipe
+        self.connections = {}
+        # worker id to the end of the worker's task pipe
+        self.task_connections = {}
+        # worker id to a list of the (tag, started at) shared values of the test running in each slot
+        self.running = {}
+        # worker id to the ids of the batches sent to the worker which still lack results, in the order sent
+        self.assigned = {}
+        # ids of the batches waiting for a worker
+        self.queued = collections.deque()
+        self.ready = collections.deque()
+        self.next_worker_id = 0
+        # Items of the parametrized test case batch being filled
+        self.pending = []
+        # batch id to an ordered dictionary of tag to item, for the items without a result yet
+        self.batches = {}
+        self.tag_batches = {}
+        self.next_batch_id = 0
+
+    def start(self):
+        for i in range(self.num_workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        running = [(multiprocessing.Value('l', -1, lock=False), multiprocessing.Value('d', 0.0, lock=False))
+                for slot in range(self.threads_per_worker)]
+        connection, worker_connection = multiprocessing.Pipe(duplex=False)
+        worker_task_connection, task_connection = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_process_worker_main,
+                args=(worker_id, self.test_cases, worker_task_connection, worker_connection, self.plugins,
+                    self.max_tests_per_worker, self.timeout, running, self.session_fixture_scope, self.trace))
+        self.running[worker_id] = running
+        self.assigned[worker_id] = []
+        for plugin in self.plugins:
+            plugin.will_fork()
+        process.start()
+        # Closed here so the pipe reaches its end once the worker exits
+        worker_connection.close()
+        worker_task_connection.close()
+        self.connections[worker_id] = connection
+        self.task_connections[worker_id] = task_connection
+        _test_run_log.debug('started worker %d (pid %d)', worker_id, process.pid)
+        self.workers[worker_id] = process
+        self._dispatch()
+
+    def submit(self, tag, test_case):
+        if isinstance(test_case, ParamTestCase):
+            item = (tag, self.indexes[id(test_case.template)], test_case.param_index, test_case.param_row)
+            if self.pending and self.pending[-1][1] != item[1]:
+                self._flush()
+            self.pending.append(item)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+        else:
+            self._flush()
+            self._send_batch([(tag, self.indexes[id(test_case)], None, None)])
+
+    def _flush(self):
+        if self.pending:
+            self._send_batch(self.pending)
+            self.pending = []
+
+    def _send_batch(self, items):
+        batch_id = self.next_batch_id
+        self.next_batch_id += 1
+        self.batches[batch_id] = collections.OrderedDict((item[0], item) for item in items)
+        for item in items:
+            self.tag_batches[item[0]] = batch_id
+        self.queued.append(batch_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Send queued batches to the workers with room for them"""
+        for worker_id, assigned in self.assigned.items():
+            while self.queued and len(assigned) < self.threads_per_worker * 2:
+                batch_id = self.queued[0]
+                batch = self.batches.get(batch_id)
+                if batch is not None:
+                    try:
+                        self.task_connections[worker_id].send((batch_id, batch.values()))
+                    except IOError:
+                        # The worker died, and _check_workers queues its batches again
+                        break
+                    assigned.append(batch_id)
+                self.queued.popleft()
+
+    def _requeue(self, worker_id):
+        """Queue the batches sent to a worker which is gone again, ahead of the others"""
+        self.queued.extendleft(reversed(self.assigned.pop(worker_id)))
+        self.task_connections.pop(worker_id).close()
+
+    def get_result(self):
+        self._flush()
+        while not self.ready:
+            if not self._receive(_WATCHDOG_INTERVAL):
+                self._check_workers()
+        return self.ready.popleft()
+
+    def _receive(self, timeout):
+        """Handle the messages of the workers which send one within timeout seconds
+
+        Returns
+        bool, whether any worker's pipe was ready
+        """
+        workers = dict((connection.fileno(), worker_id) for worker_id, connection in self.connections.items())
+        try:
+            ready, _, _ = select.select(list(workers), [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        for fd in ready:
+            worker_id = workers[fd]
+            connection = self.connections.get(worker_id)
+            if connection is None:
+                # Recycled while the messages of another worker were handled
+                continue
+            try:
+                message = connection.recv()
+            except (EOFError, IOError):
+                # The worker exited, and _check_workers replaces it
+                connection.close()
+                del self.connections[worker_id]
+                continue
+            self._handle_message(message)
+        return bool(ready)
+
+    def _handle_message(self, message):
+        kind, worker_id, tag, test_result = message
+        if kind == 'result':
+            batch_id = self.tag_batches.pop(tag, None)
+            if batch_id is None:
+                _test_run_log.debug('dropping a second result for tag %d', tag)
+                return
+            batch = self.batches[batch_id]
+            del batch[tag]
+            if not batch:
+                del self.batches[batch_id]
+                for assigned in self.assigned.values():
+                    if batch_id in assigned:
+                        assigned.remove(batch_id)
+                        self._dispatch()
+                        break
+            self.ready.append((tag, test_result))
+        elif kind == 'exit':
+            _test_run_log.debug('recycling worker %d', worker_id)
+            self.workers.pop(worker_id).join()
+            self.connections.pop(worker_id).close()
+            del self.running[worker_id]
+            self._requeue(worker_id)
+            self._start_worker()
+
+    def _drain(self):
+        while self._receive(0):
+            pass
+
+    def running_tests(self):
+        """Get the (worker name, test case, started at) of each running test
+
+        This may be called from other threads.
+        """
+        running = []
+        for worker_id, slots in self.running.items():
+            for slot, (running_tag, running_since) in enumerate(slots):
+                tag = running_tag.value
+                batch = self.batches.get(self.tag_batches.get(tag))
+                item = batch.get(tag) if batch is not None else None
+                if item is None:
+                    continue
+                worker = 'process-%d' % worker_id if len(slots) == 1 else 'process-%d/thread-%d' % (worker_id, slot)
+                running.append((worker, _task_test_case(self.test_cases, item), running_since.value))
+        return running
+
+    def _running_test_case(self, tag):
+        """Get the test case a worker is running, or None if its result has been received"""
+        batch_id = self.tag_batches.get(tag)
+        if batch_id is None:
+            return None
+        return _task_test_case(self.test_cases, self.batches[batch_id][tag])
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id, process in self.workers.items():
+            if worker_id not in self.workers:
+                # Recycled while the messages of another worker were drained
+                continue
+            slots = self.running[worker_id]
+            overdue = None
+            if not process.is_alive():
+                # Messages sent just before the worker exited may not have been read yet
+                self._drain()
+                if worker_id not in self.workers:
+                    continue
+                detail = 'worker process-%d exited with code %r' % (worker_id, process.exitcode)
+            else:
+                for slot in slots:
+                    running_tag, running_since = slot
+                    test_case = self._running_test_case(running_tag.value)
+                    if test_case is None:
+                        continue
+                    timeout = _test_case_timeout(test_case, self.timeout)
+                    if timeout is not None and now - running_since.value >= timeout + self.grace:
+                        overdue = slot
+                        break
+                if overdue is None:
+                    continue
+                detail = 'worker process-%d did not stop the test and was killed' % (worker_id, )
+                overdue_test_case = self._running_test_case(overdue[0].value)
+                os.kill(process.pid, signal.SIGKILL)
+            _test_run_log.warning('%s, starting a replacement', detail)
+            process.join()
+            if overdue is not None:
+                # Results the worker sent before it was killed
+                self._drain()
+            del self.workers[worker_id]
+            del self.running[worker_id]
+            connection = self.connections.pop(worker_id, None)
+            if connection is not None:
+                connection.close()
+            for slot in slots:
+                running_tag, running_since = slot
+                test_case = self._running_test_case(running_tag.value)
+                if test_case is not None:
+                    slot_detail = detail
+                    if overdue is not None and slot is not overdue:
+                        # Interrupted by the kill, so it isn't known whether the test would have passed
+                        slot_detail = 'worker process-%d was killed because %s timed out' % (
+                                worker_id, overdue_test_case.group_and_name())
+                    self._handle_message(('result', worker_id, running_tag.value,
+                        self._crash_result(test_case, running_since.value, process.exitcode, worker_id,
+                            slot_detail)))
+            self._requeue(worker_id)
+            self._start_worker()
+
+    def _crash_result(self, test_case, started_at, exitcode, worker_id, detail):
+        timeout = _test_case_timeout(test_case, self.timeout)
+        now = time.time()
+        if exitcode == -signal.SIGKILL and timeout is not None and now - started_at >= timeout:
+            return _timeout_result(test_case, timeout, started_at, 'process-%d' % worker_id, detail)
+        return TestResult(group=test_case.group, name=test_case.name, description=test_case.description,
+                started_at=started_at, ended_at=now, worker='process-%d' % worker_id,
+                error_msg='Crash: %s while running the test' % (detail, ))
+
+    def stop(self, cancel=False):
+        if cancel:
+            for process in self.workers.values():
+                process.terminate()
+        else:
+            for task_connection in self.task_connections.values():
+                try:
+                    task_connection.send(None)
+                except IOError:
+                    pass
+        for process in self.workers.values():
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for connection in self.connections.values() + self.task_connections.values():
+            connection.close()
+        self.workers.clear()
+        self.connections.clear()
+        self.task_connections.clear()
+        self.running.clear()
+        self.assigned.clear()
+        self.queued.clear()
+
+def _run_test_cases_multiprocess(test_cases, num_workers, plugins, max_tests_per_worker=None, timeout=None,
+        session_fixture_scope=None, threads_per_worker=1, resources=None, metrics=None, trace=False):
+    """Run test cases on a pool of worker processes, each running tests on threads_per_worker threads
+
+    The session requirements of the tests are preloaded into session_fixture_scope, if it's given, before the
+    workers are forked.  The caller closes it.
+    """
+    if num_workers is None:
+        num_workers = DEFAULT_NUM_WORKERS
+    test_cases = list(test_cases)
+    if session_fixture_scope is not None:
+        _preload_session_fixtures(test_cases, session_fixture_scope)
+    pool = _ProcessPool(test_cases, num_workers, plugins, max_tests_per_worker=max_tests_per_worker, timeout=timeout,
+            session_fixture_scope=session_fixture_scope, threads_per_worker=threads_per_worker, trace=trace)
+    return _run_test_cases_pooled(test_cases, pool, plugins, resources=resources, metrics=metrics)
+
+# Distributed runs: a coordinator serves test ids ("group:name") to worker
+# agents over TCP.  Every message is a pickle prefixed with its 4 byte length.
+# The coordinator only unpickles qa's result classes and builtin values from
+# the workers, and only listens on the loopback interface unless it's told
+# otherwise.  Workers unpickle whatever the coordinator sends (parameter rows
+# can be any picklable value), so they should only connect to a coordinator
+# they trust.
+#
+# coordinator -> worker: ('run', tag, test id), ('stop', None, None)
+# worker -> coordinator: ('hello', worker name, None), ('result', tag, TestResult)
+
+def _parse_address(address):
+    """Parse a "host:port" string into a (host, port) tuple"""
+    host, _, port = address.rpartition(':')
+    return (host, int(port))
+
+def _send_message(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _recv_message(sock, restricted=False):
+    """Receive a message
+
+    If restricted is set, the message may only hold the classes allowed by
+    _find_message_global and pickle.UnpicklingError is raised for any other
+    message.
+    """
+    size, = struct.unpack('!I', _recv_exactly(sock, 4))
+    data = _recv_exactly(sock, size)
+    if not restricted:
+        return pickle.loads(data)
+    unpickler = pickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = _find_message_global
+    try:
+        return unpickler.load()
+    except Exception as e:
+        raise pickle.UnpicklingError('bad message: %r' % (e, ))
+
+def _find_message_global(module, name):
+    value = getattr(sys.modules.get(module), name, None)
+    if not any(value is allowed for allowed in (TestResult, ExceptionSummary, set, frozenset)):
+        raise pickle.UnpicklingError('%s.%s is not allowed in a message' % (module, name))
+    return value
+
+class _CoordinatorPool(object):
+    """Serves test cases to worker agents which connect over TCP
+
+    Each connection is handled by its own thread.  A test which was sent to
+    a worker that disconnects before returning its result is queued again.
+    Tests are queued _COORDINATOR_PREFETCH at a time for each connected
+    worker, or for one worker while none is connected.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.result_queue = Queue.Queue()
+        self.listener = None
+        # tag to test case, for the tests which have been submitted and have no result yet
+        self.submitted = {}
+        # worker name to the (test case, sent at) of the test the worker is running
+        self.running = {}
+        self.num_connected = 0
+
+    @property
+    def capacity(self):
+        return max(self.num_connected, 1) * _COORDINATOR_PREFETCH
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(128)
+        _test_run_log.info('serving tests on %s:%d', *self.listener.getsockname())
+        accept_thread = threading.Thread(target=self._accept, name='qa-coordinator')
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, peer = self.listener.accept()
+            except socket.error:
+                return
+            handler = threading.Thread(target=self._serve, args=(sock, peer), name='qa-coordinator-%s:%d' % peer)
+            handler.daemon = True
+            handler.start()
+
+    def _next_task(self):
+        with self.condition:
+            while not self.pending and not self.stopping:
+                self.condition.wait()
+            if self.pending:
+                return self.pending.popleft()
+
+    def _requeue(self, task):
+        with self.condition:
+            self.pending.appendleft(task)
+            self.condition.notify()
+
+    def _serve(self, sock, peer):
+        try:
+            kind, worker, _ = _recv_message(sock, restricted=True)
+        except (socket.error, EOFError, struct.error, pickle.UnpicklingError, TypeError, ValueError):
+            sock.close()
+            return
+        if kind != 'hello' or not isinstance(worker, basestring):
+            _test_run_log.warning('rejected a connection from %s:%d which is not a worker', *peer)
+            sock.close()
+            return
+        _test_run_log.debug('worker %s connected from %s:%d', worker, *peer)
+        with self.condition:
+            self.num_connected += 1
+        try:
+            self._serve_worker(sock, worker)
+        finally:
+            with self.condition:
+                self.num_connected -= 1
+            sock.close()
+
+    def _serve_worker(self, sock, worker):
+        while True:
+            task = self._next_task()
+            if task is None:
+                try:
+                    _send_message(sock, ('stop', None, None))
+                except socket.error:
+                    pass
+                break
+            tag, test_id = task
+            self.running[worker] = (self.submitted.get(tag), time.time())
+            try:
+                _send_message(sock, ('run', tag, test_id))
+                kind, result_tag, test_result = _recv_message(sock, restricted=True)
+                if kind != 'result' or result_tag != tag or not isinstance(test_result, TestResult):
+                    raise pickle.UnpicklingError('unexpected %r message' % (kind, ))
+            except (socket.error, EOFError, struct.error):
+                _test_run_log.warning('worker %s disconnected while running %s, queueing it again', worker, test_id)
+                del self.running[worker]
+                self._requeue(task)
+                break
+            except (pickle.UnpicklingError, TypeError, ValueError) as e:
+                _test_run_log.warning('worker %s sent a bad message while running %s (%s), disconnecting it and '
+                        'queueing the test again', worker, test_id, e)
+                del self.running[worker]
+                self._requeue(task)
+                break
+            del self.running[worker]
+            self.result_queue.put((tag, test_result))
+
+    def submit(self, tag, test_case):
+        if isinstance(test_case, ParamTestCase):
+            test_id = (test_case.template.group_and_name(), test_case.param_index, test_case.param_row)
+        else:
+            test_id = test_case.group_and_name()
+        self.submitted[tag] = test_case
+        with self.condition:
+            self.pending.append((tag, test_id))
+            self.condition.notify()
+
+    def get_result(self):
+        tag, test_result = self.result_queue.get()
+        self.submitted.pop(tag, None)
+        return tag, test_result
+
+    def running_tests(self):
+        """Get the (worker name, test case, sent at) of each running test"""
+        return [(worker, test_case, started_at) for worker, (test_case, started_at) in self.running.items()
+                if test_case is not None]
+
+    def stop(self, cancel=False):
+        with self.condition:
+            if cancel:
+                self.pending.clear()
+            self.stopping = True
+            self.condition.notify_all()
+        self.listener.close()
+
+def _run_test_cases_distributed(test_cases, address, plugins, resources=None, metrics=None):
+    """Serve test cases to worker agents on other hosts (see run_worker)"""
+    if address is None:
+        address = _parse_address(DEFAULT_LISTEN_ADDRESS)
+    pool = _CoordinatorPool(address)
+    return _run_test_cases_pooled(test_cases, pool, plugins, resources=resources, metrics=metrics)
+
+def run_worker(address, test_cases, plugins, name=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT, timeout=None,
+        trace=False):
+    """Run tests served by a coordinator until it has no more
+
+    The worker must import the same test modules as the coordinator.  Test
+    ids are looked up by group_and_name() in test_cases.  The rows of
+    parametrized test cases are sent with their ids.
+
+    Arguments
+    address -- (host, port) tuple of the coordinator
+    test_cases -- iterable of TestCase
+    plugins -- list of Plugin
+    name -- str, the worker name reported on each result.  Defaults to "hostname:pid".
+    connect_timeout -- float, seconds to keep retrying to connect while the coordinator isn't up yet
+    timeout -- float, seconds each test without its own timeout may run
+    trace -- bool, record a timeline of each test for the coordinator's trace (see write_trace)
+    """
+    if name is None:
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+    by_id = {}
+    for test_case in test_cases:
+        by_id.setdefault(test_case.group_and_name(), test_case)
+    deadline = time.time() + connect_timeout
+    while True:
+        try:
+            sock = socket.create_connection(address)
+            break
+        except socket.error:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.1)
+    fixture_scope = _FixtureScope()
+    fixture_scopes = {SCOPE_GROUP: fixture_scope, SCOPE_WORKER: fixture_scope, SCOPE_SESSION: fixture_scope}
+    try:
+        _send_message(sock, ('hello', name, None))
+        while True:
+            kind, tag, test_id = _recv_message(sock)
+            if kind == 'stop':
+                break
+            if isinstance(test_id, tuple):
+                test_id, param_index, param_row = test_id
+                test_case = by_id.get(test_id)
+                if test_case is not None:
+                    test_case = ParamTestCase(test_case, param_index, param_row)
+            else:
+                test_case = by_id.get(test_id)
+            if test_case is None:
+                group, _, test_name = test_id.partition(':')
+                test_result = TestResult(group=group, name=test_name, worker=name,
+                        error_msg='worker %s has no test case %s' % (name, test_id))
+            else:
+                test_result = _run_test_case(test_case, plugins, fixture_scopes, worker=name,
+                        timeout=_test_case_timeout(test_case, timeout), trace=trace)
+            _send_message(sock, ('result', tag, test_result))
+    finally:
+        fixture_scope.close()
+        sock.close()
+
+class Context(dict):
+    def __getattr__(self, attr):
+        try:
+            return self.__getitem__(attr)
+        except KeyError:
+            raise AttributeError
+
+    def __setattr__(self, attr, val):
+        self.__setitem__(attr, val)
+
+    def __delattr__(self, attr):
+        try:
+            return self.__delitem__(attr)
+        except KeyError:
+            raise AttributeError
+
+def _fixture_scope(requirement):
+    return getattr(requirement, 'scope', SCOPE_TEST)
+
+def _fixture_key(requirement, test_case):
+    """Get the key that identifies the shared instance of a requirement used by a test case"""
+    if _fixture_scope(requirement) == SCOPE_GROUP:
+        return (requirement, test_case.group)
+    else:
+        return (requirement, None)
+
+def _shared_fixture_keys(test_case):
+    return tuple(_fixture_key(r, test_case) for r in test_case.requires if _fixture_scope(r) != SCOPE_TEST)
+
+def _count_fixture_users(test_cases):
+    """Count the number of tests which use each shared requirement instance
+
+    The rows of parametrized test cases aren't counted ahead of time, so the
+    instances they use are left out and live until the end of the run.
+    """
+    counts = {}
+    uncounted = set()
+    for test_case in test_cases:
+        for key in _shared_fixture_keys(test_case):
+            counts[key] = counts.get(key, 0) + 1
+            if test_case.params is not None:
+                uncounted.add(key)
+    for key in uncounted:
+        del counts[key]
+    return counts
+
+def _group_by_fixtures(test_cases, users):
+    """Reorder a stream of test cases so tests which share requirement instances run next to each other
+
+    Tests which don't share any requirement instances are passed through as
+    they come.  The tests which do are held back and follow, grouped in the
+    order the groups first appear in, once test_cases is exhausted.  Before
+    the first of them is yielded, users is updated with the number of tests
+    which use each instance (see _count_fixture_users).
+    """
+    groups = collections.OrderedDict()
+    for test_case in test_cases:
+        key = _shared_fixture_keys(test_case)
+        if key:
+            groups.setdefault(key, []).append(test_case)
+        else:
+            yield test_case
+    users.update(_count_fixture_users(test_case for group in groups.itervalues() for test_case in group))
+    for group in groups.itervalues():
+        for test_case in group:
+            yield test_case
+
+def _fixture_groups(test_cases):
+    """Split test cases into lists of tests which share requirement instances
+
+    Each test which doesn't share any is in a list of its own.  The lists are
+    in the order their first tests appear in.
+    """
+    groups = {}
+    order = []
+    for test_case in test_cases:
+        key = _shared_fixture_keys(test_case)
+        if not key:
+            order.append([test_case])
+        elif key in groups:
+            groups[key].append(test_case)
+        else:
+            groups[key] = [test_case]
+            order.append(groups[key])
+    return order
+
+class _FixtureInstance(object):
+    def __init__(self, context_manager, values, error):
+        self.context_manager = context_manager
+        self.values = values
+        self.error = error
+
+class _FixtureScope(object):
+    """Live instances of shared requirements
+
+    Arguments
+    remaining -- dictionary of fixture key to the number of tests which will use it, or None.  When
+        given, an instance is torn down after its last user is released.  Otherwise instances live until
+        close() is called, except that only one group instance of each requirement is kept alive at a time.
+    lock -- reentrant lock guarding set up and tear down.  Defaults to a threading.RLock.
+    """
+    def __init__(self, remaining=None, lock=None):
+        self.remaining = remaining
+        self.instances = {}
+        self.order = []
+        self.lock = threading.RLock() if lock is None else lock
+
+    def acquire(self, requirement, key, ctx):
+        """Get the context values of a shared requirement instance, setting it up if necessary"""
+        with self.lock:
+            instance = self.instances.get(key)
+            if instance is None:
+                if self.remaining is None:
+                    for other_key in self.order[:]:
+                        if other_key[0] is requirement:
+                            self._tear_down(other_key)
+                instance = self.instances[key] = self._set_up(requirement, ctx)
+                self.order.append(key)
+        if instance.error is not None:
+            raise instance.error[0], instance.error[1], instance.error[2]
+        return instance.values
+
+    def _set_up(self, requirement, ctx):
+        _test_run_log.debug('setting up shared requirement %r', requirement)
+        fixture_ctx = Context(ctx)
+        context_manager = requirement(fixture_ctx)
+        try:
+            context_manager.__enter__()
+        except Exception:
+            return _FixtureInstance(None, None, sys.exc_info())
+        return _FixtureInstance(context_manager, dict(fixture_ctx), None)
+
+    def add_users(self, key, count):
+        """Keep an instance alive for count more releases than the tests which were counted"""
+        if self.remaining is None or key not in self.remaining:
+            return
+        with self.lock:
+            self.remaining[key] += count
+
+    def release(self, key):
+        if self.remaining is None or key not in self.remaining:
+            return
+        with self.lock:
+            self.remaining[key] -= 1
+            if self.remaining[key] <= 0 and key in self.instances:
+                self._tear_down(key)
+
+    def _tear_down(self, key):
+        instance = self.instances.pop(key)
+        self.order.remove(key)
+        if instance.context_manager is not None:
+            _test_run_log.debug('tearing down shared requirement %r', key[0])
+            try:
+                instance.context_manager.__exit__(None, None, None)
+            except Exception:
+                _test_run_log.exception('An exception occurred while tearing down %r', key[0])
+
+    def close(self):
+        with self.lock:
+            for key in reversed(self.order[:]):
+                self._tear_down(key)
+
+def _preload_session_fixtures(test_cases, fixture_scope):
+    """Set up the session requirements of test cases ahead of the run in fixture_scope
+
+    A requirement which fails to set up fails each test using it.
+    """
+    for test_case in test_cases:
+        for requirement in test_case.requires:
+            if _fixture_scope(requirement) == SCOPE_SESSION:
+                try:
+                    fixture_scope.acquire(requirement, _fixture_key(requirement, test_case), Context())
+                except Exception:
+                    # The error is raised again in each test which uses the requirement
+                    pass
+
+def _close_after(test_results, fixture_scope):
+    """Pass through a stream of test results, closing fixture_scope when the stream ends"""
+    try:
+        for test_result in test_results:
+            yield test_result
+    finally:
+        test_results.close()
+        fixture_scope.close()
+
+def _release_fixtures(test_case, fixture_scope):
+    """Release the shared requirements of a test case which will not be run"""
+    for key in _shared_fixture_keys(test_case):
+        fixture_scope.release(key)
+
+@contextlib.contextmanager
+def _use_shared_fixture(fixture_scope, requirement, key, ctx):
+    ctx.update(fixture_scope.acquire(requirement, key, ctx))
+    yield
+
+@contextlib.contextmanager
+def _interrupt_after(timeout):
+    """Raise Timeout in the current test if it runs for longer than timeout seconds
+
+    Greenlets are interrupted with a gevent.Timeout and the main thread with
+    SIGALRM.  Other threads can't be interrupted so this does nothing there.
+    """
+    if timeout is None:
+        yield
+        return
+    message = 'test did not finish within %gs' % (timeout, )
+    # A process forked from a greenlet worker is no longer a greenlet worker
+    if gevent is not None and getattr(gevent.getcurrent(), 'qa_worker_pid', None) == os.getpid():
+        with gevent.Timeout(timeout, Timeout(message)):
+            yield
+        return
+    def interrupt(signum, frame):
+        raise Timeout(message)
+    can_interrupt = hasattr(signal, 'setitimer')
+    if can_interrupt:
+        try:
+            previous_handler = signal.signal(signal.SIGALRM, interrupt)
+        except ValueError:
+            # Only the main thread can handle signals.  The only thread of a forked worker counts as the main thread.
+            can_interrupt = False
+    if not can_interrupt:
+        yield
+    else:
+        started = time.time()
+        previous_delay, _ = signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            if previous_delay:
+                signal.setitimer(signal.ITIMER_REAL, max(previous_delay - (time.time() - started), 0.001))
+
+def _run_test_case(test_case, plugins, fixture_scopes=None, worker='', timeout=None, trace=False):
+    """Helper method to run a test case.
+
+    This is shared between the multiprocess, multithread and single thread test runners.
+
+    Arguments
+    fixture_scopes -- dictionary of scope to _FixtureScope holding the shared requirements of the
+        current worker.  Requirements whose scope is missing are run around the test like SCOPE_TEST.
+    worker -- str, name of the current worker
+    timeout -- float, seconds after which the test is interrupted with Timeout (where that's possible)
+    trace -- bool, record the setup and teardown of each of the test's requirements, the call of the test and
+        each plugin hook called while running it as (name, category, started at, ended at) spans in
+        test_result.extra['trace'] along with the id of the process which ran it
+    """
+    if fixture_scopes is None:
+        fixture_scopes = {}
+    if plugins is None:
+        plugins = ()
+    spans = [] if trace else None
+    ctx = Context()
+    test_result = TestResult(group=test_case.group, name=test_case.name, description=test_case.description,
+            started_at=time.time(), worker=worker)
+    shared = []
+    try:
+        requirement_functions = []
+        for extra_requirements in _call_plugins(plugins, 'extra_test_case_requirements', spans, test_case):
+            requirement_functions.extend(extra_requirements)
+        requirement_functions.extend(test_case.requires)
+        requirements = []
+        for requirement in requirement_functions:
+            fixture_scope = fixture_scopes.get(_fixture_scope(requirement))
+            if fixture_scope is None:
+                manager = requirement(ctx)
+            else:
+                key = _fixture_key(requirement, test_case)
+                shared.append((fixture_scope, key))
+                manager = _use_shared_fixture(fixture_scope, requirement, key, ctx)
+            if spans is not None:
+                manager = _TracedRequirement(manager, getattr(requirement, '__name__', repr(requirement)), spans)
+            requirements.append(manager)
+        with _interrupt_after(timeout):
+            with contextlib.nested(*requirements):
+                _call_plugins(plugins, 'will_run_test_case', spans, test_case, ctx)
+                called_at = time.time()
+                try:
+                    test_case.callable(ctx)
+                finally:
+                    if spans is not None:
+                        spans.append(('call', 'test', called_at, time.time()))
+                    _call_plugins(plugins, 'did_call_test_case', spans, test_case, ctx)
+    except Failure:
+        test_result.failure = sys.exc_info()
+    except Exception:
+        test_result.error = sys.exc_info()
+    test_result.ended_at_seconds = time.time()
+    _test_run_log.debug('test %s: %r', test_result.status, test_result.group_and_name)
+    # For plugins which rerun the test (see MemoryPlugin).  Shared requirements are released afterwards.
+    ctx['_qa_fixture_scopes'] = fixture_scopes
+    _call_plugins(plugins, 'did_run_test_case', spans, test_case, test_result, ctx)
+    for fixture_scope, key in reversed(shared):
+        fixture_scope.release(key)
+    if spans is not None:
+        spans.append((test_result.group_and_name, 'test', test_result.started_at_seconds, time.time()))
+        test_result.extra['trace'] = {'pid': os.getpid(), 'spans': spans}
+    return test_result
+
+def _call_plugins(plugins, hook, spans, *args):
+    """Call a hook of each plugin, recording a span for each call if spans isn't None
+
+    Returns a list of the results of the calls
+    """
+    if spans is None:
+        return [getattr(plugin, hook)(*args) for plugin in plugins]
+    results = []
+    for plugin in plugins:
+        started_at = time.time()
+        try:
+            results.append(getattr(plugin, hook)(*args))
+        finally:
+            spans.append(('%s.%s' % (type(plugin).__name__, hook), 'plugin', started_at, time.time()))
+    return results
+
+class _TracedRequirement(object):
+    """Wraps a requirement's context manager, recording spans for its setup and teardown"""
+    def __init__(self, manager, name, spans):
+        self.manager = manager
+        self.name = name
+        self.spans = spans
+
+    def __enter__(self):
+        started_at = time.time()
+        try:
+            return self.manager.__enter__()
+        finally:
+            self.spans.append((self.name, 'setup', started_at, time.time()))
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        started_at = time.time()
+        try:
+            return self.manager.__exit__(exc_type, exc_value, exc_traceback)
+        finally:
+            self.spans.append((self.name, 'teardown', started_at, time.time()))
+
+def _run_test_cases_singlethread(test_cases, plugins, timeout=None, metrics=None, fixture_users=None,
+        session_fixture_scope=None, trace=False):
+    """Run test cases in a single thread
+
+    fixture_users is as for _run_test_cases_multithread.  session_fixture_scope is a _FixtureScope of
+    preloaded session requirements to use, which the caller closes.
+    """
+    if fixture_users is None:
+        fixture_users = _count_fixture_users(test_cases)
+    fixture_scope = _FixtureScope(remaining=fixture_users)
+    fixture_scopes = {SCOPE_GROUP: fixture_scope, SCOPE_WORKER: fixture_scope,
+            SCOPE_SESSION: fixture_scope if session_fixture_scope is None else session_fixture_scope}
+    running = []
+    if metrics is not None:
+        metrics.running_tests = lambda: list(running)
+    try:
+        for test_case in expand_test_cases(test_cases):
+            skip_test_result = _is_skip_test_case(test_case, plugins)
+            if skip_test_result is not None:
+                _release_fixtures(test_case, fixture_scope)
+                test_result = skip_test_result
+            else:
+                running.append(('main', test_case, time.time()))
+                test_result = _run_test_case(test_case, plugins, fixture_scopes, worker='main',
+                        timeout=_test_case_timeout(test_case, timeout), trace=trace)
+                del running[:]
+            if metrics is not None:
+                metrics.test_finished(test_result)
+            yield test_result
+    finally:
+        fixture_scope.close()
+
+def print_test_results(test_results, plugins, file=None, reporters=()):
+    """Print a stream of test results
+
+    Each test error or failure will be printed to 'file'
+
+    Arguments
+    test_results -- stream of test results
+    file -- None
+    reporters -- sequence of Reporter.  Each result is reported as soon as it is received and the
+        reporters are closed at the end.
+    """
+    if file is None:
+        file = sys.stderr
+    try:
+        _print_test_results(test_results, reporters)
+    finally:
+        # Stop the runner's workers if printing was interrupted
+        close = getattr(test_results, 'close', None)
+        if close is not None:
+            close()
+        for reporter in reporters:
+            reporter.close()
+
+def _print_test_results(test_results, reporters):
+    failures = 0
+    errors = 0
+    skipped = 0
+    ok = 0
+    for result in test_results:
+        for reporter in reporters:
+            reporter.report(result)
+        if result.is_error:
             errors += 1
         elif result.is_failure:
             failures += 1
         elif result.skipped:
             skipped += 1
         else:
-            ok += 1
-        if result.is_success:
-            _test_result_log.info('test %r %s', result.group_and_name, result.status)
-        elif result.skipped:
-            _test_result_log.warning('test %r %s', result.group_and_name, result.status)
+            ok += 1
+        if result.is_success and result.cached:
+            _test_result_log.info('test %r %s (cached)', result.group_and_name, result.status)
+        elif result.is_success:
+            _test_result_log.info('test %r %s', result.group_and_name, result.status)
+        elif result.skipped:
+            _test_result_log.warning('test %r %s', result.group_and_name, result.status)
+        else:
+            _test_result_log.error('test %r %s:\n%s', result.group_and_name, result.status, result.formatted_message)
+        if 'benchmark' in result.extra:
+            stats = result.extra['benchmark']
+            _test_result_log.info('benchmark %r: min %s, median %s, p95 %s, stddev %s, %.1f ops/sec', result.group_and_name,
+                    _format_seconds(stats['min']), _format_seconds(stats['median']), _format_seconds(stats['p95']),
+                    _format_seconds(stats['stddev']), stats['ops_per_sec'])
+        if 'memory' in result.extra:
+            memory = result.extra['memory']
+            _test_result_log.info('memory %r: retained %s resident, %+d objects (%s)', result.group_and_name,
+                    _format_bytes(memory['retained']), memory['objects'],
+                    ', '.join('%s %+d' % (name, count) for name, count in memory['top_types']))
+    _test_result_log.info('executed ok: %d, errors: %d, failures: %d, skipped: %d', ok, errors, failures, skipped) 
+
+def _to_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return value
+
+def _to_datetime(timestamp):
+    if timestamp is not None:
+        return datetime.datetime.fromtimestamp(timestamp)
+
+def _to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+class Reporter(object):
+    """Abstract reporter which writes each test result as it finishes
+
+    Arguments
+    file -- a file object to write to
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def report(self, test_result):
+        pass
+
+    def close(self):
+        if self.file not in (sys.stdout, sys.stderr):
+            self.file.close()
+        else:
+            self.file.flush()
+
+class JSONLinesReporter(Reporter):
+    """Writes one JSON object per test result"""
+    def report(self, test_result):
+        duration = test_result.duration_seconds
+        record = {
+                'group': _to_unicode(test_result.group),
+                'name': _to_unicode(test_result.name),
+                'status': test_result.status,
+                'duration': duration,
+                'formatted_message': _to_unicode(test_result.formatted_message),
+                'skipped_reason': _to_unicode(test_result.skipped_reason),
+                'worker': _to_unicode(test_result.worker),
+                'cached': test_result.cached}
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+
+class JUnitXMLReporter(Reporter):
+    """Writes a JUnit XML <testsuite> one <testcase> element at a time
+
+    The suite totals aren't known until the end so the <testsuite> element has no count attributes.
+    """
+    def __init__(self, file):
+        super(JUnitXMLReporter, self).__init__(file)
+        self._write(u'<?xml version="1.0" encoding="utf-8"?>\n<testsuite name="qa">\n')
+
+    def _write(self, text):
+        self.file.write(text.encode('utf-8'))
+        self.file.flush()
+
+    def report(self, test_result):
+        duration = test_result.duration_seconds
+        attributes = u' '.join(u'%s=%s' % (name, saxutils.quoteattr(_to_unicode(value))) for name, value in [
+            ('classname', test_result.group),
+            ('name', test_result.name),
+            ('time', '%.6f' % duration if duration is not None else '0'),
+            ('worker', test_result.worker)])
+        if test_result.is_error:
+            body = u'<error message="crashed">%s</error>' % saxutils.escape(_to_unicode(test_result.formatted_message))
+        elif test_result.is_failure:
+            body = u'<failure message="failed">%s</failure>' % saxutils.escape(_to_unicode(test_result.formatted_message))
+        elif test_result.skipped:
+            body = u'<skipped message=%s/>' % saxutils.quoteattr(_to_unicode(test_result.skipped_reason))
+        else:
+            body = u''
+        self._write(u'<testcase %s>%s</testcase>\n' % (attributes, body))
+
+    def close(self):
+        self._write(u'</testsuite>\n')
+        super(JUnitXMLReporter, self).close()
+
+REPORTERS = {'jsonl': JSONLinesReporter, 'junit': JUnitXMLReporter}
+
+def make_reporter(spec):
+    """Make a reporter from a "FORMAT:PATH" string like "junit:results.xml"
+
+    PATH "-" writes to stdout.
+    """
+    format, _, path = spec.partition(':')
+    if format not in REPORTERS or not path:
+        raise ValueError("unexpected report (expected FORMAT:PATH with FORMAT one of %s)" % ', '.join(sorted(REPORTERS)), spec)
+    file = sys.stdout if path == '-' else open(path, 'w')
+    return REPORTERS[format](file)
+
+class RunMetrics(object):
+    """Live measurements of a test run
+
+    The runners update these as tests are queued and finish, and they can be
+    read from other threads at any time with snapshot() (see MetricsExporter).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.statuses = collections.Counter()
+        # worker name to the seconds it spent running tests which have finished
+        self.busy = collections.Counter()
+        # (second, number of tests finished in it) for the last _METRICS_RATE_WINDOW seconds
+        self.recent = collections.deque()
+        # tests handed to the workers and tests held back waiting for resources
+        self.in_flight = 0
+        self.waiting = 0
+        # function returning the (worker name, test case, started at) of each running test
+        self.running_tests = lambda: []
+
+    def test_finished(self, test_result):
+        second = int(time.time())
+        with self.lock:
+            self.statuses[test_result.status] += 1
+            if test_result.worker and test_result.duration_seconds is not None:
+                self.busy[test_result.worker] += test_result.duration_seconds
+            if self.recent and self.recent[-1][0] == second:
+                self.recent[-1][1] += 1
+            else:
+                self.recent.append([second, 1])
+                while self.recent[0][0] <= second - _METRICS_RATE_WINDOW:
+                    self.recent.popleft()
+
+    def snapshot(self, top=DEFAULT_METRICS_TOP):
+        """Get the current measurements as a dictionary
+
+        Workers are idle when they aren't running a test, from the start of
+        the run.  The top longest running tests are listed.
+        """
+        now = time.time()
+        running = sorted(((now - started_at, worker, test_case.group_and_name())
+            for worker, test_case, started_at in self.running_tests()), reverse=True)
+        with self.lock:
+            statuses = dict(self.statuses)
+            busy = dict(self.busy)
+            recent = sum(count for second, count in self.recent if second > now - _METRICS_RATE_WINDOW)
+        elapsed = now - self.started_at
+        running_seconds = dict((worker, seconds) for seconds, worker, name in running)
+        workers = {}
+        for worker in set(busy) | set(running_seconds):
+            worker_busy = busy.get(worker, 0.0) + running_seconds.get(worker, 0.0)
+            workers[worker] = {'busy': worker_busy, 'idle': max(elapsed - worker_busy, 0.0),
+                    'running': worker in running_seconds}
+        finished = sum(statuses.values())
+        return {'elapsed': elapsed,
+                'finished': finished,
+                'statuses': statuses,
+                'tests_per_second': finished / elapsed if elapsed > 0 else 0.0,
+                'recent_tests_per_second': recent / min(_METRICS_RATE_WINDOW, elapsed) if elapsed > 0 else 0.0,
+                'in_flight': self.in_flight,
+                'queued': max(self.in_flight - len(running), 0) + self.waiting,
+                'workers': workers,
+                'slowest_running': [{'worker': worker, 'test': name, 'seconds': seconds}
+                    for seconds, worker, name in running[:top]]}
+
+def _prometheus_label(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+def prometheus_text(snapshot):
+    """Format a RunMetrics snapshot in the Prometheus text exposition format"""
+    lines = []
+    def add(name, kind, description, samples):
+        lines.append(u'# HELP qa_%s %s' % (name, description))
+        lines.append(u'# TYPE qa_%s %s' % (name, kind))
+        for labels, value in samples:
+            label_text = u','.join(u'%s="%s"' % (key, _prometheus_label(label)) for key, label in labels)
+            lines.append(u'qa_%s%s %r' % (name, u'{%s}' % label_text if labels else u'', float(value)))
+    add('run_seconds', 'gauge', 'Seconds since the run started', [((), snapshot['elapsed'])])
+    add('tests_total', 'counter', 'Tests which have finished by status',
+            [((('status', status), ), count) for status, count in sorted(snapshot['statuses'].items())])
+    add('tests_per_second', 'gauge', 'Tests finished per second over the whole run and the last minute',
+            [((('window', 'run'), ), snapshot['tests_per_second']),
+                ((('window', '%ds' % _METRICS_RATE_WINDOW), ), snapshot['recent_tests_per_second'])])
+    add('tests_in_flight', 'gauge', 'Tests handed to the workers', [((), snapshot['in_flight'])])
+    add('tests_queued', 'gauge', 'Tests waiting for a worker or for resources', [((), snapshot['queued'])])
+    workers = sorted(snapshot['workers'].items())
+    add('worker_busy_seconds_total', 'counter', 'Seconds each worker spent running tests',
+            [((('worker', worker), ), stats['busy']) for worker, stats in workers])
+    add('worker_idle_seconds_total', 'counter', 'Seconds each worker spent without a test since the run started',
+            [((('worker', worker), ), stats['idle']) for worker, stats in workers])
+    add('running_test_seconds', 'gauge', 'Seconds the longest running tests have been running',
+            [((('worker', test['worker']), ('test', test['test'])), test['seconds']) for test in snapshot['slowest_running']])
+    return u'\n'.join(lines) + u'\n'
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        snapshot = self.server.metrics.snapshot()
+        if self.path == '/metrics':
+            body = prometheus_text(snapshot).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path in ('/', '/stats'):
+            body = json.dumps(snapshot, indent=1, sort_keys=True)
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug('metrics request: ' + format, *args)
+
+class _MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class MetricsExporter(object):
+    """Publishes the RunMetrics of a run while it is going
+
+    Arguments
+    metrics -- RunMetrics
+    path -- path of a Prometheus text file to rewrite every interval seconds (for node_exporter's
+        textfile collector, for instance), or None
+    address -- (host, port) tuple to serve the metrics on over HTTP, or None.  /metrics serves the
+        Prometheus format and /stats JSON.
+    interval -- float, seconds between rewrites of the file
+    """
+    def __init__(self, metrics, path=None, address=None, interval=DEFAULT_METRICS_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.address = address
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.writer = None
+        self.server = None
+
+    def start(self):
+        if self.address is not None:
+            self.server = _MetricsServer(self.address, _MetricsHandler)
+            self.server.metrics = self.metrics
+            _log.info('serving run metrics on http://%s:%d/metrics', *self.server.server_address)
+            server_thread = threading.Thread(target=self.server.serve_forever, name='qa-metrics-server')
+            server_thread.daemon = True
+            server_thread.start()
+        if self.path is not None:
+            self.writer = threading.Thread(target=self._write_periodically, name='qa-metrics-writer')
+            self.writer.daemon = True
+            self.writer.start()
+
+    def _write_periodically(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Atomically replace the metrics file"""
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(prometheus_text(self.metrics.snapshot()).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+
+    def stop(self):
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def _parse_shard(shard):
+    """Parse an "INDEX/TOTAL" string into an (index, total) tuple"""
+    try:
+        index, total = map(int, shard.split('/'))
+    except ValueError:
+        raise ValueError("unexpected shard (expected INDEX/TOTAL)", shard)
+    if not 1 <= index <= total:
+        raise ValueError("unexpected shard (expected 1 <= INDEX <= TOTAL)", shard)
+    return index, total
+
+def _parse_num_workers(num_workers):
+    """Parse a "WORKERS" or "PROCESSESxTHREADS" string into an int or a (processes, threads) tuple"""
+    parts = map(int, num_workers.lower().split('x'))
+    if len(parts) > 2 or min(parts) < 1:
+        raise ValueError("unexpected number of workers (expected WORKERS or PROCESSESxTHREADS)", num_workers)
+    return parts[0] if len(parts) == 1 else tuple(parts)
+
+def _parse_resource(resource):
+    """Parse a "NAME=N" string into a (name, units) tuple"""
+    name, _, units = resource.partition('=')
+    if not name or int(units) < 1:
+        raise ValueError("unexpected resource (expected NAME=N)", resource)
+    return name, int(units)
+
+def _estimated_durations(test_cases, durations):
+    """Get the recorded duration of each test case, using the mean for tests without one"""
+    if not durations:
+        durations = {}
+    durations = _with_row_durations(test_cases, durations)
+    known = [durations[t.group_and_name()] for t in test_cases if t.group_and_name() in durations]
+    default = sum(known) / len(known) if known else 1.0
+    return [durations.get(t.group_and_name(), default) for t in test_cases]
+
+def partition_test_cases(test_cases, total, strategy=SHARD_STABLE, durations=None):
+    """Split test cases into total disjoint shards
+
+    The split only depends on the test names (and, for SHARD_BALANCED, their
+    durations) so separate processes which see the same tests agree on it.
+
+    Arguments
+    test_cases -- iterable of TestCase
+    total -- int, the number of shards
+    strategy -- SHARD_STABLE to assign tests by a hash of group_and_name(), or SHARD_BALANCED to assign
+        the longest remaining test to the shard with the least predicted time
+    durations -- dictionary of test name to seconds (see load_durations)
+
+    Returns
+    a list of total lists of TestCase, each in the original order
+    """
+    test_cases = list(test_cases)
+    assignments = []
+    if strategy == SHARD_STABLE:
+        for test_case in test_cases:
+            assignments.append(int(hashlib.md5(test_case.group_and_name()).hexdigest(), 16) % total)
+    elif strategy == SHARD_BALANCED:
+        estimates = _estimated_durations(test_cases, durations)
+        assignments = [None] * len(test_cases)
+        loads = [0.0] * total
+        longest_first = sorted(range(len(test_cases)), key=lambda i: (-estimates[i], test_cases[i].group_and_name()))
+        for i in longest_first:
+            shard = min(range(total), key=lambda j: (loads[j], j))
+            assignments[i] = shard
+            loads[shard] += estimates[i]
+    else:
+        raise ValueError("unexpected shard strategy", strategy)
+    partitions = [[] for i in range(total)]
+    for test_case, shard in zip(test_cases, assignments):
+        partitions[shard].append(test_case)
+    return partitions
+
+def print_shard_plan(partitions, durations, file=None):
+    """Print the tests and predicted duration of each shard"""
+    if file is None:
+        file = sys.stdout
+    for i, partition in enumerate(partitions):
+        estimates = _estimated_durations(partition, durations)
+        file.write('shard %d/%d: %d tests, predicted %.2fs\n' % (i + 1, len(partitions), len(partition), sum(estimates)))
+        for test_case, estimate in zip(partition, estimates):
+            file.write('    %s %.2fs\n' % (test_case.group_and_name(), estimate))
+
+def load_durations(path):
+    """Load the test durations recorded by a previous run
+
+    Returns
+    dictionary of "group:name" to duration in seconds
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        _log.debug('no usable durations in %r', path)
+        return {}
+
+def _save_json(path, data):
+    """Atomically replace the file at path with data encoded as JSON"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=0, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def save_durations(path, durations):
+    """Atomically replace the durations file at path"""
+    _save_json(path, durations)
+
+def _record_durations(test_results, durations, path):
+    """Pass through a stream of test results, saving each test's duration when the stream ends"""
+    try:
+        for test_result in test_results:
+            if test_result.duration_seconds is not None:
+                durations[test_result.group_and_name] = test_result.duration_seconds
+            yield test_result
+    finally:
+        save_durations(path, durations)
+
+def load_benchmarks(path):
+    """Load the benchmark baseline
+
+    Returns
+    dictionary of "group:name" to benchmark statistics
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        _log.debug('no usable benchmark baseline in %r', path)
+        return {}
+
+def _record_benchmarks(test_results, baseline, path, update=False):
+    """Pass through a stream of test results, saving new benchmarks to the baseline when the stream ends
+
+    If update is set every passing benchmark replaces its baseline.
+    """
+    changed = False
+    try:
+        for test_result in test_results:
+            stats = test_result.extra.get('benchmark')
+            if stats is not None and test_result.is_success and (update or test_result.group_and_name not in baseline):
+                baseline[test_result.group_and_name] = stats
+                changed = True
+            yield test_result
+    finally:
+        if changed:
+            _save_json(path, baseline)
+
+def load_failed(path):
+    """Load the names of the tests which failed or crashed the last time they ran
+
+    Returns
+    set of "group:name"
+    """
+    try:
+        with open(path) as f:
+            return set(json.load(f))
+    except (IOError, ValueError):
+        _log.debug('no usable failed tests in %r', path)
+        return set()
+
+def _record_failed(test_results, failed, path):
+    """Pass through a stream of test results, saving the tests which failed or crashed when the stream ends
+
+    Tests which didn't run keep their previous state.
+    """
+    try:
+        for test_result in test_results:
+            if test_result.is_error or test_result.is_failure:
+                failed.add(test_result.group_and_name)
+            elif test_result.is_success:
+                failed.discard(test_result.group_and_name)
+            yield test_result
+    finally:
+        _save_json(path, sorted(failed))
+
+def _order_failed_first(test_cases, failed):
+    """Move test cases which failed last time ahead of the others, keeping the order otherwise
+
+    Tests which share requirement instances are kept together (see
+    _fixture_groups).  Groups with a failed test move ahead of the others and
+    their failed tests move to the front of the group.  A parametrized test
+    case failed if any of its rows did.
+    """
+    test_cases = list(test_cases)
+    failed = set(failed) | set(_row_names(test_cases, failed))
+    first = []
+    rest = []
+    for group in _fixture_groups(test_cases):
+        failed_tests = [t for t in group if t.group_and_name() in failed]
+        if failed_tests:
+            first.extend(failed_tests)
+            first.extend(t for t in group if t.group_and_name() not in failed)
+        else:
+            rest.extend(group)
+    return first + rest
+
+def _hold_back_benchmarks(test_cases, benchmarks):
+    """Pass through a stream of test cases, appending the benchmarks to the benchmarks list instead"""
+    for test_case in test_cases:
+        if test_case.benchmark is None:
+            yield test_case
         else:
-            _test_result_log.error('test %r %s:\n%s', result.group_and_name, result.status, result.formatted_message)
-    _test_result_log.info('executed ok: %d, errors: %d, failures: %d, skipped: %d', ok, errors, failures, skipped) 
+            benchmarks.append(test_case)
+
+def _run_in_turn(*streams):
+    """Yield the results of each stream of test results in turn
+
+    Closing this closes every stream, cancelling the tests which are still running.
+    """
+    try:
+        for test_results in streams:
+            for test_result in test_results:
+                yield test_result
+    finally:
+        for test_results in streams:
+            test_results.close()
+
+def _stop_after_failures(test_results, max_failures):
+    """Pass through a stream of test results until max_failures tests have failed or crashed
+
+    Closing the stream cancels the tests which are still running.
+    """
+    failures = 0
+    try:
+        for test_result in test_results:
+            yield test_result
+            if test_result.is_error or test_result.is_failure:
+                failures += 1
+                if failures >= max_failures:
+                    _test_run_log.warning('stopping after %d failed tests', failures)
+                    break
+    finally:
+        test_results.close()
+
+def _repeat_test_cases(test_cases, repeat):
+    # A list, so the users of shared requirements are counted once for each run
+    return [test_case for test_case in test_cases for i in xrange(repeat)]
+
+def _order_longest_first(test_cases, durations):
+    """Order test cases by their recorded duration, longest first
+
+    Tests which share requirement instances are kept together (see
+    _fixture_groups).  Groups are ordered by the total recorded duration of
+    their tests and the tests of a group by their own.  A parametrized test
+    case takes as long as its rows.  Tests and groups without a recorded
+    duration follow in their original order.
+    """
+    test_cases = list(test_cases)
+    durations = _with_row_durations(test_cases, durations)
+    known = []
+    unknown = []
+    for group in _fixture_groups(test_cases):
+        group_durations = [durations.get(t.group_and_name()) for t in group]
+        if all(duration is None for duration in group_durations):
+            unknown.extend(group)
+            continue
+        ordered = sorted((-(duration or 0.0), index, t) for index, (duration, t) in enumerate(zip(group_durations, group)))
+        known.append((-sum(duration or 0.0 for duration in group_durations), len(known),
+            [t for _, _, t in ordered]))
+    known.sort()
+    return [test_case for _, _, group in known for test_case in group] + unknown
+
+def _file_fingerprint(path):
+    """Get a [mtime, size, md5 hex digest] list for a file or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+    return [stat.st_mtime, stat.st_size, digest]
+
+class _FileFingerprints(object):
+    """Fingerprints of the current source files, computed at most once per file
+
+    A file is only hashed when its mtime or size differs from a recorded fingerprint.
+    """
+    def __init__(self):
+        self.stats = {}
+        self.fingerprints = {}
+
+    def get(self, path):
+        if path not in self.fingerprints:
+            self.fingerprints[path] = _file_fingerprint(path)
+        return self.fingerprints[path]
+
+    def changed(self, path, fingerprint):
+        if path not in self.stats:
+            try:
+                stat = os.stat(path)
+                self.stats[path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                self.stats[path] = None
+        if self.stats[path] is None or fingerprint is None:
+            return True
+        mtime, size, digest = fingerprint
+        if self.stats[path] == (mtime, size):
+            return False
+        current = self.get(path)
+        return current is None or current[2] != digest
+
+def load_impact_map(path):
+    """Load the record of which source files each test runs
+
+    Returns
+    dictionary of "group:name" to a dictionary of source path to the file's fingerprint when the test last passed
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        _log.debug('no usable impact map in %r', path)
+        return {}
+
+def select_impacted_test_cases(test_cases, impact_map, changed_paths=None):
+    """Select the test cases affected by source changes
+
+    A test case is selected if it has no record (new, or didn't pass last time) or if any file it ran changed.
+    Only the rows of a parametrized test case which are selected are run.
+
+    Arguments
+    test_cases -- iterable of TestCase
+    impact_map -- as returned by load_impact_map
+    changed_paths -- list of changed source paths.  If this is None, every recorded file is checked for
+        changes instead.
+    """
+    if changed_paths is not None:
+        changed_paths = set(os.path.abspath(p) for p in changed_paths)
+    fingerprints = _FileFingerprints()
+    def is_changed(path, fingerprint):
+        if changed_paths is not None:
+            return path in changed_paths
+        return fingerprints.changed(path, fingerprint)
+    def is_impacted(test_case):
+        files = impact_map.get(test_case.group_and_name())
+        return files is None or any(is_changed(path, fingerprint) for path, fingerprint in files.iteritems())
+    selected = []
+    for test_case in test_cases:
+        if test_case.params is not None:
+            # The rows are checked as they are expanded
+            selected.append(_add_param_filter(test_case, is_impacted))
+        elif is_impacted(test_case):
+            selected.append(test_case)
+    _test_run_log.debug('selected %d test cases affected by changes', len(selected))
+    return selected
+
+def _record_impact(test_results, impact_map, path):
+    """Pass through a stream of test results, saving the files each test ran when the stream ends
+
+    Tests which did not pass are forgotten so they are selected again on the next run.
+    """
+    fingerprints = _FileFingerprints()
+    try:
+        for test_result in test_results:
+            files = test_result.extra.get('files')
+            if test_result.is_success and files is not None:
+                impact_map[test_result.group_and_name] = dict((f, fingerprints.get(f)) for f in files)
+            elif not test_result.skipped:
+                impact_map.pop(test_result.group_and_name, None)
+            yield test_result
+    finally:
+        _save_json(path, impact_map)
+
+def _hash_function(function, digest, seen=None):
+    """Hash the code of a function and the values of its default arguments and closure
+
+    Functions among the values are hashed the same way, so a
+    contextlib.contextmanager helper hashes the generator function it wraps.
+    Other values are hashed by their repr, so tests made by a factory differ
+    by the values they captured.  A value whose repr changes from run to run
+    (like the default repr, which shows the object's address) keeps the test
+    from ever being served from the cache.
+    """
+    if seen is None:
+        seen = set()
+    if function in seen:
+        return
+    seen.add(function)
+    if isinstance(function, functools.partial):
+        values = (function.func, ) + function.args + tuple(sorted((function.keywords or {}).items()))
+    else:
+        code = getattr(function, 'func_code', None)
+        if code is None:
+            digest.update(repr(function))
+            return
+        _hash_code(code, digest)
+        values = list(function.func_defaults or ())
+        for cell in function.func_closure or ():
+            try:
+                values.append(cell.cell_contents)
+            except ValueError:
+                values.append(None)
+    for value in values:
+        if isinstance(value, (types.FunctionType, functools.partial)):
+            _hash_function(value, digest, seen)
+        else:
+            digest.update(repr(value))
+
+def _hash_code(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names))
+    digest.update(repr(code.co_varnames))
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            _hash_code(const, digest)
+        else:
+            digest.update(repr(const))
+
+class ResultCache(object):
+    """A directory of passing test results keyed by a hash of the test's code
+
+    The key of a test hashes the code of its callable and its requirements,
+    the values of their default arguments and closures (see _hash_function),
+    and the source of their modules and of the modules those import which
+    live under root (the current directory by default).  The key of a row of
+    a parametrized test case also hashes the repr of the row.
+
+    Each result is stored in its own file, written to a temporary name and
+    renamed into place, so several runs can share the directory.  prune()
+    removes the least recently used results beyond max_entries.
+    """
+    def __init__(self, directory, max_entries=DEFAULT_CACHE_SIZE, root=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.root = os.path.abspath(os.getcwd() if root is None else root) + os.sep
+        self.fingerprints = _FileFingerprints()
+        self.module_files = {}
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _module_files(self, module_name):
+        """Get the source files of a module and of the project modules it imports"""
+        if module_name in self.module_files:
+            return self.module_files[module_name]
+        files = self.module_files[module_name] = set()
+        pending = [sys.modules.get(module_name)]
+        seen = set()
+        while pending:
+            module = pending.pop()
+            if module is None or id(module) in seen:
+                continue
+            seen.add(id(module))
+            filename = getattr(module, '__file__', None)
+            if filename is None:
+                continue
+            path = os.path.abspath(filename)
+            if path.endswith(('.pyc', '.pyo')):
+                path = path[:-1]
+            if module.__name__ != module_name and not path.startswith(self.root):
+                continue
+            files.add(path)
+            for value in vars(module).values():
+                if isinstance(value, type(sys)):
+                    pending.append(value)
+                else:
+                    value_module = getattr(value, '__module__', None)
+                    if isinstance(value_module, basestring):
+                        pending.append(sys.modules.get(value_module))
+        return files
+
+    def key(self, test_case):
+        """Get the key of a test case, or None if it can't be cached
+
+        A row of a parametrized test case can only be cached if its repr reads
+        back as the same row, so the repr is the same in every run.
+        """
+        template = getattr(test_case, 'template', None)
+        if template is not None and not _is_literal_row(test_case.param_row):
+            return None
+        digest = hashlib.md5()
+        digest.update(sys.version)
+        name = test_case.group_and_name()
+        digest.update(name.encode('utf-8') if isinstance(name, unicode) else name)
+        if template is not None:
+            digest.update(repr(test_case.param_row))
+        module_names = set()
+        for function in ((template or test_case).callable, ) + test_case.requires:
+            _hash_function(function, digest)
+            module_name = getattr(function, '__module__', None)
+            if module_name is not None:
+                module_names.add(module_name)
+        files = set()
+        for module_name in module_names:
+            files.update(self._module_files(module_name))
+        for path in sorted(files):
+            fingerprint = self.fingerprints.get(path)
+            digest.update(path)
+            digest.update(fingerprint[2] if fingerprint is not None else '')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Get the cached test result for a key or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                test_result = pickle.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        test_result.cached = True
+        return test_result
+
+    def put(self, key, test_result):
+        """Cache a test result.  A result which can't be saved is left out, as if it had never been cached."""
+        path = self._path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(test_result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as error:
+            # Another run's prune() may have removed the file while it was written
+            _log.debug('could not cache the result of %s: %s', test_result.group_and_name, error)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def prune(self):
+        """Remove the least recently used results beyond max_entries
+
+        Results which are still being written are left alone.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        entries.sort(reverse=True)
+        for mtime, path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _is_literal_row(row):
+    """Check whether the repr of a row of parameters reads back as the same row"""
+    try:
+        return ast.literal_eval(repr(row)) == row
+    except (ValueError, SyntaxError):
+        return False
+
+def _run_test_cases_cached(test_cases, cache, run, plugins):
+    """Yield cached results for unchanged passing tests and run the rest with run
+
+    Tests which are skipped (by themselves or by a plugin) are left to run to
+    report, and benchmarks always run.  The rows of a parametrized test case
+    are looked up one by one and only the rows without a cached result are
+    run, unless its params are an iterator, which can only be read once.
+    """
+    # group_and_name to key, or None for a name which more than one test has
+    keys = {}
+    def lookup(test_case):
+        if _is_skip_test_case(test_case, plugins) is not None:
+            return None
+        key = cache.key(test_case)
+        if key is None:
+            return None
+        test_result = cache.get(key)
+        if test_result is None:
+            name = test_case.group_and_name()
+            keys[name] = None if name in keys else key
+        return test_result
+
+    misses = []
+    for test_case in test_cases:
+        if test_case.benchmark is not None:
+            misses.append(test_case)
+        elif test_case.params is None:
+            test_result = lookup(test_case)
+            if test_result is not None:
+                yield test_result
+            else:
+                misses.append(test_case)
+        elif callable(test_case.params) or iter(test_case.params) is not test_case.params:
+            uncached = set()
+            for param_test_case in expand_test_case(test_case):
+                test_result = lookup(param_test_case)
+                if test_result is not None:
+                    yield test_result
+                else:
+                    uncached.add(param_test_case.param_index)
+            if uncached:
+                misses.append(_add_param_filter(test_case,
+                    lambda param_test_case, uncached=uncached: param_test_case.param_index in uncached))
+        else:
+            misses.append(test_case)
+    try:
+        for test_result in run(misses):
+            key = keys.get(test_result.group_and_name)
+            if key is not None and test_result.is_success:
+                cache.put(key, test_result)
+            yield test_result
+    finally:
+        cache.prune()
+
+def _project_modules(root):
+    """Get the imported modules whose source files are under root, other than qa itself
+
+    Returns
+    dictionary of module name to the path of its source file
+    """
+    root = os.path.abspath(root) + os.sep
+    this_module = sys.modules.get(__name__)
+    modules = {}
+    for name, module in sys.modules.items():
+        if module is None or module is this_module or name in ('__main__', '_qa_globals'):
+            continue
+        filename = getattr(module, '__file__', None)
+        if filename is None:
+            continue
+        path = os.path.abspath(filename)
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        if path.startswith(root):
+            modules[name] = path
+    return modules
+
+def _module_dependencies(module, module_names):
+    """Get the names of the modules in module_names which a module refers to"""
+    dependencies = set()
+    for value in vars(module).values():
+        if isinstance(value, type(sys)):
+            name = value.__name__
+        else:
+            name = getattr(value, '__module__', None)
+        if isinstance(name, basestring) and name in module_names and name != module.__name__:
+            dependencies.add(name)
+    return dependencies
+
+def _test_case_modules(test_case):
+    """Get the names of the modules which define a test case's function and requirements"""
+    names = set(getattr(function, '__module__', None) for function in (test_case.callable, ) + test_case.requires)
+    names.discard(None)
+    return names
+
+def reload_changed_modules(changed_paths, root):
+    """Reload the modules under root whose source files changed and the modules which use them
+
+    Modules are reloaded after the modules they use.  The registered test
+    cases of a reloaded module are replaced by the ones it registers again.
+    A module which fails to reload keeps its old test cases.
+
+    Returns
+    set of the names of the reloaded modules
+    """
+    modules = _project_modules(root)
+    changed_paths = set(os.path.abspath(path) for path in changed_paths)
+    dependencies = dict((name, _module_dependencies(sys.modules[name], modules)) for name in modules)
+    affected = set(name for name, path in modules.items() if path in changed_paths)
+    pending = list(affected)
+    while pending:
+        changed_name = pending.pop()
+        for name, uses in dependencies.items():
+            if changed_name in uses and name not in affected:
+                affected.add(name)
+                pending.append(name)
+    registry = _qa_globals.all_test_cases
+    defined_in = lambda test_case, name: getattr(test_case.callable, '__module__', None) == name
+    reloaded = set()
+    remaining = set(affected)
+    while remaining:
+        # Modules which import each other are reloaded in name order
+        ready = sorted(name for name in remaining if not dependencies[name] & remaining) or sorted(remaining)[:1]
+        for name in ready:
+            remaining.discard(name)
+            old_test_cases = [t for t in registry if defined_in(t, name)]
+            registry[:] = [t for t in registry if not defined_in(t, name)]
+            # The compiled file only records the source's modification time in whole seconds
+            try:
+                os.remove(modules[name] + 'c')
+            except OSError:
+                pass
+            try:
+                reload(sys.modules[name])
+            except Exception:
+                _log.exception('could not reload %s', name)
+                registry[:] = [t for t in registry if not defined_in(t, name)] + old_test_cases
+            else:
+                reloaded.add(name)
+    return reloaded
+
+class _PollingWatcher(object):
+    """Watches the source files of the imported modules under root by checking them every interval seconds"""
+    def __init__(self, root, interval=DEFAULT_WATCH_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.stats = self._stat_all()
+
+    def _stat_all(self):
+        stats = {}
+        for path in _project_modules(self.root).values():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (stat.st_mtime, stat.st_size)
+        return stats
+
+    def _changes(self):
+        stats = self._stat_all()
+        changed = set(path for path, stat in stats.items() if self.stats.get(path, stat) != stat)
+        self.stats = stats
+        return changed
+
+    def wait(self):
+        """Wait until source files change
+
+        Returns
+        set of the paths of the changed files
+        """
+        while True:
+            changed = self._changes()
+            if changed:
+                time.sleep(_WATCH_SETTLE_TIME)
+                return changed | self._changes()
+            time.sleep(self.interval)
+
+class _InotifyWatcher(object):
+    """Watches the source files of the imported modules under root with inotify"""
+    def __init__(self, root):
+        self.root = root
+        self.changed = set()
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, default_proc_fun=self._record)
+        self.watch_manager.add_watch(root, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True, auto_add=True,
+                exclude_filter=lambda path: os.path.basename(path).startswith('.'))
+
+    def _record(self, event):
+        if event.pathname.endswith('.py'):
+            self.changed.add(os.path.abspath(event.pathname))
+
+    def _read_events(self, timeout):
+        if not self.notifier.check_events(timeout=timeout):
+            return False
+        self.notifier.read_events()
+        self.notifier.process_events()
+        return True
+
+    def wait(self):
+        """Wait until source files change
+
+        Returns
+        set of the paths of the changed files
+        """
+        while True:
+            self._read_events(None)
+            while self._read_events(int(_WATCH_SETTLE_TIME * 1000)):
+                pass
+            changed = self.changed & set(_project_modules(self.root).values())
+            self.changed = set()
+            if changed:
+                return changed
+
+def _make_watcher(root, interval=DEFAULT_WATCH_INTERVAL):
+    """Make a watcher of the source files under root, using inotify if pyinotify is installed"""
+    if pyinotify is not None:
+        return _InotifyWatcher(root)
+    return _PollingWatcher(root, interval=interval)
 
 class Plugin(object):
     """Abstract Plugin class"""
@@ -596,6 +4065,10 @@ class Plugin(object):
         """This is called whenever a test case is about to be run"""
         pass
 
+    def did_call_test_case(self, test_case, context):
+        """This is called when the test case function returns or raises, before its requirements are torn down"""
+        pass
+
     def did_run_test_case(self, test_case, test_result, context):
         """This is called whenever a test case is run with the test result dictionary"""
         pass
@@ -605,15 +4078,19 @@ class Plugin(object):
         pass
 
     def will_fork(self):
+        """This is called in the parent before each process worker is forked"""
         pass
 
     def did_fork(self):
+        """This is called in each new process worker before it runs any tests, for instance to reconnect or reseed"""
         pass
 
     def will_clone(self):
+        """This is called before each thread worker is started"""
         pass
 
     def did_clone(self):
+        """This is called in each new thread worker before it runs any tests"""
         pass
 
     def extra_test_case_requirements(self, test_case):
@@ -627,5 +4104,400 @@ class Plugin(object):
         """
         return []
 
+class ImpactPlugin(Plugin):
+    """Records the source files each test runs in test_result.extra['files']
+
+    Files are recorded when a function in them is called while the test and
+    its requirements run.  Only files under root (the current directory by
+    default) are recorded.  Files are traced with sys.settrace, which is per
+    thread, so this can't be used in async mode where tests share a thread.
+    """
+    def __init__(self, root=None):
+        self.root = os.path.abspath(os.getcwd() if root is None else root) + os.sep
+
+    def extra_test_case_requirements(self, test_case):
+        return [self._trace_files]
+
+    @contextlib.contextmanager
+    def _trace_files(self, context):
+        files = set()
+        code_seen = set()
+        def trace(frame, event, arg):
+            code = frame.f_code
+            if code not in code_seen:
+                code_seen.add(code)
+                files.add(code.co_filename)
+            return None
+        previous_trace = sys.gettrace()
+        sys.settrace(trace)
+        try:
+            yield
+        finally:
+            sys.settrace(previous_trace)
+            context['_qa_impact_files'] = files
+
+    def did_run_test_case(self, test_case, test_result, context):
+        files = context.get('_qa_impact_files')
+        if files is None:
+            return
+        paths = set()
+        for filename in files:
+            path = os.path.abspath(filename)
+            if path.endswith(('.pyc', '.pyo')):
+                path = path[:-1]
+            if path.startswith(self.root) and os.path.exists(path):
+                paths.add(path)
+        test_result.extra['files'] = sorted(paths)
+
+class BenchmarkPlugin(Plugin):
+    """Records benchmark statistics in test_result.extra['benchmark'] and compares them to a baseline
+
+    Arguments
+    baseline -- dictionary of "group:name" to the statistics of a previous run (see load_benchmarks)
+    threshold -- float, the fraction by which a benchmark's median time may exceed its baseline's
+    """
+    def __init__(self, baseline=None, threshold=DEFAULT_BENCHMARK_THRESHOLD):
+        self.baseline = {} if baseline is None else baseline
+        self.threshold = threshold
+
+    def will_run_test_case(self, test_case, context):
+        if test_case.benchmark is not None:
+            context['_qa_benchmark_baseline'] = self.baseline.get(test_case.group_and_name())
+            context['_qa_benchmark_threshold'] = self.threshold
+
+    def did_run_test_case(self, test_case, test_result, context):
+        stats = context.get('_qa_benchmark')
+        if stats is not None:
+            test_result.extra['benchmark'] = stats
+
+class ProfilePlugin(Plugin):
+    """Profiles each test with cProfile
+
+    Each test's profile is saved to DIRECTORY/GROUP:NAME.PID.N.prof, where N
+    counts the profiles the process has saved so repeated runs of a test
+    don't overwrite each other, and its path is recorded in
+    test_result.extra['profile'] (see merge_profiles).  Only one
+    profiler can run on a thread at a time, so in async mode a test which
+    starts while another test on the event loop is being profiled isn't
+    profiled.
+
+    Arguments
+    directory -- path of the directory to save profiles in
+    fixtures -- bool, also profile the setup and teardown of the test's requirements
+    """
+    def __init__(self, directory, fixtures=False):
+        self.directory = directory
+        self.fixtures = fixtures
+        self.counter = itertools.count()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def extra_test_case_requirements(self, test_case):
+        if self.fixtures:
+            return [self._profile_requirements]
+        return []
+
+    @contextlib.contextmanager
+    def _profile_requirements(self, context):
+        self._start(context)
+        try:
+            yield
+        finally:
+            self._stop(context)
+
+    def will_run_test_case(self, test_case, context):
+        if not self.fixtures:
+            self._start(context)
+
+    def did_call_test_case(self, test_case, context):
+        if not self.fixtures:
+            self._stop(context)
+
+    def _start(self, context):
+        if sys.getprofile() is None:
+            profile = cProfile.Profile()
+            context['_qa_profile'] = profile
+            profile.enable()
+
+    def _stop(self, context):
+        profile = context.get('_qa_profile')
+        if profile is not None:
+            profile.disable()
+
+    def did_run_test_case(self, test_case, test_result, context):
+        profile = context.get('_qa_profile')
+        if profile is None:
+            return
+        path = os.path.join(self.directory, '%s.%d.%d.prof' % (re.sub(r'[^\w.:-]+', '_', test_case.group_and_name()),
+            os.getpid(), next(self.counter)))
+        profile.dump_stats(path)
+        test_result.extra['profile'] = path
+
+def _resident_memory():
+    """Get the resident memory of the current process in bytes, or None if it is unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def _peak_resident_memory():
+    """Get the most resident memory the current process has used in bytes, or None if it is unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and OS X reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _count_objects(exclude=()):
+    """Count the live objects tracked by the garbage collector by type name
+
+    Arguments
+    exclude -- objects of the measurement itself, which aren't counted
+    """
+    gc.collect()
+    excluded = set(id(o) for o in exclude)
+    return collections.Counter(type(o).__name__ for o in gc.get_objects() if id(o) not in excluded)
+
+class MemoryPlugin(Plugin):
+    """Records the memory each test retains in test_result.extra['memory']
+
+    Memory is measured before the test's requirements are set up and after
+    they are torn down:
+
+    retained -- growth of resident memory in bytes
+    peak_rss -- the process's peak resident memory in bytes after the test
+    peak_growth -- how much the test raised the peak
+    objects -- growth of the number of objects tracked by the garbage collector
+    top_types -- list of [type name, growth] of the types whose count grew most
+
+    The numbers are for the whole process, so they include whatever other
+    tests running at the same time did.
+
+    Arguments
+    threshold -- int, fail tests which retain more than this many bytes of resident memory
+    leak_check -- int, rerun each passing test this many times after it has run (setting up its
+        test-scoped requirements each time) and fail it if the number of objects grows after every rerun.
+        This is 0 to skip the check or at least MIN_LEAK_CHECK, since one growth could just be a cache filling.
+    top -- int, the number of types to record in top_types
+    """
+    def __init__(self, threshold=None, leak_check=0, top=DEFAULT_MEMORY_TOP):
+        if leak_check and leak_check < MIN_LEAK_CHECK:
+            raise ValueError("unexpected leak check (expected 0 or at least %d reruns)" % MIN_LEAK_CHECK, leak_check)
+        self.threshold = threshold
+        self.leak_check = leak_check
+        self.top = top
+
+    def extra_test_case_requirements(self, test_case):
+        return [functools.partial(self._measure, test_case)]
+
+    @contextlib.contextmanager
+    def _measure(self, test_case, context):
+        objects = _count_objects()
+        rss = _resident_memory()
+        peak = _peak_resident_memory()
+        try:
+            yield
+        finally:
+            objects_after = _count_objects(exclude=[objects])
+            rss_after = _resident_memory()
+            peak_after = _peak_resident_memory()
+            growth = objects_after - objects
+            context['_qa_memory'] = {
+                    'retained': rss_after - rss if rss is not None and rss_after is not None else None,
+                    'peak_rss': peak_after,
+                    'peak_growth': peak_after - peak if peak is not None else None,
+                    'objects': sum(objects_after.values()) - sum(objects.values()),
+                    'top_types': [[name, count] for name, count in growth.most_common(self.top)]}
+
+    def _check_for_leaks(self, test_case, context):
+        """Rerun a test leak_check times and count the live objects after each rerun
+
+        The reruns happen after the test, outside its timeout, and share its
+        group, worker and session requirement instances, which are kept alive
+        for them.  They run without plugins, so they aren't measured, profiled
+        or traced themselves.
+        """
+        fixture_scopes = context['_qa_fixture_scopes']
+        for requirement in test_case.requires:
+            fixture_scope = fixture_scopes.get(_fixture_scope(requirement))
+            if fixture_scope is not None:
+                fixture_scope.add_users(_fixture_key(requirement, test_case), self.leak_check)
+        counts = []
+        for i in range(self.leak_check):
+            _run_test_case(test_case, [], fixture_scopes)
+            counts.append(sum(_count_objects(exclude=[counts]).values()))
+        return counts
+
+    def did_run_test_case(self, test_case, test_result, context):
+        memory = context.get('_qa_memory')
+        if memory is None:
+            return
+        test_result.extra['memory'] = memory
+        if not test_result.is_success:
+            return
+        counts = None
+        if self.leak_check:
+            counts = memory['leak_check'] = self._check_for_leaks(test_case, context)
+        if counts is not None and all(a < b for a, b in zip(counts, counts[1:])):
+            test_result.failure_msg = 'leak: the number of live objects grew after each of %d runs: %s' % (
+                    len(counts), ', '.join(str(count) for count in counts))
+        elif self.threshold is not None and memory['retained'] is not None and memory['retained'] > self.threshold:
+            test_result.failure_msg = 'retained %s of resident memory, more than the threshold of %s' % (
+                    _format_bytes(memory['retained']), _format_bytes(self.threshold))
+
+def merge_profiles(test_results, directory, top=DEFAULT_PROFILE_TOP, file=None):
+    """Pass through a stream of test results, merging the tests' profiles when the stream ends
+
+    The merged profile is saved to DIRECTORY/all.prof and the top functions
+    by cumulative time across the whole run are printed to file.
+
+    Arguments
+    test_results -- stream of test results run with ProfilePlugin
+    directory -- path of the directory to save the merged profile in
+    top -- int, the number of functions to print
+    file -- the file to print to.  This defaults to stdout.
+    """
+    paths = collections.OrderedDict()
+    try:
+        for test_result in test_results:
+            path = test_result.extra.get('profile')
+            if path is not None and not test_result.cached and os.path.exists(path):
+                paths[path] = True
+            yield test_result
+    finally:
+        if paths:
+            stats = pstats.Stats(*paths, stream=file if file is not None else sys.stdout)
+            stats.dump_stats(os.path.join(directory, 'all.prof'))
+            stats.sort_stats('cumulative').print_stats(top)
+
+def write_trace(test_results, path):
+    """Pass through a stream of test results, saving their timeline as Chrome trace events when the stream ends
+
+    The file can be opened in chrome://tracing or Perfetto.  Each worker gets
+    a track in its process's group with a span for each test and spans for its
+    requirements' setup and teardown, its call and the plugin hooks nested in
+    it.  Tests which didn't record a trace (like tests whose worker crashed)
+    are shown as a single span.
+
+    Arguments
+    test_results -- stream of test results run with trace=True
+    path -- path of the file to save the trace events to
+    """
+    spans = []
+    pids = {}
+    try:
+        for test_result in test_results:
+            if not (test_result.cached or test_result.skipped or test_result.started_at_seconds is None
+                    or test_result.ended_at_seconds is None):
+                trace = test_result.extra.get('trace')
+                if trace is not None:
+                    pids[test_result.worker] = trace['pid']
+                    spans.append((test_result.worker, test_result.status, trace['spans']))
+                else:
+                    spans.append((test_result.worker, test_result.status, [(test_result.group_and_name, 'test',
+                        test_result.started_at_seconds, test_result.ended_at_seconds)]))
+            yield test_result
+    finally:
+        if spans:
+            _save_json(path, {'traceEvents': _trace_events(spans, pids), 'displayTimeUnit': 'ms'})
+
+def _trace_events(spans, pids):
+    start = min(started_at for worker, status, test_spans in spans for name, category, started_at, ended_at in test_spans)
+    tids = {}
+    events = []
+    for worker, status, test_spans in spans:
+        pid = pids.get(worker, os.getpid())
+        if worker not in tids:
+            tids[worker] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tids[worker], 'args': {'name': worker}})
+        for name, category, started_at, ended_at in test_spans:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tids[worker],
+                    'ts': (started_at - start) * 1e6, 'dur': (ended_at - started_at) * 1e6}
+            if category == 'test' and name != 'call':
+                event['args'] = {'status': status}
+            events.append(event)
+    for pid in set(pids.values()) | set([os.getpid()]):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': 'qa' if pid == os.getpid() else 'qa worker %d' % pid}})
+    return events
+
+def stress_report(test_results, json_path=None, file=None):
+    """Pass through a stream of test results of repeated tests, summarizing each test's runs when the stream ends
+
+    For each test, the number of runs, the fraction which failed or crashed,
+    the 50th, 90th and 99th percentile and maximum durations and the runs
+    per second from its first start to its last end are printed as a table.
+    Runs without a start or end time, such as those which crashed before the
+    test started, are counted but left out of the durations.
+
+    Arguments
+    test_results -- stream of test results
+    json_path -- path of a file to also save the summary to as JSON, or None
+    file -- the file to print to.  This defaults to stdout.
+    """
+    runs = collections.OrderedDict()
+    try:
+        for test_result in test_results:
+            if not test_result.skipped:
+                name = test_result.group_and_name
+                if name not in runs:
+                    runs[name] = [array.array('d'), 0, 0, None, None]
+                test_runs = runs[name]
+                test_runs[1] += 1
+                if test_result.duration_seconds is not None:
+                    if not test_runs[0]:
+                        test_runs[3:] = [test_result.started_at_seconds, test_result.ended_at_seconds]
+                    test_runs[0].append(test_result.duration_seconds)
+                    test_runs[3] = min(test_runs[3], test_result.started_at_seconds)
+                    test_runs[4] = max(test_runs[4], test_result.ended_at_seconds)
+                if test_result.is_error or test_result.is_failure:
+                    test_runs[2] += 1
+            yield test_result
+    finally:
+        if runs:
+            summary = _stress_summary(runs)
+            _print_stress_summary(summary, file if file is not None else sys.stdout)
+            if json_path is not None:
+                _save_json(json_path, summary)
+
+def _stress_summary(runs):
+    tests = collections.OrderedDict()
+    for name, (durations, num_runs, failures, started_at, ended_at) in runs.items():
+        durations = sorted(durations)
+        elapsed = ended_at - started_at if durations else 0.0
+        tests[name] = {'runs': num_runs,
+                'failures': failures,
+                'failure_rate': float(failures) / num_runs,
+                'p50': _percentile(durations, 0.5) if durations else None,
+                'p90': _percentile(durations, 0.9) if durations else None,
+                'p99': _percentile(durations, 0.99) if durations else None,
+                'max': durations[-1] if durations else None,
+                'throughput': len(durations) / elapsed if elapsed > 0 else 0.0}
+    timed = [test_runs for test_runs in runs.values() if test_runs[0]]
+    elapsed = max(test_runs[4] for test_runs in timed) - min(test_runs[3] for test_runs in timed) if timed else 0.0
+    total_runs = sum(test['runs'] for test in tests.values())
+    total_failures = sum(test['failures'] for test in tests.values())
+    return {'tests': tests,
+            'runs': total_runs,
+            'failures': total_failures,
+            'failure_rate': float(total_failures) / total_runs,
+            'seconds': elapsed,
+            'throughput': total_runs / elapsed if elapsed > 0 else 0.0}
+
+def _print_stress_summary(summary, file):
+    width = max(len('test'), max(len(name) for name in summary['tests']))
+    row = u'%-*s %8s %7s %9s %9s %9s %9s %9s\n'
+    file.write(row % (width, 'test', 'runs', 'failed', 'p50', 'p90', 'p99', 'max', 'runs/s'))
+    for name, test in summary['tests'].items():
+        file.write(row % (width, name, test['runs'], '%.1f%%' % (100 * test['failure_rate']),
+            _format_stress_seconds(test['p50']), _format_stress_seconds(test['p90']),
+            _format_stress_seconds(test['p99']), _format_stress_seconds(test['max']), '%.1f' % test['throughput']))
+    file.write(u'%d runs in %s, %.1f runs/s, %.1f%% failed\n' % (summary['runs'], _format_seconds(summary['seconds']),
+        summary['throughput'], 100 * summary['failure_rate']))
+
+def _format_stress_seconds(seconds):
+    return '-' if seconds is None else _format_seconds(seconds)
+
 if __name__ == '__main__': 
     main()
@@ -1,5 +1,28 @@
 import contextlib
+import cPickle as pickle
+import datetime
+import gc
+import imp
+import json
+import os
+import pstats
 import qa
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import weakref
+from xml.dom import minidom
+
+try:
+    import gevent
+    import gevent.event
+except ImportError:
+    gevent = None
 
 @qa.testcase()
 def test_expect(ctx):
@@ -67,3 +90,1079 @@ def skip_works(context):
     qa.expect_eq(results[0].skipped, True)
     qa.expect_eq(results[0].skipped_reason, 'Should be skipped')
 
+
+class _PidPlugin(qa.Plugin):
+    def did_run_test_case(self, test_case, test_result, context):
+        test_result.description = str(os.getpid())
+
+@qa.testcase()
+def process_pool_recycles_workers(context):
+    """Process workers are reused and replaced after max_tests_per_worker"""
+    test_cases = []
+    for i in range(6):
+        @qa.testcase(name='noop%d' % i, is_global=False)
+        def _noop(ctx):
+            pass
+        test_cases.append(_noop)
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_MULTIPROCESS, num_workers=2,
+        plugins=[_PidPlugin()], max_tests_per_worker=2))
+    qa.expect_eq(sorted(r.name for r in results), ['noop%d' % i for i in range(6)])
+    qa.expect(all(r.is_success for r in results))
+    pids = [r.description for r in results]
+    qa.expect_not(str(os.getpid()) in pids)
+    qa.expect_eq(max(pids.count(pid) for pid in pids), 2)
+
+@qa.testcase()
+def thread_pool_runs_tests_concurrently(context):
+    """All thread workers run at the same time"""
+    num_workers = 4
+    started = []
+    everyone_started = threading.Event()
+    test_cases = []
+    for i in range(num_workers * 3):
+        @qa.testcase(name='wait%d' % i, is_global=False)
+        def _wait(ctx):
+            started.append(1)
+            if len(started) >= num_workers:
+                everyone_started.set()
+            qa.expect(everyone_started.wait(5.0))
+        test_cases.append(_wait)
+    results = list(qa.run_test_cases(iter(test_cases), mode=qa.RUN_MULTITHREAD, num_workers=num_workers))
+    qa.expect_eq(sorted(r.name for r in results), sorted(t.name for t in test_cases))
+    qa.expect(all(r.is_success for r in results))
+
+@qa.testcase()
+def shared_fixtures_are_set_up_once_per_scope(context):
+    """Session and group requirements are set up once and torn down after their last test"""
+    path = os.path.join(tempfile.gettempdir(), 'qa-fixture-events-%d' % os.getpid())
+    def record(event):
+        # Appended to a file so the events of process workers are seen too
+        with open(path, 'a') as f:
+            f.write(event + '\n')
+    for mode in [qa.RUN_SINGLETHREAD, qa.RUN_MULTITHREAD, qa.RUN_MULTIPROCESS]:
+        with open(path, 'w'):
+            pass
+
+        @qa.fixture(scope=qa.SCOPE_SESSION)
+        @contextlib.contextmanager
+        def _session(ctx):
+            record('session up')
+            ctx.session = object()
+            yield
+            record('session down')
+
+        @qa.fixture(scope=qa.SCOPE_GROUP)
+        @contextlib.contextmanager
+        def _group(ctx):
+            record('group up')
+            yield
+            record('group down')
+
+        @contextlib.contextmanager
+        def _session_id(ctx):
+            ctx.session_id = id(ctx.session)
+            yield
+
+        test_cases = []
+        for i in range(6):
+            @qa.testcase(group='g%d' % (i % 2), name='t%d' % i, requires=[_session, _session_id, _group], is_global=False)
+            def _test(ctx):
+                record('test %d' % ctx.session_id)
+            test_cases.append(_test)
+        # A process worker keeps its requirements until it exits, so one worker shows the groups are run together
+        results = list(qa.run_test_cases(iter(test_cases), mode=mode, num_workers=1 if mode == qa.RUN_MULTIPROCESS else 3))
+        with open(path) as f:
+            events = f.read().splitlines()
+        os.remove(path)
+        qa.expect(all(r.is_success for r in results))
+        sessions = [event for event in events if event.startswith('test ')]
+        qa.expect_eq(len(sessions), 6)
+        qa.expect_eq(len(set(sessions)), 1)
+        qa.expect_eq(events.count('session up'), 1)
+        qa.expect_eq(events.count('group up'), 2)
+        qa.expect_eq(events.count('group down'), 2)
+        qa.expect_eq(events[-1], 'session down')
+
+@qa.testcase()
+def longest_tests_are_started_first(context):
+    """Tests with the longest recorded durations run first in the parallel modes"""
+    started = []
+    test_cases = []
+    for name in ['a', 'b', 'c', 'd']:
+        @qa.testcase(group='durations', name=name, is_global=False)
+        def _test(ctx, name=name):
+            started.append(name)
+        test_cases.append(_test)
+    durations = {'durations:b': 1.0, 'durations:d': 90.0}
+    list(qa.run_test_cases(test_cases, mode=qa.RUN_MULTITHREAD, num_workers=1, durations=durations))
+    qa.expect_eq(started, ['d', 'b', 'a', 'c'])
+
+    # Tests sharing a requirement instance stay together, ordered by their total duration
+    @qa.fixture(scope=qa.SCOPE_GROUP)
+    @contextlib.contextmanager
+    def _shared(ctx):
+        yield
+    del started[:]
+    test_cases = []
+    for group, name, requires in [('solo', 'a', []), ('shared', 'x1', [_shared]), ('solo', 'y', []),
+            ('shared', 'x2', [_shared])]:
+        @qa.testcase(group=group, name=name, requires=requires, is_global=False)
+        def _test(ctx, name=name):
+            started.append(name)
+        test_cases.append(_test)
+    durations = {'solo:a': 90.0, 'shared:x1': 1.0, 'solo:y': 50.0, 'shared:x2': 80.0}
+    list(qa.run_test_cases(test_cases, mode=qa.RUN_MULTITHREAD, num_workers=1, durations=durations))
+    qa.expect_eq(started, ['a', 'x2', 'x1', 'y'])
+
+@qa.testcase()
+def async_mode_overlaps_waits(context):
+    """Tests in async mode wait concurrently on one event loop"""
+    num_workers = 50
+    started = []
+    everyone_started = gevent.event.Event()
+    test_cases = []
+    for i in range(num_workers * 2):
+        @qa.testcase(name='wait%d' % i, is_global=False)
+        def _wait(ctx):
+            started.append(1)
+            if len(started) >= num_workers:
+                everyone_started.set()
+            qa.expect(everyone_started.wait(5.0))
+        test_cases.append(_wait)
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_ASYNC, num_workers=num_workers))
+    qa.expect_eq(len(results), num_workers * 2)
+    qa.expect(all(r.is_success for r in results))
+
+async_mode_overlaps_waits.skip = gevent is None
+async_mode_overlaps_waits.skip_reason = 'gevent is not installed'
+
+@contextlib.contextmanager
+def _temp_dir(ctx):
+    ctx.temp_dir = tempfile.mkdtemp()
+    try:
+        yield
+    finally:
+        shutil.rmtree(ctx.temp_dir)
+
+@qa.testcase(requires=[_temp_dir])
+def impact_selects_tests_whose_files_changed(ctx):
+    """Tests are rerun only when a source file they ran changes"""
+    source_path = os.path.join(ctx.temp_dir, 'impacted.py')
+    with open(source_path, 'w') as f:
+        f.write('def f():\n    return 1\n')
+    impacted = imp.load_source('impacted', source_path)
+
+    @qa.testcase(group='impact', name='uses_f', is_global=False)
+    def _uses_f(ctx):
+        impacted.f()
+
+    @qa.testcase(group='impact', name='independent', is_global=False)
+    def _independent(ctx):
+        pass
+
+    test_cases = [_uses_f, _independent]
+    impact_map = qa.load_impact_map(os.path.join(ctx.temp_dir, 'impact'))
+    qa.expect_eq(qa.select_impacted_test_cases(test_cases, impact_map), test_cases)
+    results = qa.run_test_cases(test_cases, plugins=[qa.ImpactPlugin(root=ctx.temp_dir)])
+    list(qa._record_impact(results, impact_map, os.path.join(ctx.temp_dir, 'impact')))
+    impact_map = qa.load_impact_map(os.path.join(ctx.temp_dir, 'impact'))
+    qa.expect_eq(impact_map['impact:uses_f'].keys(), [source_path])
+    qa.expect_eq(impact_map['impact:independent'], {})
+    qa.expect_eq(qa.select_impacted_test_cases(test_cases, impact_map), [])
+    qa.expect_eq(qa.select_impacted_test_cases(test_cases, impact_map, changed_paths=[source_path]), [_uses_f])
+
+    with open(source_path, 'w') as f:
+        f.write('def f():\n    return 2  # changed\n')
+    qa.expect_eq(qa.select_impacted_test_cases(test_cases, impact_map), [_uses_f])
+
+# Runs of the cached test, kept out of its closure so they don't change its key
+_cache_runs = []
+
+class _SkipAllPlugin(qa.Plugin):
+    def should_run_test_case(self, test_case):
+        return False
+
+@qa.testcase(requires=[_temp_dir])
+def cache_skips_unchanged_passing_tests(ctx):
+    """Passing results are reused until the test's code or captured values change"""
+    del _cache_runs[:]
+    def make_test_case(fail):
+        @qa.testcase(group='cache', name='test', is_global=False)
+        def _test(ctx):
+            _cache_runs.append(1)
+            if fail:
+                qa.expect(False)
+        return _test
+
+    cache = qa.ResultCache(os.path.join(ctx.temp_dir, 'cache'), max_entries=1)
+    results = list(qa.run_test_cases([make_test_case(False)], cache=cache))
+    qa.expect_eq([r.cached for r in results], [False])
+    results = list(qa.run_test_cases([make_test_case(False)], cache=cache))
+    qa.expect_eq([(r.cached, r.status) for r in results], [(True, 'ok')])
+    qa.expect_eq(len(_cache_runs), 1)
+    results = list(qa.run_test_cases([make_test_case(True)], cache=cache))
+    qa.expect_eq([(r.cached, r.status) for r in results], [(False, 'failed')])
+    results = list(qa.run_test_cases([make_test_case(False)], cache=cache, plugins=[_SkipAllPlugin()]))
+    qa.expect_eq([(r.cached, r.status) for r in results], [(False, 'skipped')])
+
+    @qa.testcase(group='cache', name='test', is_global=False)
+    def _changed(ctx):
+        _cache_runs.append(2)
+    results = list(qa.run_test_cases([_changed], cache=cache))
+    qa.expect_eq([r.cached for r in results], [False])
+    qa.expect_eq(_cache_runs, [1, 1, 2])
+    qa.expect_eq(len(os.listdir(cache.directory)), 1)
+
+    # Each row of a parametrized test is cached, unless its repr doesn't read back as the row
+    del _cache_runs[:]
+    row = _Referent()
+    @qa.parametrize(['a', 'b', row])
+    @qa.testcase(group='cache', name='rows', is_global=False)
+    def _rows(ctx, value):
+        _cache_runs.append(value)
+    row_cache = qa.ResultCache(os.path.join(ctx.temp_dir, 'row-cache'))
+    results = list(qa.run_test_cases([_rows], cache=row_cache))
+    qa.expect_eq([(r.name, r.cached) for r in results], [('rows[a]', False), ('rows[b]', False), ('rows[2]', False)])
+    results = list(qa.run_test_cases([_rows], cache=row_cache))
+    qa.expect_eq([(r.name, r.cached) for r in results], [('rows[a]', True), ('rows[b]', True), ('rows[2]', False)])
+    qa.expect_eq(_cache_runs, ['a', 'b', row, row])
+
+    # Another run's result which is still being written isn't pruned, and one which can't be saved is a miss
+    writing = os.path.join(cache.directory, 'other.1.2.tmp')
+    with open(writing, 'w'):
+        pass
+    cache.prune()
+    qa.expect(os.path.exists(writing))
+    shutil.rmtree(cache.directory)
+    cache.put('lost', qa.TestResult(group='cache', name='test'))
+    qa.expect(cache.get('lost') is None)
+
+@qa.testcase(requires=[_temp_dir])
+def reporters_write_each_result(ctx):
+    """JSON lines and JUnit XML reports have a record for each result"""
+    @qa.testcase(group='report', name='passes', is_global=False)
+    def _passes(ctx):
+        pass
+
+    @qa.testcase(group='report', name='fails', is_global=False)
+    def _fails(ctx):
+        qa.expect_eq(1, 2)
+
+    @qa.testcase(group='report', name='skipped', is_global=False)
+    def _skipped(ctx):
+        pass
+    _skipped.skip = True
+
+    jsonl_path = os.path.join(ctx.temp_dir, 'results.jsonl')
+    junit_path = os.path.join(ctx.temp_dir, 'results.xml')
+    reporters = [qa.make_reporter('jsonl:' + jsonl_path), qa.make_reporter('junit:' + junit_path)]
+    for test_result in qa.run_test_cases([_passes, _fails, _skipped]):
+        for reporter in reporters:
+            reporter.report(test_result)
+    for reporter in reporters:
+        reporter.close()
+
+    with open(jsonl_path) as f:
+        records = [json.loads(line) for line in f]
+    qa.expect_eq([(r['name'], r['status']) for r in records], [('passes', 'ok'), ('fails', 'failed'), ('skipped', 'skipped')])
+    qa.expect_eq(records[0]['worker'], 'main')
+    qa.expect('expected: 1 == 2' in records[1]['formatted_message'])
+
+    document = minidom.parse(junit_path)
+    test_cases = document.getElementsByTagName('testcase')
+    qa.expect_eq([t.getAttribute('name') for t in test_cases], ['passes', 'fails', 'skipped'])
+    qa.expect_eq(len(test_cases[1].getElementsByTagName('failure')), 1)
+    qa.expect_eq(len(test_cases[2].getElementsByTagName('skipped')), 1)
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+_unpickled = []
+
+def _record_unpickled():
+    _unpickled.append(1)
+
+class _RunsCodeWhenUnpickled(object):
+    def __reduce__(self):
+        return (_record_unpickled, ())
+
+@qa.testcase()
+def distributed_workers_run_tests_and_requeue_on_disconnect(context):
+    """Tests served over loopback run once each even when a worker drops out or sends a bad result"""
+    test_cases = []
+    for i in range(10):
+        @qa.testcase(group='distributed', name='t%d' % i, is_global=False)
+        def _test(ctx):
+            pass
+        test_cases.append(_test)
+    address = ('127.0.0.1', _free_port())
+    results = []
+    pulled = []
+    def _stream():
+        for test_case in test_cases:
+            pulled.append(test_case)
+            yield test_case
+    def coordinate():
+        results.extend(qa.run_test_cases(_stream(), mode=qa.RUN_DISTRIBUTED, address=address))
+    coordinator = threading.Thread(target=coordinate)
+    coordinator.start()
+
+    # A worker which disconnects in the middle of a test
+    for i in range(100):
+        try:
+            sock = socket.create_connection(address)
+            break
+        except socket.error:
+            time.sleep(0.05)
+    qa._send_message(sock, ('hello', 'dropped', None))
+    kind, tag, test_id = qa._recv_message(sock)
+    qa.expect_eq(kind, 'run')
+    # Only a few tests are queued per connected worker
+    qa.expect_lt(len(pulled), len(test_cases))
+    sock.close()
+
+    # A worker whose result would run code when it's unpickled
+    sock = socket.create_connection(address)
+    qa._send_message(sock, ('hello', 'hostile', None))
+    kind, tag, test_id = qa._recv_message(sock)
+    qa._send_message(sock, ('result', tag, _RunsCodeWhenUnpickled()))
+    qa.expect_eq(sock.recv(1), '')
+    sock.close()
+    qa.expect_eq(_unpickled, [])
+
+    workers = [threading.Thread(target=qa.run_worker, args=(address, test_cases, []), kwargs={'name': 'w%d' % i})
+            for i in range(2)]
+    for worker in workers:
+        worker.start()
+    coordinator.join(10.0)
+    for worker in workers:
+        worker.join(10.0)
+    qa.expect_eq(sorted(r.name for r in results), sorted(t.name for t in test_cases))
+    qa.expect(all(r.is_success for r in results))
+    qa.expect_eq(set(r.worker for r in results) - set(['w0', 'w1']), set())
+
+@qa.testcase()
+def shards_are_disjoint_and_balanced(context):
+    """Every test lands in exactly one shard and balanced shards take similar time"""
+    test_cases = []
+    for i in range(20):
+        @qa.testcase(group='shard', name='t%d' % i, is_global=False)
+        def _test(ctx):
+            pass
+        test_cases.append(_test)
+    durations = dict(('shard:t%d' % i, float(i)) for i in range(20))
+    for strategy in qa.SHARD_STRATEGIES:
+        partitions = qa.partition_test_cases(test_cases, 3, strategy=strategy, durations=durations)
+        qa.expect_eq(sorted(t.name for p in partitions for t in p), sorted(t.name for t in test_cases))
+        qa.expect_eq(qa.partition_test_cases(test_cases, 3, strategy=strategy, durations=durations), partitions)
+    loads = [sum(durations[t.group_and_name()] for t in p) for p in partitions]
+    qa.expect_le(max(loads) - min(loads), 19.0)
+    qa.expect_eq(qa._parse_shard('2/3'), (2, 3))
+    with qa.expect_raises(ValueError):
+        qa._parse_shard('4/3')
+
+def _join_abandoned_threads(threads_before):
+    """Wait for the worker threads a pool left behind so they don't outlive the interpreter"""
+    for thread in set(threading.enumerate()) - threads_before:
+        if thread.name.startswith('qa-thread-') and thread.ident is not None:
+            thread.join(5.0)
+
+@qa.testcase()
+def hung_tests_time_out_without_stopping_the_run(context):
+    """A test which runs past its timeout is reported as crashed and the other tests still run"""
+    release = threading.Event()
+    threads_before = set(threading.enumerate())
+    for mode in [qa.RUN_MULTITHREAD, qa.RUN_MULTIPROCESS]:
+        @qa.testcase(group='timeout', name='hang', is_global=False, timeout=0.2)
+        def _hang(ctx):
+            release.wait(10.0)
+
+        @qa.testcase(group='timeout', name='quick', is_global=False)
+        def _quick(ctx):
+            pass
+
+        started = time.time()
+        results = dict((r.name, r) for r in qa.run_test_cases([_hang, _quick], mode=mode, num_workers=1, timeout=5.0))
+        qa.expect_lt(time.time() - started, 5.0)
+        qa.expect(results['quick'].is_success)
+        qa.expect(results['hang'].is_error)
+        qa.expect('within 0.2s' in results['hang'].formatted_message)
+    # The abandoned thread worker is still in the hung test until it's released
+    release.set()
+    _join_abandoned_threads(threads_before)
+
+    # A result which arrives after its test was reported as crashed is dropped
+    pool = qa._ProcessPool([], 1, [])
+    pool._handle_message(('result', 0, 7, qa.TestResult(group='timeout', name='late')))
+    qa.expect_eq(len(pool.ready), 0)
+
+@qa.testcase()
+def dead_process_workers_lose_no_results(context):
+    """The results a process worker sent just before it died are run again instead of waited for"""
+    test_cases = []
+    for i in range(20):
+        @qa.testcase(group='crash', name='t%d' % i, is_global=False)
+        def _test(ctx, i=i):
+            if i == 10:
+                os._exit(3)
+        test_cases.append(_test)
+    results = dict((r.name, r) for r in qa.run_test_cases(test_cases, mode=qa.RUN_MULTIPROCESS, num_workers=1))
+    qa.expect_eq(sorted(results), sorted('t%d' % i for i in range(20)))
+    qa.expect(results['t10'].is_error)
+    qa.expect('exited with code 3' in results['t10'].formatted_message)
+    qa.expect(all(r.is_success for name, r in results.items() if name != 't10'))
+    # A hybrid worker killed while its other threads wait for tasks leaves nothing held for its replacement
+    @qa.testcase(group='crash', name='hang', is_global=False, timeout=0.5, resources={'db': 1})
+    def _hang(ctx):
+        time.sleep(5)
+
+    @qa.testcase(group='crash', name='after', is_global=False, resources={'db': 1})
+    def _after(ctx):
+        pass
+
+    results = dict((r.name, r) for r in qa.run_test_cases([_hang, _after] + test_cases[11:], mode=qa.RUN_HYBRID,
+        num_workers=(1, 4), resources={'db': 1}))
+    qa.expect_eq(sorted(results), sorted(['after', 'hang'] + ['t%d' % i for i in range(11, 20)]))
+    qa.expect(results['hang'].is_error)
+    qa.expect(all(r.is_success for name, r in results.items() if name != 'hang'))
+
+@qa.testcase()
+def benchmarks_run_last_and_fail_on_regression(context):
+    """Benchmarks run after the other tests and fail when they are slower than their baseline"""
+    @qa.benchmark(group='bench', name='sum', is_global=False, min_time=0.01)
+    def _sum(ctx):
+        sum(range(100))
+
+    @qa.testcase(group='bench', name='test', is_global=False)
+    def _test(ctx):
+        pass
+
+    results = list(qa.run_test_cases([_sum, _test], mode=qa.RUN_MULTITHREAD, num_workers=2,
+        plugins=[qa.BenchmarkPlugin()]))
+    qa.expect_eq([r.name for r in results], ['test', 'sum'])
+    qa.expect(results[1].is_success)
+    # Benchmarks are held back without reading the whole stream of test cases ahead of time
+    pulled = []
+    def _stream():
+        yield _sum
+        for i in range(100):
+            pulled.append(i)
+            yield _test
+    stream = qa.run_test_cases(_stream(), mode=qa.RUN_MULTITHREAD, num_workers=2)
+    next(stream)
+    qa.expect_lt(len(pulled), 100)
+    qa.expect_eq([r.name for r in stream][-1], 'sum')
+    stats = results[1].extra['benchmark']
+    qa.expect_ge(stats['rounds'], 5)
+    qa.expect_le(stats['min'], stats['median'])
+    qa.expect_le(stats['median'], stats['p95'])
+    qa.expect_gt(stats['ops_per_sec'], 0)
+    # A baseline no call can beat.  One derived from the first measurement isn't reliably faster than the second
+    # one, since tests running at the same time slow either of them down.
+    baseline = {'bench:sum': dict(stats, median=1e-9)}
+    results = list(qa.run_test_cases([_sum], plugins=[qa.BenchmarkPlugin(baseline, threshold=0.5)]))
+    qa.expect(results[0].is_failure)
+    qa.expect('regressed' in results[0].formatted_message)
+
+def _profiled_function():
+    return sum(range(1000))
+
+@qa.testcase(requires=[_temp_dir])
+def profiles_are_saved_per_test_and_merged(ctx):
+    """Each test's profile is saved and the run's profiles are merged into one report"""
+    test_cases = []
+    for i in range(3):
+        @qa.testcase(group='profile', name='t%d' % i, is_global=False)
+        def _test(ctx):
+            _profiled_function()
+        test_cases.append(_test)
+    report = StringIO.StringIO()
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_MULTITHREAD, num_workers=2,
+            plugins=[qa.ProfilePlugin(ctx.temp_dir)], repeat=2))
+    qa.expect(all(r.is_success for r in results))
+    qa.expect_eq(sorted(os.path.basename(r.extra['profile']).split('.')[0] for r in results),
+            ['profile:t0', 'profile:t0', 'profile:t1', 'profile:t1', 'profile:t2', 'profile:t2'])
+    qa.expect_eq(len(set(r.extra['profile'] for r in results)), 6)
+    # A result seen twice is merged once
+    list(qa.merge_profiles(iter(results + results[:1]), ctx.temp_dir, top=10, file=report))
+    qa.expect('_profiled_function' in report.getvalue())
+    stats = pstats.Stats(os.path.join(ctx.temp_dir, 'all.prof')).stats
+    qa.expect_eq([calls for (filename, line, name), (calls, _, _, _, _) in stats.items()
+        if name == '_profiled_function'], [6])
+
+_leaked = []
+
+@qa.testcase()
+def memory_plugin_records_retained_objects_and_leaks(context):
+    """Objects a test keeps alive are recorded and a test that leaks on every run fails the leak check"""
+    @qa.testcase(group='memory', name='leaks', is_global=False)
+    def _leaks(ctx):
+        _leaked.append([[] for i in range(10000)])
+
+    # The object counts are for the whole process, so run it in a worker process of its own where no
+    # other tests are running
+    results = list(qa.run_test_cases([_leaks], mode=qa.RUN_MULTIPROCESS, num_workers=1,
+        plugins=[qa.MemoryPlugin(leak_check=3)]))
+    memory = results[0].extra['memory']
+    qa.expect_ge(memory['objects'], 10000)
+    qa.expect_eq(memory['top_types'][0][0], 'list')
+    qa.expect_eq(len(memory['leak_check']), 3)
+    qa.expect(results[0].is_failure)
+    qa.expect('leak' in results[0].failure_msg)
+    del _leaked[:]
+
+    # The reruns share the test's group requirement instead of setting it up again
+    set_ups = []
+    @qa.fixture(scope=qa.SCOPE_GROUP)
+    @contextlib.contextmanager
+    def _group_requirement(ctx):
+        set_ups.append(True)
+        yield
+
+    @qa.testcase(group='memory', name='shares', requires=[_group_requirement], is_global=False)
+    def _shares(ctx):
+        pass
+
+    results = list(qa.run_test_cases([_shares], plugins=[qa.MemoryPlugin(leak_check=3)]))
+    qa.expect(results[0].is_success)
+    qa.expect_eq(len(results[0].extra['memory']['leak_check']), 3)
+    qa.expect_eq(len(set_ups), 1)
+
+    # Fewer reruns couldn't tell a leak from a cache filling
+    with qa.expect_raises(ValueError):
+        qa.MemoryPlugin(leak_check=2)
+
+@qa.testcase()
+def failed_tests_run_first_and_fail_fast_cancels_the_rest(context):
+    """Tests which failed last time run first and the run stops at the first failure"""
+    threads_before = set(threading.enumerate())
+    for mode in [qa.RUN_SINGLETHREAD, qa.RUN_MULTITHREAD, qa.RUN_MULTIPROCESS]:
+        test_cases = []
+        for i in range(20):
+            @qa.testcase(group='failfast', name='slow%d' % i, is_global=False)
+            def _slow(ctx):
+                time.sleep(0.2)
+            test_cases.append(_slow)
+
+        @qa.testcase(group='failfast', name='broken', is_global=False)
+        def _broken(ctx):
+            qa.expect(False)
+        test_cases.append(_broken)
+
+        started = time.time()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            results = list(qa.run_test_cases(test_cases, mode=mode, num_workers=2, failed=set(['failfast:broken']),
+                max_failures=1))
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        qa.expect_lt(time.time() - started, 2.0)
+        qa.expect_eq([r.name for r in results if not r.is_success], ['broken'])
+        qa.expect_lt(len(results), 5)
+        # Nothing is left writing tasks to the cancelled workers
+        qa.expect('Broken pipe' not in stderr.getvalue())
+    _join_abandoned_threads(threads_before)
+    qa.expect_eq([t.name for t in qa._order_failed_first(test_cases, set(['failfast:broken']))][:2], ['broken', 'slow0'])
+
+@qa.testcase(requires=[_temp_dir])
+def index_finds_tests_without_importing_modules(ctx):
+    """The test index lists tests and selects modules from their source alone"""
+    with open(os.path.join(ctx.temp_dir, 'qa_indexed_static.py'), 'w') as f:
+        f.write('import qa\n'
+                'raise ImportError("imported")\n'
+                '@qa.testcase()\n'
+                'def one(ctx): pass\n'
+                '@qa.testcase(group="g", name="two")\n'
+                'def two_(ctx): pass\n')
+    with open(os.path.join(ctx.temp_dir, 'qa_indexed_dynamic.py'), 'w') as f:
+        f.write('import qa\n'
+                'for i in range(2):\n'
+                '    @qa.testcase(name="d%d" % i)\n'
+                '    def t(ctx): pass\n')
+    with open(os.path.join(ctx.temp_dir, 'qa_indexed_mixed.py'), 'w') as f:
+        f.write('import qa\n'
+                '@qa.testcase(name=NAME)\n'
+                'def computed(ctx): pass\n'
+                '@qa.testcase(params=[1, 2])\n'
+                'def rows(ctx, x): pass\n'
+                '@qa.benchmark(group="g", name="bench")\n'
+                'def bench(ctx): pass\n')
+    index_path = os.path.join(ctx.temp_dir, 'index')
+    modules = ['qa_indexed_static', 'qa_indexed_dynamic']
+    sys.path.insert(0, ctx.temp_dir)
+    try:
+        index = qa.TestIndex(index_path)
+        qa.expect_eq(index.list_test_names(modules), ['qa_indexed_static:one', 'g:two'])
+        qa.expect_eq(index.select_modules(modules, ['two']), modules)
+        qa.expect_eq(index.select_modules(modules, ['d1']), ['qa_indexed_dynamic'])
+        # Tests after the ones which can't be read from the source are still found
+        qa.expect_eq(index.lookup('qa_indexed_mixed'), (['g:bench'], True))
+        output = StringIO.StringIO()
+        index.print_test_names(modules, ['o'], file=output)
+        qa.expect_eq(output.getvalue(), 'g:two\nqa_indexed_static:one\n')
+        index.save()
+        qa.expect_eq(qa.TestIndex(index_path).entries, index.entries)
+    finally:
+        sys.path.remove(ctx.temp_dir)
+    qa.expect('qa_indexed_static' not in sys.modules)
+
+    # Without the index the registered tests are listed, and never run
+    ran = []
+    @qa.testcase(group='g', name='listed', is_global=False)
+    def _listed(ctx):
+        ran.append(1)
+    argv, stdout, defaults = sys.argv, sys.stdout, qa.option_parser.defaults
+    sys.argv, sys.stdout = ['qa', '--list', '--index-file', ''], StringIO.StringIO()
+    # optparse appends to the default list, which holds the -f patterns of this run
+    qa.option_parser.defaults = dict(defaults, filter=[])
+    try:
+        qa.main(init_logging=False, test_cases=[_listed], plugins=[])
+        output = sys.stdout.getvalue()
+    finally:
+        sys.argv, sys.stdout, qa.option_parser.defaults = argv, stdout, defaults
+    qa.expect_eq(output, 'g:listed\n')
+    qa.expect_eq(ran, [])
+
+class _Referent(object):
+    pass
+
+@qa.testcase()
+def results_do_not_keep_test_frames_alive(context):
+    """A crashed result keeps a summary of its traceback but none of the test's locals"""
+    references = []
+    @qa.testcase(group='result', name='crash', is_global=False)
+    def _crash(ctx):
+        local = _Referent()
+        references.append(weakref.ref(local))
+        raise ValueError('boom')
+
+    result, = qa.run_test_cases([_crash])
+    # contextlib.nested leaves a reference cycle through the traceback for the collector
+    gc.collect()
+    qa.expect(references[0]() is None)
+    qa.expect(result.is_error)
+    message = result.formatted_message
+    qa.expect("raise ValueError('boom')" in message)
+    qa.expect('ValueError: boom' in message)
+    qa.expect_eq(pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)).formatted_message, message)
+    qa.expect_eq(pickle.loads(pickle.dumps(result)).formatted_message, message)
+    qa.expect(not hasattr(result, '__dict__'))
+    qa.expect_le(result.started_at, result.ended_at)
+    qa.expect(isinstance(result.started_at, datetime.datetime))
+    qa.expect(isinstance(result.duration, datetime.timedelta))
+    qa.expect_lt(abs(result.duration.total_seconds() - result.duration_seconds), 1e-5)
+
+@qa.testcase()
+def parametrized_tests_expand_lazily_and_run_in_batches(context):
+    """Parametrized tests run once per row, reading the rows as they go"""
+    rows_read = []
+    def rows():
+        for i in range(500):
+            rows_read.append(i)
+            yield (i, i * 2)
+
+    @qa.parametrize(rows)
+    @qa.testcase(group='params', name='double', is_global=False)
+    def _double(ctx, x, doubled):
+        qa.expect_eq(x * 2, doubled)
+        qa.expect(x != 123)
+
+    @qa.testcase(group='params', name='words', is_global=False, params=['a', 'b'], ids=lambda row: row.upper())
+    def _words(ctx, word):
+        qa.expect(word in 'ab')
+
+    results = qa.run_test_cases([_double])
+    qa.expect_eq(next(results).group_and_name, 'params:double[0-0]')
+    qa.expect_lt(len(rows_read), 10)
+    results.close()
+    for mode in [qa.RUN_SINGLETHREAD, qa.RUN_MULTITHREAD, qa.RUN_MULTIPROCESS]:
+        results = list(qa.run_test_cases([_double, _words], mode=mode, num_workers=3))
+        qa.expect_eq(len(results), 502)
+        qa.expect_eq([r.name for r in results if not r.is_success], ['double[123-246]'])
+        qa.expect_eq(sorted(r.name for r in results if r.name.startswith('words')), ['words[A]', 'words[B]'])
+    selected = qa._filter_test_cases([_double, _words], qa._make_name_filter([r'double\[4\d\d-']))
+    qa.expect_eq(len(list(qa.expand_test_cases(selected))), 100)
+
+    # Ordering, sharding and impact selection use the records of the rows
+    @qa.testcase(group='', name='plain', is_global=False)
+    def _plain(ctx):
+        pass
+
+    @qa.testcase(group='', name='rows', is_global=False, params=[1, 2, 3])
+    def _rows(ctx, x):
+        pass
+
+    def names(test_cases):
+        return [t.group_and_name() for t in qa.expand_test_cases(test_cases)]
+    qa.expect_eq(names(qa._order_failed_first([_plain, _rows], set([':rows[3]']))),
+            [':rows[1]', ':rows[2]', ':rows[3]', ':plain'])
+    qa.expect_eq(names(qa._order_longest_first([_plain, _rows], {':plain': 2.0, ':rows[3]': 5.0})),
+            [':rows[1]', ':rows[2]', ':rows[3]', ':plain'])
+    qa.expect_eq(qa._estimated_durations([_plain, _rows], {':plain': 2.0, ':rows[1]': 1.0, ':rows[3]': 5.0}),
+            [2.0, 6.0])
+    impact_map = {':plain': {}, ':rows[1]': {}, ':rows[2]': {os.path.abspath('changed.py'): None}}
+    qa.expect_eq(names(qa.select_impacted_test_cases([_plain, _rows], impact_map, changed_paths=['changed.py'])),
+            [':rows[2]', ':rows[3]'])
+
+class _ForkRecorder(qa.Plugin):
+    def __init__(self):
+        self.forks = 0
+        self.clones = 0
+        self.forked_pid = None
+        self.cloned_threads = set()
+
+    def will_fork(self):
+        self.forks += 1
+
+    def did_fork(self):
+        self.forked_pid = os.getpid()
+
+    def will_clone(self):
+        self.clones += 1
+
+    def did_clone(self):
+        self.cloned_threads.add(threading.current_thread().name)
+
+    def did_run_test_case(self, test_case, test_result, ctx):
+        test_result.extra['forked'] = self.forked_pid == os.getpid()
+
+@qa.testcase()
+def preloaded_workers_share_session_requirements(context):
+    """Session requirements can be set up once before the process workers are forked"""
+    set_up_in = []
+    @qa.fixture(scope=qa.SCOPE_SESSION)
+    @contextlib.contextmanager
+    def _session(ctx):
+        set_up_in.append(os.getpid())
+        ctx.session_pid = os.getpid()
+        yield
+
+    test_cases = []
+    for i in range(6):
+        @qa.testcase(group='preload', name='t%d' % i, requires=[_session], is_global=False)
+        def _test(ctx):
+            qa.expect_ne(ctx.session_pid, os.getpid())
+        test_cases.append(_test)
+
+    # Benchmarks run in this process after the workers and use the preloaded requirement too
+    @qa.benchmark(group='preload', name='bench', requires=[_session], is_global=False, min_time=0.001)
+    def _bench(ctx):
+        pass
+    recorder = _ForkRecorder()
+    results = list(qa.run_test_cases(test_cases + [_bench], mode=qa.RUN_MULTIPROCESS, num_workers=3,
+        plugins=[recorder], preload=True))
+    qa.expect_eq(results[-1].name, 'bench')
+    qa.expect(results[-1].is_success)
+    qa.expect(all(r.is_success and r.extra['forked'] for r in results[:-1]))
+    qa.expect_eq(set_up_in, [os.getpid()])
+    qa.expect_eq(recorder.forks, 3)
+
+    @qa.testcase(group='preload', name='thread', is_global=False)
+    def _thread_test(ctx):
+        pass
+    list(qa.run_test_cases([_thread_test], mode=qa.RUN_MULTITHREAD, num_workers=2, plugins=[recorder]))
+    qa.expect_eq(recorder.clones, 2)
+    qa.expect_eq(recorder.cloned_threads, set(['qa-thread-0', 'qa-thread-1']))
+
+@qa.testcase(requires=[_temp_dir])
+def watch_reloads_changed_modules_and_their_users(ctx):
+    """A changed module is reloaded with the modules which use it and their tests are registered again"""
+    def write(name, source):
+        path = os.path.join(ctx.temp_dir, name + '.py')
+        with open(path, 'w') as f:
+            f.write(source)
+        # Make the change visible to checks of the modification time
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        return path
+    helper_path = write('_watched_helper', 'def value():\n    return 1\n')
+    write('_watched_tests', 'import qa\nimport _watched_helper\n\n'
+            '@qa.testcase()\ndef uses_helper(ctx):\n    qa.expect_eq(_watched_helper.value(), 1)\n')
+    write('_watched_other', 'import qa\n\n@qa.testcase()\ndef unrelated(ctx):\n    pass\n')
+    registry = qa._qa_globals.all_test_cases
+    qa._qa_globals.all_test_cases = []
+    sys.path.insert(0, ctx.temp_dir)
+    try:
+        # Imported for their test cases, which register themselves
+        import _watched_tests, _watched_other  # noqa: F401
+        watcher = qa._PollingWatcher(ctx.temp_dir, interval=0.01)
+        write('_watched_helper', 'def value():\n    return 2\n')
+        changed = watcher.wait()
+        qa.expect_eq(changed, set([helper_path]))
+        qa.expect_eq(qa.reload_changed_modules(changed, ctx.temp_dir), set(['_watched_helper', '_watched_tests']))
+        test_cases = qa._qa_globals.all_test_cases
+        qa.expect_eq(sorted(t.name for t in test_cases), ['unrelated', 'uses_helper'])
+        selected = [t for t in test_cases if qa._test_case_modules(t) & set(['_watched_helper', '_watched_tests'])]
+        results = list(qa.run_test_cases(selected))
+        qa.expect_eq([(r.name, r.is_failure) for r in results], [('uses_helper', True)])
+    finally:
+        qa._qa_globals.all_test_cases = registry
+        sys.path.remove(ctx.temp_dir)
+        for name in ['_watched_helper', '_watched_tests', '_watched_other']:
+            sys.modules.pop(name, None)
+
+_hybrid_running = []
+
+@contextlib.contextmanager
+def _count_running(ctx):
+    _hybrid_running.append(threading.current_thread().name)
+    try:
+        yield
+    finally:
+        _hybrid_running.remove(threading.current_thread().name)
+
+@qa.testcase()
+def hybrid_mode_runs_threads_in_each_process(context):
+    """Hybrid workers run several tests at once per process and thread unsafe tests alone"""
+    test_cases = []
+    for i in range(16):
+        @qa.testcase(group='hybrid', name='t%d' % i, requires=[_count_running], is_global=False)
+        def _test(ctx):
+            time.sleep(0.2)
+            qa.expect_eq(os.getppid(), context.pid)
+        test_cases.append(_test)
+    for i in range(2):
+        @qa.testcase(group='hybrid', name='unsafe%d' % i, requires=[_count_running], is_global=False, thread_safe=False)
+        def _unsafe(ctx):
+            time.sleep(0.1)
+            qa.expect_eq(len(_hybrid_running), 1)
+        test_cases.insert(5, _unsafe)
+    context.pid = os.getpid()
+    started = time.time()
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_HYBRID, num_workers=(2, 4)))
+    qa.expect_lt(time.time() - started, 2.0)
+    qa.expect_eq(len(results), 18)
+    qa.expect_eq([r.name for r in results if not r.is_success], [])
+    qa.expect_eq(set(r.worker.split('/')[0] for r in results), set(['process-0', 'process-1']))
+    qa.expect_eq(len(set(r.worker for r in results)), 8)
+    qa.expect_eq(qa._parse_num_workers('8x16'), (8, 16))
+
+    # A test which overruns its timeout on a thread gets its process killed.  The test running beside it is
+    # reported as interrupted instead of being run again.
+    @qa.testcase(group='hybrid', name='hang', is_global=False, timeout=0.3)
+    def _hang(ctx):
+        time.sleep(5)
+
+    @qa.testcase(group='hybrid', name='sibling', is_global=False)
+    def _sibling(ctx):
+        time.sleep(1)
+
+    results = list(qa.run_test_cases([_hang, _sibling], mode=qa.RUN_HYBRID, num_workers=(1, 2)))
+    qa.expect_eq(sorted(r.name for r in results), ['hang', 'sibling'])
+    qa.expect(all(r.is_error for r in results))
+    sibling, = [r for r in results if r.name == 'sibling']
+    qa.expect('killed because hybrid:hang timed out' in sibling.formatted_message)
+
+    # Each thread keeps the group requirements its tests use, so other groups don't tear them down
+    @qa.fixture(scope=qa.SCOPE_GROUP)
+    @contextlib.contextmanager
+    def _group_state(ctx):
+        state = ctx.group_state = {'open': True}
+        yield
+        state['open'] = False
+
+    test_cases = []
+    for group in range(4):
+        for i in range(3):
+            @qa.testcase(group='hybrid%d' % group, name='t%d' % i, requires=[_group_state], is_global=False)
+            def _grouped(ctx):
+                time.sleep(0.05)
+                qa.expect(ctx.group_state['open'])
+            test_cases.append(_grouped)
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_HYBRID, num_workers=(1, 4)))
+    qa.expect_eq(len(results), 12)
+    qa.expect_eq([r.group_and_name() for r in results if not r.is_success], [])
+
+@qa.testcase()
+def resources_limit_concurrent_tests_and_backfill(context):
+    """Tests which need a busy resource wait while later tests run"""
+    lock = threading.Lock()
+    using = []
+    most_using = [0]
+    test_cases = []
+    for i in range(4):
+        @qa.testcase(group='resources', name='db%d' % i, resources={'db': 1, 'cpu': 5}, is_global=False)
+        def _db(ctx):
+            with lock:
+                using.append(1)
+                most_using[0] = max(most_using[0], len(using))
+            time.sleep(0.1)
+            with lock:
+                using.pop()
+        test_cases.append(_db)
+    for i in range(6):
+        @qa.testcase(group='resources', name='other%d' % i, is_global=False)
+        def _other(ctx):
+            time.sleep(0.1)
+        test_cases.append(_other)
+    results = list(qa.run_test_cases(test_cases, mode=qa.RUN_MULTITHREAD, num_workers=4, resources={'db': 1, 'cpu': 2}))
+    qa.expect_eq(most_using[0], 1)
+    qa.expect(all(r.is_success for r in results))
+    names = [r.name for r in results]
+    qa.expect_eq(names[-1], 'db3')
+    qa.expect_eq(qa._parse_resource('db=3'), ('db', 3))
+
+    # A test abandoned at its timeout keeps its resources until its thread is done with them
+    hog_running = threading.Event()
+    @qa.testcase(group='resources', name='hog', resources={'db': 1}, timeout=0.2, is_global=False)
+    def _hog(ctx):
+        hog_running.set()
+        time.sleep(0.6)
+        hog_running.clear()
+
+    overlapped = []
+    @qa.testcase(group='resources', name='after_hog', resources={'db': 1}, is_global=False)
+    def _after_hog(ctx):
+        overlapped.append(hog_running.is_set())
+
+    threads_before = set(threading.enumerate())
+    results = list(qa.run_test_cases([_hog, _after_hog], mode=qa.RUN_MULTITHREAD, num_workers=2,
+        resources={'db': 1}))
+    _join_abandoned_threads(threads_before)
+    qa.expect_eq([(r.name, r.status) for r in results], [('hog', 'crashed'), ('after_hog', 'ok')])
+    qa.expect_eq(overlapped, [False])
+
+    # Tests waiting for the resources of a test which never finishes are skipped after the grace period
+    release = threading.Event()
+    @qa.testcase(group='resources', name='hang', resources={'db': 1}, timeout=0.2, is_global=False)
+    def _hang(ctx):
+        release.wait(10.0)
+
+    @qa.testcase(group='resources', name='after_hang', resources={'db': 1}, is_global=False)
+    def _after_hang(ctx):
+        pass
+
+    pool = qa._ThreadPool(2, [], qa._FixtureScope(remaining={}))
+    pool.grace = 0.2
+    started = time.time()
+    results = list(qa._run_test_cases_pooled([_hang, _after_hang], pool, [], resources={'db': 1}))
+    qa.expect_lt(time.time() - started, 2.0)
+    qa.expect_eq([(r.name, r.status) for r in results], [('hang', 'crashed'), ('after_hang', 'skipped')])
+    qa.expect_eq(results[1].skipped_reason, 'resources held by an abandoned test')
+    release.set()
+    _join_abandoned_threads(threads_before)
+
+@qa.testcase()
+def repeated_tests_are_summarized(context):
+    """Repeated tests run the requested number of times with bounded copies in flight"""
+    lock = threading.Lock()
+    running = []
+    most_running = [0]
+    calls = [0]
+    @qa.testcase(group='stress', name='flaky', is_global=False)
+    def _flaky(ctx):
+        with lock:
+            running.append(1)
+            most_running[0] = max(most_running[0], len(running))
+            calls[0] += 1
+            call = calls[0]
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        qa.expect(call % 5 != 0)
+    out = StringIO.StringIO()
+    path = os.path.join(tempfile.gettempdir(), 'qa-stress-%d.json' % os.getpid())
+    try:
+        results = list(qa.stress_report(qa.run_test_cases([_flaky], mode=qa.RUN_MULTITHREAD, num_workers=6,
+            repeat=40, concurrency=3), json_path=path, file=out))
+        with open(path) as f:
+            summary = json.load(f)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    qa.expect_eq(len(results), 40)
+    qa.expect_eq(most_running[0], 3)
+    test = summary['tests']['stress:flaky']
+    qa.expect_eq((test['runs'], test['failures'], summary['runs']), (40, 8, 40))
+    qa.expect_eq(test['failure_rate'], 0.2)
+    qa.expect(test['p50'] <= test['p90'] <= test['p99'] <= test['max'])
+    qa.expect_gt(test['throughput'], 0)
+    qa.expect('stress:flaky' in out.getvalue() and '20.0%' in out.getvalue())
+    # A run without times, such as one which crashed before the test started, is counted without a duration
+    untimed = qa.TestResult(group='stress', name='flaky', error_msg='Crash: setup failed')
+    out = StringIO.StringIO()
+    results = list(qa.stress_report([untimed, next(r for r in results if r.is_success)], file=out))
+    qa.expect_eq(len(results), 2)
+    qa.expect('stress:flaky' in out.getvalue() and '50.0%' in out.getvalue())
+
+@qa.testcase()
+def run_metrics_are_exported_while_tests_run(context):
+    """Live metrics count finished tests and report the longest running ones over HTTP"""
+    release = threading.Event()
+    started = threading.Event()
+    @qa.testcase(group='metrics', name='slow', is_global=False)
+    def _slow(ctx):
+        started.set()
+        release.wait(5)
+    fast = [qa.TestCase(lambda ctx: None, group='metrics', name='fast%d' % i) for i in range(5)]
+    metrics = qa.RunMetrics()
+    exporter = qa.MetricsExporter(metrics, address=('127.0.0.1', _free_port()))
+    exporter.start()
+    try:
+        results = qa.run_test_cases([_slow] + fast, mode=qa.RUN_MULTITHREAD, num_workers=2, metrics=metrics)
+        names = [next(results).name for i in range(5)]
+        qa.expect_eq(sorted(names), ['fast%d' % i for i in range(5)])
+        qa.expect(started.wait(5))
+        snapshot = metrics.snapshot()
+        qa.expect_eq(snapshot['finished'], 5)
+        qa.expect_eq(snapshot['statuses'], {'ok': 5})
+        qa.expect_eq([test['test'] for test in snapshot['slowest_running']], ['metrics:slow'])
+        qa.expect_eq(len(snapshot['workers']), 2)
+        body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % exporter.server.server_address[1]).read()
+        qa.expect('qa_tests_total{status="ok"} 5.0' in body)
+        qa.expect('qa_running_test_seconds{worker=' in body and 'test="metrics:slow"}' in body)
+        stats = json.loads(urllib2.urlopen('http://127.0.0.1:%d/stats' % exporter.server.server_address[1]).read())
+        qa.expect_eq(stats['finished'], 5)
+        release.set()
+        qa.expect_eq([r.name for r in results], ['slow'])
+        qa.expect_eq(metrics.snapshot()['slowest_running'], [])
+    finally:
+        release.set()
+        exporter.stop()
+    qa.expect_eq(qa.prometheus_text({'elapsed': 1, 'finished': 0, 'statuses': {}, 'tests_per_second': 0,
+        'recent_tests_per_second': 0, 'in_flight': 0, 'queued': 0, 'workers': {}, 'slowest_running':
+        [{'worker': 'w', 'test': 'a"b\\c', 'seconds': 2}]}).splitlines()[-1], 'qa_running_test_seconds{worker="w",test="a\\"b\\\\c"} 2.0')
+
+@qa.testcase()
+def trace_records_fixtures_and_hooks(context):
+    """The trace has a track per worker with spans for each test, its fixtures' setup and teardown and plugin hooks"""
+    @contextlib.contextmanager
+    def slow_fixture(ctx):
+        time.sleep(0.02)
+        yield
+        time.sleep(0.01)
+    test_cases = [qa.TestCase(lambda ctx: time.sleep(0.01), group='trace', name='t%d' % i, requires=[slow_fixture])
+            for i in range(4)]
+    path = os.path.join(tempfile.gettempdir(), 'qa-trace-%d.json' % os.getpid())
+    try:
+        results = list(qa.write_trace(qa.run_test_cases(test_cases, mode=qa.RUN_MULTIPROCESS, num_workers=2,
+            plugins=[qa.Plugin()], trace=True), path))
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    qa.expect_eq(len(results), 4)
+    tracks = dict((event['tid'], event['args']['name']) for event in events if event['name'] == 'thread_name')
+    qa.expect_eq(sorted(tracks.values()), ['process-0', 'process-1'])
+    spans = [event for event in events if event['ph'] == 'X']
+    tests = [span for span in spans if span['name'].startswith('trace:')]
+    qa.expect_eq(len(tests), 4)
+    qa.expect_eq(set(test['args']['status'] for test in tests), set(['ok']))
+    for test in tests:
+        inner = [span for span in spans if span['tid'] == test['tid'] and span is not test
+                and test['ts'] <= span['ts'] and span['ts'] + span['dur'] <= test['ts'] + test['dur']]
+        qa.expect_eq(sorted((span['cat'], span['name']) for span in inner), [('plugin', 'Plugin.did_call_test_case'),
+            ('plugin', 'Plugin.did_run_test_case'), ('plugin', 'Plugin.extra_test_case_requirements'),
+            ('plugin', 'Plugin.will_run_test_case'), ('setup', 'slow_fixture'), ('teardown', 'slow_fixture'),
+            ('test', 'call')])
+        setup = [span for span in inner if span['cat'] == 'setup'][0]
+        qa.expect_gt(setup['dur'], 15000)
+
+    # Untraced runs don't record a timeline
+    result, = qa.run_test_cases(test_cases[:1], plugins=[qa.Plugin()])
+    qa.expect('trace' not in result.extra)